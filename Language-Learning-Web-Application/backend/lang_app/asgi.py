@@ -8,9 +8,19 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
+import sys
+from pathlib import Path
 
 from django.core.asgi import get_asgi_application
 
+# same as manage.py, the apps are imported as lang_app / lang_chat / login, so backend/ has to be on the path.
+# the chat view is async, so run it through this file to get the non-blocking cohere calls, e.g.
+#   uvicorn backend.lang_app.asgi:application --workers 2
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lang_app.settings')
+# no persistent connections under asgi, they'd be one per request thread and never closed (see DATABASES in
+# settings.py). put PgBouncer between the workers and postgres to pool them instead
+os.environ.setdefault('DATABASE_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
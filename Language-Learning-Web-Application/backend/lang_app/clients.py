@@ -0,0 +1,69 @@
+import asyncio
+import threading
+import weakref
+
+from lang_app import metrics
+
+# the clients for other services (cohere, recaptcha, translation, grammar checking), built the first time
+# something asks for them instead of when their module is imported.
+# the module that owns a client registers a factory for it:
+#   clients.register('cohere', make_cohere_client, per_loop=True)
+# and gets the client with clients.get('cohere'). the factory does the heavy imports (the cohere sdk,
+# google-cloud-translate) itself, so a process that never calls a service never pays for loading its sdk,
+# and a worker boots without any network setup.
+# per_loop clients hold an asyncio connection pool, which belongs to one event loop (under wsgi every async
+# view has its own), so there is one per loop, dropped with the loop. the rest are one per process.
+
+init_seconds = metrics.histogram('client_init_seconds', 'Building a client on first use', ['client'])
+
+_providers = {}  # name -> (factory, per_loop)
+_instances = {}
+_loop_instances = {}  # name -> WeakKeyDictionary(loop -> client)
+_lock = threading.Lock()
+
+
+def register(name, factory, per_loop=False):
+    # registering again replaces the factory (and drops what it built), the benchmarks swap clients that way
+    with _lock:
+        _providers[name] = (factory, per_loop)
+        _instances.pop(name, None)
+        _loop_instances[name] = weakref.WeakKeyDictionary()
+
+
+def registered():
+    return sorted(_providers)
+
+
+def _build(name, factory):
+    with init_seconds.time(client=name):
+        return factory()
+
+
+def get(name):
+    try:
+        factory, per_loop = _providers[name]
+    except KeyError:
+        raise LookupError(f'No client registered as {name!r}, registered: {registered()}') from None
+    if per_loop:
+        loop = asyncio.get_running_loop()
+        clients = _loop_instances[name]
+        client = clients.get(loop)
+        if client is None:
+            # no lock needed, only code running on this loop gets here for it
+            client = clients[loop] = _build(name, factory)
+        return client
+    client = _instances.get(name)
+    if client is None:
+        with _lock:
+            client = _instances.get(name)
+            if client is None:
+                client = _instances[name] = _build(name, factory)
+    return client
+
+
+def reset(name=None):
+    """Forget the built clients (all, or one), the next get builds them again."""
+    with _lock:
+        for provider in [name] if name else list(_providers):
+            _instances.pop(provider, None)
+            _loop_instances[provider] = weakref.WeakKeyDictionary()
@@ -0,0 +1,121 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+
+from lang_app import metrics
+
+# read replicas.
+# every query goes to the primary ('default') unless the code asks for a replica with
+#   with read_replica():
+#       ...
+# around reads that are fine with data a moment old (the chat history GET, username checks, loading the
+# dictionary lookup index). the replicas are the DATABASES aliases in DATABASE_REPLICAS (settings.py).
+#
+# read your writes: after a request that can write (POST, PUT, PATCH, DELETE) ReplicaPinningMiddleware
+# sets a short lived cookie, and while it's there that browser's reads stay on the primary even inside
+# read_replica(), so nobody posts a message and then gets a history page from a replica without it.
+# reads inside a transaction always stay on the primary as well.
+# the flags are contextvars, so they follow the request into sync_to_async threads and don't leak between
+# concurrent requests on the same event loop.
+
+PIN_COOKIE = 'db_primary'
+
+_use_replica = ContextVar('use_replica', default=False)
+_pinned = ContextVar('pinned_to_primary', default=False)
+
+reads_routed = metrics.counter('db_reads_routed_total', 'Reads sent to each database by the router', ['alias'])
+
+
+@contextmanager
+def read_replica():
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+@contextmanager
+def pinned_to_primary():
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def replica_for_read():
+    """The alias the next read should go to, 'default' unless read_replica() is on and nothing pins it."""
+    replicas = replica_aliases()
+    if not replicas or not _use_replica.get() or _pinned.get():
+        return 'default'
+    if connections['default'].in_atomic_block:
+        # the transaction may have written something the replicas haven't seen
+        return 'default'
+    return random.choice(replicas)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = replica_for_read()
+        reads_routed.inc(alias=alias)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema by replication
+        return db not in replica_aliases()
+
+
+class ReplicaPinningMiddleware:
+    """Keeps a browser's reads on the primary for DATABASE_REPLICA_PIN_SECONDS after it wrote something."""
+    sync_capable = True
+    async_capable = True
+
+    WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with self.pinned(request):
+            response = self.get_response(request)
+        return self.pin(request, response)
+
+    async def __acall__(self, request):
+        with self.pinned(request):
+            response = await self.get_response(request)
+        return self.pin(request, response)
+
+    @contextmanager
+    def pinned(self, request):
+        if PIN_COOKIE in request.COOKIES:
+            with pinned_to_primary():
+                yield
+        else:
+            yield
+
+    def pin(self, request, response):
+        if request.method in self.WRITE_METHODS and replica_aliases():
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.DATABASE_REPLICA_PIN_SECONDS, httponly=True, samesite='Lax',
+            )
+        return response
@@ -0,0 +1,214 @@
+import heapq
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from lang_app import metrics
+
+logger = logging.getLogger(__name__)
+
+# per view numbers for every request, on /metrics/ next to the rest (metrics.py).
+# InstrumentationMiddleware times the request and puts a RequestStats in a contextvar for it. everything the
+# request does reports into that: every database query through record_query, an execute_wrapper put on each
+# connection as it's opened, and every call to another service (cohere, recaptcha, translation) through
+#   with instrumentation.external_call('llm'):
+#       ...
+# the contextvar follows the request into sync_to_async threads, so the async views are counted as well.
+# when the request is done the middleware observes, labelled with the view class:
+#   http_request_duration_seconds, http_request_db_queries, http_request_db_seconds, http_request_external_seconds
+# a streamed response (chat/stream/) is measured up to the first chunk, what it does while streaming isn't counted.
+#
+# slow requests: of the requests slower than INSTRUMENTATION['SLOW_REQUEST_SECONDS'], SLOW_REQUEST_SAMPLE_RATE
+# get their slowest queries (up to EXPLAIN_QUERIES of them) explained and logged with the numbers above.
+
+request_seconds = metrics.histogram(
+    'http_request_duration_seconds', 'Requests, through the whole middleware stack', ['view', 'method', 'status'],
+)
+request_queries = metrics.histogram(
+    'http_request_db_queries', 'Database queries per request', ['view'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+request_db_seconds = metrics.histogram('http_request_db_seconds', 'Time per request spent in queries', ['view'])
+request_external_seconds = metrics.histogram(
+    'http_request_external_seconds', 'Time per request spent calling other services', ['view', 'service'],
+)
+external_seconds = metrics.histogram('external_call_seconds', 'Calls to other services', ['service', 'outcome'])
+slow_requests = metrics.counter('slow_requests_total', 'Requests slower than SLOW_REQUEST_SECONDS', ['view'])
+
+_stats = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    def __init__(self, keep_slowest=0):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.external = {}  # service -> seconds
+        self.keep_slowest = keep_slowest
+        self.slowest = []  # heap of (seconds, sequence, alias, sql, params), only selects
+        self._lock = threading.Lock()  # a request can run queries in more than one thread
+
+    def add_query(self, seconds, alias, sql, params):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+            if self.keep_slowest and params is not None and sql.lstrip()[:6].upper() == 'SELECT':
+                entry = (seconds, self.queries, alias, sql, params)
+                if len(self.slowest) < self.keep_slowest:
+                    heapq.heappush(self.slowest, entry)
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def add_external(self, service, seconds):
+        with self._lock:
+            self.external[service] = self.external.get(service, 0.0) + seconds
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.add_query(
+            time.perf_counter() - started, context['connection'].alias, sql, None if many else params,
+        )
+
+
+def install_query_recorder(connection, **kwargs):
+    # connection_created fires again on every reconnect of the same wrapper
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+class external_call:
+    """
+    Times a call to another service, for external_call_seconds and the current request's numbers.
+    Works with with and async with (next to another async context manager, like llm.py's upstream slot).
+    """
+
+    def __init__(self, service):
+        self.service = service
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._started
+        external_seconds.observe(elapsed, service=self.service, outcome='error' if exc_type else 'ok')
+        stats = _stats.get()
+        if stats is not None:
+            stats.add_external(self.service, elapsed)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__exit__(exc_type, exc, tb)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return getattr(match.func, 'view_class', match.func).__name__
+
+
+def explain_queries(queries):
+    """[(seconds, alias, sql, plan)] for the (seconds, sequence, alias, sql, params) of record_query."""
+    plans = []
+    for seconds, _, alias, sql, params in sorted(queries, reverse=True):
+        connection = connections[alias]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f'{connection.ops.explain_query_prefix()} {sql}', params)
+                plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+        except Exception as e:
+            plan = f'(could not explain: {e})'
+        plans.append((seconds, alias, sql, plan))
+    return plans
+
+
+class InstrumentationMiddleware:
+    """Latency, query and external call numbers per view, see the top of the module. Goes first in MIDDLEWARE."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        options = settings.INSTRUMENTATION
+        self.slow_seconds = options['SLOW_REQUEST_SECONDS']
+        self.sample_rate = options['SLOW_REQUEST_SAMPLE_RATE']
+        self.explain_count = options['EXPLAIN_QUERIES']
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _stats.reset(token)
+        elapsed = time.perf_counter() - started
+        self.observe(request, response, stats, elapsed)
+        if self.sampled(elapsed):
+            self.log_slow(request, stats, elapsed, explain_queries(stats.slowest))
+        return response
+
+    async def __acall__(self, request):
+        stats, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _stats.reset(token)
+        elapsed = time.perf_counter() - started
+        self.observe(request, response, stats, elapsed)
+        if self.sampled(elapsed):
+            # after the reset, so the explains themselves aren't counted
+            self.log_slow(request, stats, elapsed, await sync_to_async(explain_queries)(stats.slowest))
+        return response
+
+    def start(self):
+        # wrappers opened before this module was imported (runserver's checks) don't get connection_created
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+        stats = RequestStats(keep_slowest=self.explain_count if self.sample_rate else 0)
+        return stats, _stats.set(stats), time.perf_counter()
+
+    def observe(self, request, response, stats, elapsed):
+        view = view_name(request)
+        request_seconds.observe(elapsed, view=view, method=request.method, status=response.status_code)
+        request_queries.observe(stats.queries, view=view)
+        request_db_seconds.observe(stats.query_seconds, view=view)
+        for service, seconds in stats.external.items():
+            request_external_seconds.observe(seconds, view=view, service=service)
+        if elapsed >= self.slow_seconds:
+            slow_requests.inc(view=view)
+
+    def sampled(self, elapsed):
+        return elapsed >= self.slow_seconds and random.random() < self.sample_rate
+
+    def log_slow(self, request, stats, elapsed, plans):
+        view = view_name(request)
+        lines = [
+            f'Slow request {request.method} {request.path} ({view}): {elapsed:.3f}s, '
+            f'{stats.queries} queries in {stats.query_seconds:.3f}s, '
+            f"external {', '.join(f'{service} {seconds:.3f}s' for service, seconds in stats.external.items()) or 'none'}"
+        ]
+        for seconds, alias, sql, plan in plans:
+            lines.append(f'-- {seconds:.3f}s on {alias}: {sql}\n{plan}')
+        logger.warning('\n'.join(lines))
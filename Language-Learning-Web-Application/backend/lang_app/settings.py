@@ -64,6 +64,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so it times everything below it (lang_app/instrumentation.py)
+    'lang_app.instrumentation.InstrumentationMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -74,6 +76,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'allauth.account.middleware.AccountMiddleware',   
+    'lang_app.db_router.ReplicaPinningMiddleware',
 ]
 
 ROOT_URLCONF = 'backend.lang_app.urls'
@@ -108,9 +111,153 @@ DATABASES = {
         'PASSWORD': 'database-password',
         'HOST': '127.0.0.1',
         'PORT': '5432',
+        # under wsgi, keep connections open between requests instead of paying the connect (and the proxy's)
+        # every time, checked before reuse so one dropped by the server or the proxy is replaced instead of
+        # failing a request.
+        # not under asgi: every request gets a ThreadSensitiveContext and runs its ORM calls in a thread of its
+        # own, with its own connection, so a persistent one would outlive its thread and leak. asgi.py sets
+        # DATABASE_CONN_MAX_AGE=0, connections are closed at the end of each request and the pooling is done
+        # outside django, by PgBouncer (transaction pooling) or the cloud sql proxy in front of the database
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 300)),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
+# read replicas (lang_app/db_router.py), DATABASE_REPLICA_HOSTS=host[:port],host[:port]...
+# each one becomes a 'replica<n>' alias with the same credentials as the primary.
+# only code inside read_replica() reads from them
+DATABASE_REPLICAS = []
+for number, address in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',')), 1):
+    host, _, port = address.strip().partition(':')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica{number}')
+DATABASE_ROUTERS = ['lang_app.db_router.ReplicaRouter']
+# how long a browser reads from the primary after it wrote something, longer than the replication lag
+DATABASE_REPLICA_PIN_SECONDS = 10
+
+# username/email availability filters of the register form (login/availability.py).
+# sized for at least CAPACITY names at ERROR_RATE false positives, reloaded every MAX_AGE seconds
+USERNAME_FILTER_CAPACITY = 100000
+USERNAME_FILTER_ERROR_RATE = 0.01
+USERNAME_FILTER_MAX_AGE = 600
+
+# login and registration (login/auth_pipeline.py).
+# threads that hash passwords, None means one per core up to 4
+PASSWORD_HASHING_WORKERS = None
+RECAPTCHA_VERIFY_URL = os.environ.get(
+    'RECAPTCHA_VERIFY_URL',
+    'https://recaptchaenterprise.googleapis.com/v1/projects/lang-aide/assessments?key=my-recaptcha-key',
+)
+RECAPTCHA_SITE_KEY = os.environ.get('RECAPTCHA_SITE_KEY', 'my-recaptcha-sitekey')
+RECAPTCHA_TIMEOUT = 5
+RECAPTCHA_MAX_CONNECTIONS = 50
+# a token that failed verification or was already used for a registration is refused for this many seconds
+# without asking google again (tokens expire after two minutes anyway). valid verdicts are never cached
+RECAPTCHA_CACHE_TTL = 120
+
+# Caches
+# chat_context holds the recent chat_history of each chat (lang_chat/context_cache.py).
+# by default it's an in-process LRU, set CHAT_CONTEXT_REDIS_URL to share it between processes
+# through redis (or any server that speaks the redis protocol)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'chat_context': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'chat-context',
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+if os.environ.get('CHAT_CONTEXT_REDIS_URL'):
+    CACHES['chat_context'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['CHAT_CONTEXT_REDIS_URL'],
+    }
+
+# sessions live in their own cache (login/session_backend.py), set SESSION_REDIS_URL when there is
+# more than one process, with per process memory a session changed in one isn't seen by the others
+CACHES['sessions'] = {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'sessions',
+    'OPTIONS': {'MAX_ENTRIES': 100000},
+}
+if os.environ.get('SESSION_REDIS_URL'):
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['SESSION_REDIS_URL'],
+    }
+
+SESSION_ENGINE = 'login.session_backend'
+SESSION_CACHE_ALIAS = 'sessions'
+# changed sessions are written to the database this many seconds after the request at the latest
+SESSION_WRITE_BEHIND_INTERVAL = 1.0
+# signed api tokens from the login view (login/tokens.py) are good for this many seconds
+API_TOKEN_MAX_AGE = 60 * 60 * 24 * 7
+
+CHAT_CONTEXT_CACHE_ALIAS = 'chat_context'
+# seconds an idle chat stays cached
+CHAT_CONTEXT_CACHE_TIMEOUT = 60 * 60 * 24
+# how many past messages are sent to cohere as chat_history
+CHAT_HISTORY_LENGTH = 5
+
+# where translations come from when they aren't in the translation memory yet (lang_chat/translation.py).
+# lang_chat.translation.StubTranslationBackend works without any credentials, for local development and tests
+TRANSLATION_BACKEND = os.environ.get('TRANSLATION_BACKEND', 'lang_chat.translation.GoogleTranslationBackend')
+
+# background grammar checking (lang_chat/grammar.py, python manage.py run_grammar_worker).
+# lang_chat.grammar.StubGrammarChecker works without an api key, for local development and tests
+GRAMMAR_CHECKER = os.environ.get('GRAMMAR_CHECKER', 'lang_chat.grammar.GingerGrammarChecker')
+GINGER_API_KEY = os.environ.get('GINGER_API_KEY', 'my-ginger-api-key')
+GRAMMAR_CHECKER_TIMEOUT = 10
+GRAMMAR_BATCH_SIZE = 20
+# a job is marked failed after this many batches it was in failed
+GRAMMAR_MAX_ATTEMPTS = 3
+# how long a worker may take to check a batch it claimed before its jobs go back in the queue.
+# longer than GRAMMAR_BATCH_SIZE ginger calls running into GRAMMAR_CHECKER_TIMEOUT
+GRAMMAR_LEASE_SECONDS = 300
+
+# pronunciation recordings (lang_chat/audio.py)
+AUDIO_STORAGE_BACKEND = 'lang_chat.audio.LocalAudioStorage'
+AUDIO_STORAGE_ROOT = BASE_DIR / 'media' / 'audio'
+AUDIO_URL = '/media/audio/'
+# request bodies are copied to storage this many bytes at a time
+AUDIO_UPLOAD_CHUNK_SIZE = 64 * 1024
+AUDIO_UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+
+# every process keeps the dictionary in memory for lookups (lang_chat/lookup.py), its own edits show up
+# right away, edits made by other processes after at most this many seconds
+DICTIONARY_INDEX_MAX_AGE = 300
+
+# messages older than this many months are moved out of the database by archive_messages
+# (lang_chat/archive.py) into gzipped files under MESSAGE_ARCHIVE_ROOT, the chat history still reads them
+MESSAGE_HOT_MONTHS = 12
+MESSAGE_ARCHIVE_ROOT = BASE_DIR / 'archive' / 'messages'
+
+# pronunciation scoring (lang_chat/scoring.py, python manage.py score_pronunciation).
+# there is no real scorer yet, the stub makes deterministic scores up from the recording
+PRONUNCIATION_SCORER = os.environ.get('PRONUNCIATION_SCORER', 'lang_chat.scoring.StubPronunciationScorer')
+# scoring processes, None means one per available core
+PRONUNCIATION_SCORER_WORKERS = None
+PRONUNCIATION_BATCH_SIZE = 32
+PRONUNCIATION_MAX_ATTEMPTS = 3
+# how long a worker may take to score a batch it claimed before its recordings go back in the queue
+PRONUNCIATION_LEASE_SECONDS = 300
+
+# group commit for chat messages (lang_chat/writes.py).
+# when enabled, the turns of concurrent requests are collected for up to MAX_WAIT_MS
+# (or MAX_BATCH turns) and inserted together in one transaction
+CHAT_GROUP_COMMIT = {
+    'ENABLED': os.environ.get('CHAT_GROUP_COMMIT', '') == '1',
+    'MAX_BATCH': 64,
+    'MAX_WAIT_MS': 5,
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -194,10 +341,67 @@ COMPRESS_ROOT = BASE_DIR / 'dist'
   
 COMPRESS_ENABLED = True
   
-STATICFILES_FINDERS = ('compressor.finders.CompressorFinder',)
+# the compressor finder alone found nothing in STATICFILES_DIRS, so collectstatic collected none of dist/
+STATICFILES_FINDERS = (
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+    'compressor.finders.CompressorFinder',
+)
+
+# collectstatic writes content hashed copies of the static files plus .gz/.br variants of the text ones,
+# lang_app.storage.serve_static serves them by the manifest (see lang_app/storage.py)
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'lang_app.storage.PrecompressedManifestStaticFilesStorage'},
+}
+# which files get precompressed, smaller ones aren't worth a Content-Encoding
+STATIC_PRECOMPRESS = {
+    'EXTENSIONS': ('.js', '.css', '.html', '.svg', '.json', '.map', '.txt', '.xml', '.ico', '.ttf', '.eot'),
+    'MIN_SIZE': 512,
+}
 
 COMPRESS_URL = '/static/'
 
+# Cohere chat api (lang_chat/llm.py)
+# the key was hardcoded in views.py before, privacy reasons, replaced it
+COHERE_API_KEY = os.environ.get('COHERE_API_KEY', 'my-cohere-api-key')
+# None means cohere's own api, the benchmarks point this at a local fake server
+COHERE_BASE_URL = os.environ.get('COHERE_BASE_URL') or None
+# seconds before a completion is given up on
+COHERE_TIMEOUT = float(os.environ.get('COHERE_TIMEOUT', 60))
+# how many completions one process keeps in flight at once, the rest wait their turn
+COHERE_MAX_CONCURRENT_REQUESTS = int(os.environ.get('COHERE_MAX_CONCURRENT_REQUESTS', 100))
+# the turn waiting behind them (lang_chat/throttle.py): past MAX_QUEUE waiting calls, or MAX_WAIT seconds of
+# waiting, a chat gets a 429 with Retry-After instead
+CHAT_UPSTREAM = {
+    'MAX_QUEUE': int(os.environ.get('CHAT_UPSTREAM_MAX_QUEUE', 200)),
+    'MAX_WAIT': float(os.environ.get('CHAT_UPSTREAM_MAX_WAIT', 10)),
+}
+# messages per client (user, or ip when not logged in): BURST at once, refilled at PER_MINUTE.
+# the buckets are in CACHE_ALIAS, shared between processes when that's redis. PER_MINUTE 0 turns it off
+CHAT_RATE_LIMIT = {
+    'PER_MINUTE': int(os.environ.get('CHAT_RATE_LIMIT_PER_MINUTE', 20)),
+    'BURST': 10,
+    'CACHE_ALIAS': 'default',
+}
+# identical requests (same history, message and sampling params) are answered from an in-process cache,
+# up to this many entries for this many seconds. 0 turns the cache off
+COHERE_COMPLETION_CACHE_SIZE = int(os.environ.get('COHERE_COMPLETION_CACHE_SIZE', 2000))
+COHERE_COMPLETION_CACHE_TTL = 60 * 60
+
+# /metrics/ (lang_app/metrics.py) is only served to scrapes sending "Authorization: Bearer <METRICS_TOKEN>",
+# in prometheus: authorization: {credentials: <METRICS_TOKEN>}. empty (the default) turns it off
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# per view latency / query / external call metrics, see lang_app/instrumentation.py.
+# of the requests slower than SLOW_REQUEST_SECONDS, SLOW_REQUEST_SAMPLE_RATE get the plans of their
+# EXPLAIN_QUERIES slowest selects logged
+INSTRUMENTATION = {
+    'SLOW_REQUEST_SECONDS': float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0)),
+    'SLOW_REQUEST_SAMPLE_RATE': float(os.environ.get('SLOW_REQUEST_SAMPLE_RATE', 0.1)),
+    'EXPLAIN_QUERIES': 3,
+}
+
 def show_toolbar(request):
     return not request.path.startswith(('/login/', '/register/'))
 
@@ -205,12 +409,6 @@ DEBUG_TOOLBAR_CONFIG = {
     'SHOW_TOOLBAR_CALLBACK': show_toolbar,
 }
 
-# debug purposes
-print(f"STATICFILES_DIRS is currently: {STATICFILES_DIRS}")
-print(f"STATIC_ROOT is currently: {STATIC_ROOT}")
-print(f"STATIC_URL is currently: {STATIC_URL}")
-print(f"BASE_DIR is currently: {BASE_DIR}")
-
 CORS_ALLOW_ALL_ORIGINS = True
 
 # Or to allow specific origins:
@@ -0,0 +1,53 @@
+"""
+Lean settings for the production web workers, DJANGO_SETTINGS_MODULE=lang_app.settings_production.
+
+Everything from settings.py, minus the apps the live routes (admin/, login/, register/, chat/ and the
+api next to them) don't use: no allauth with its facebook/twitter/google providers, no debug_toolbar,
+compressor, dj_rest_auth or rest_framework's own urls. urls.py only routes what's installed.
+A worker boots noticeably faster without them, measure with
+    python manage.py startup_profile --settings lang_app.settings_production
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+ALLOWED_HOSTS = [host for host in os.environ.get('ALLOWED_HOSTS', '').split(',') if host] or ALLOWED_HOSTS
+
+SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY', SECRET_KEY)
+
+INSTALLED_APPS = [
+    'django.contrib.admin',
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    'corsheaders',
+    'backend.lang_chat',
+    'backend.login',
+]
+
+# the debug toolbar and allauth's middleware are gone with their apps
+MIDDLEWARE = [
+    middleware for middleware in MIDDLEWARE
+    if not middleware.startswith(('debug_toolbar.', 'allauth.'))
+]
+
+# allauth's backend is gone as well. EmailBackend is the one the login view logs people in with,
+# a session only stays logged in when its backend is listed here
+AUTHENTICATION_BACKENDS = (
+    'login.views.EmailBackend',
+    'django.contrib.auth.backends.ModelBackend',
+)
+
+# settings.py's finders without the compressor one
+STATICFILES_FINDERS = (
+    'django.contrib.staticfiles.finders.FileSystemFinder',
+    'django.contrib.staticfiles.finders.AppDirectoriesFinder',
+)
+
+# the cors middleware still allows everything in settings.py, keep it to the frontend here
+CORS_ALLOW_ALL_ORIGINS = False
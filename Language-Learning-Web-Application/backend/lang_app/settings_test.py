@@ -0,0 +1,36 @@
+"""
+Settings for the tests, DJANGO_SETTINGS_MODULE=lang_app.settings_test:
+    python manage.py test lang_app.tests lang_chat.tests login.tests --settings lang_app.settings_test
+
+The production settings against two throwaway sqlite files, a primary and a 'replica1' next to it, so
+the replica routing (db_router.py) can be checked against two real databases. Nothing is called upstream.
+"""
+
+import tempfile
+from pathlib import Path
+
+from .settings_production import *  # noqa: F401,F403
+
+TEST_DATABASE_DIR = Path(tempfile.gettempdir())
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': TEST_DATABASE_DIR / 'lang-app-test-default.sqlite3',
+        'TEST': {'NAME': str(TEST_DATABASE_DIR / 'lang-app-test-default.sqlite3')},
+    },
+    'replica1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': TEST_DATABASE_DIR / 'lang-app-test-replica1.sqlite3',
+        # a database of its own, not a mirror of default: the tests look at which one a read went to
+        'TEST': {'NAME': str(TEST_DATABASE_DIR / 'lang-app-test-replica1.sqlite3')},
+    },
+}
+DATABASE_REPLICAS = ['replica1']
+
+# hashing at the default 600k iterations would be most of the run
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+TRANSLATION_BACKEND = 'lang_chat.translation.StubTranslationBackend'
+GRAMMAR_CHECKER = 'lang_chat.grammar.StubGrammarChecker'
+CHAT_GROUP_COMMIT = {**CHAT_GROUP_COMMIT, 'ENABLED': False}
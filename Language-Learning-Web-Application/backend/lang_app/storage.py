@@ -0,0 +1,199 @@
+import gzip
+import json
+import logging
+import mimetypes
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import parse_etags, quote_etag
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# the frontend's static files (the webpack bundles in dist/, STATICFILES_DIRS).
+#
+# build: collectstatic with PrecompressedManifestStaticFilesStorage (STORAGES['staticfiles']) copies every file
+# under a content hashed name (main.bundle.3f2a9c1e.js, django's ManifestStaticFilesStorage), rewrites the
+# references to them in css, js and html (so index.html points at the hashed bundles), and writes a .gz and a
+# .br (with the brotli package installed) next to every text file that gets smaller.
+# staticfiles.json maps the names to the hashed names, precompressed.json lists the encodings of each file.
+#
+# serving: serve_static / serve_index look the file up in those manifests, so no stat or directory walk per
+# request, and hand the precompressed variant the client accepts (br, then gzip) to FileResponse. nothing is
+# compressed per request. under wsgi the server can send the file with wsgi.file_wrapper (sendfile), under asgi
+# django 4.2 reads the whole file into memory first (sync_to_async(list) over the file's blocks) and sends that,
+# so in production the front server (nginx gzip_static / brotli_static, or a cdn) should serve /static/ from
+# STATIC_ROOT instead, these views are for runserver, wsgi deployments and whatever gets past the proxy.
+# hashed names never change, they're cached for a year as immutable. anything else (index.html and whatever is
+# asked for by its plain name) is no-cache with an ETag, so a deploy shows up right away and costs a 304 otherwise.
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # in order of preference
+
+
+class PrecompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    encodings_manifest_name = 'precompressed.json'
+
+    # absolute links to STATIC_URL in html (index.html from webpack), <script src="/static/..."> and <link href=...>.
+    # the rest (relative links, /login...) are left alone
+    html_patterns = (
+        '*.html',
+        (
+            (
+                r"""(?P<matched>\b(?P<attr>src|href)=(?P<quote>["'])(?P<url>/[^"']*?)(?P=quote))""",
+                '%(attr)s=%(quote)s%(url)s%(quote)s',
+            ),
+        ),
+    )
+
+    def __init__(self, *args, **kwargs):
+        self.patterns = self.patterns + (self.html_patterns,)
+        super().__init__(*args, **kwargs)
+        options = settings.STATIC_PRECOMPRESS
+        self.compress_extensions = set(options['EXTENSIONS'])
+        self.compress_min_size = options['MIN_SIZE']
+        self.encodings = self.load_encodings()
+
+    def load_encodings(self):
+        try:
+            with self.manifest_storage.open(self.encodings_manifest_name) as manifest:
+                return json.loads(manifest.read().decode())
+        except FileNotFoundError:
+            return {}
+
+    def post_process(self, paths, dry_run=False, **options):
+        self.encodings = {}
+        if brotli is None and not dry_run:
+            logger.warning('brotli is not installed, only writing .gz variants (pip install brotli)')
+        # the manifest is saved after the last file, by then every file below is compressed
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if not dry_run and hashed_name and not isinstance(processed, Exception):
+                self.compress(hashed_name)
+            yield name, hashed_name, processed
+
+    def compress(self, name):
+        if posixpath.splitext(name)[1].lower() not in self.compress_extensions:
+            return
+        with self.open(name) as original:
+            content = original.read()
+        if len(content) < self.compress_min_size:
+            return
+        variants = {'gzip': gzip.compress(content, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(content, quality=11)
+        for encoding, suffix in ENCODINGS:
+            data = variants.get(encoding)
+            # not worth a Content-Encoding when it barely shrinks (already minified images, fonts...)
+            if data is None or len(data) >= len(content) * 0.95:
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            self._save(name + suffix, ContentFile(data))
+            self.encodings.setdefault(name, []).append(encoding)
+
+    def save_manifest(self):
+        super().save_manifest()
+        if self.manifest_storage.exists(self.encodings_manifest_name):
+            self.manifest_storage.delete(self.encodings_manifest_name)
+        self.manifest_storage._save(
+            self.encodings_manifest_name, ContentFile(json.dumps(self.encodings, sort_keys=True).encode()),
+        )
+
+
+_hashed_names = None
+
+
+def hashed_names():
+    # every hashed name of the manifest, those are the immutable ones
+    global _hashed_names
+    if _hashed_names is None:
+        _hashed_names = frozenset(getattr(staticfiles_storage, 'hashed_files', {}).values())
+    return _hashed_names
+
+
+def quality(params):
+    # the q of ";q=0.5", 1 without one. a q that isn't a number ("q=.", "q=1.2.3") counts as 1, like no q at all
+    match = re.search(r'q\s*=\s*([^\s;]*)', params)
+    if match is None:
+        return 1.0
+    try:
+        return float(match.group(1))
+    except ValueError:
+        return 1.0
+
+
+def accepted_encodings(request):
+    """The content codings the client takes, from Accept-Encoding (q=0 means refused)."""
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding and quality(params) > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def file_response(request, name, cache_control, etag=None):
+    """FileResponse for a name in STATIC_ROOT, precompressed when there's a variant the client accepts."""
+    path, encoding = safe_join(settings.STATIC_ROOT, name), None
+    available = getattr(staticfiles_storage, 'encodings', {}).get(name, ())
+    if available:
+        accepted = accepted_encodings(request)
+        for candidate, suffix in ENCODINGS:
+            if candidate in available and (candidate in accepted or '*' in accepted):
+                path, encoding = path + suffix, candidate
+                break
+    if etag is not None:
+        etag = quote_etag(f'{etag}-{encoding}' if encoding else etag)
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            response['Cache-Control'] = cache_control
+            return response
+    try:
+        response = FileResponse(open(path, 'rb'))
+    except (FileNotFoundError, IsADirectoryError):
+        raise Http404(name)
+    # the type of the file, not of the .gz / .br
+    response['Content-Type'] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if available:
+        response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = cache_control
+    if etag is not None:
+        response['ETag'] = etag
+    return response
+
+
+def serve_static(request, path):
+    name = posixpath.normpath(path).lstrip('/')
+    if name in hashed_names():
+        return file_response(request, name, IMMUTABLE)
+    hashed_name = getattr(staticfiles_storage, 'hashed_files', {}).get(name)
+    if hashed_name is not None:
+        # asked for by its plain name, that one can change with the next deploy
+        return file_response(request, hashed_name, REVALIDATE, etag=hashed_name)
+    if settings.DEBUG:
+        # not collected yet, straight from dist/ like runserver would
+        found = finders.find(name)
+        if found:
+            response = FileResponse(open(found, 'rb'))
+            response['Cache-Control'] = REVALIDATE
+            return response
+    raise Http404(name)
+
+
+def serve_index(request):
+    # the single page app's entry point, never cached without asking (the hashed bundles it points at are)
+    return serve_static(request, 'index.html')
@@ -0,0 +1,84 @@
+from django.db import connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+
+from lang_app.db_router import PIN_COOKIE, ReplicaPinningMiddleware, pinned_to_primary, read_replica, replica_for_read
+from lang_chat.models import Dictionary
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], DATABASE_ROUTERS=['lang_app.db_router.ReplicaRouter'])
+class ReplicaRouterTests(TransactionTestCase):
+    # settings_test.py's default and replica1 are two sqlite files. nothing replicates between them here,
+    # so a row written to only one of them shows which database a read went to
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        # replicas get their schema by replication (allow_migrate), so the test database has no tables,
+        # and the flush between tests doesn't know about this one either
+        with connections['replica1'].schema_editor() as editor:
+            editor.create_model(Dictionary)
+        self.addCleanup(self.drop_replica_table)
+        Dictionary.objects.create(english_word='primary', chinese_translation='主')
+        Dictionary.objects.using('replica1').create(english_word='replica', chinese_translation='副')
+
+    def drop_replica_table(self):
+        with connections['replica1'].schema_editor() as editor:
+            editor.delete_model(Dictionary)
+
+    def words(self):
+        return list(Dictionary.objects.values_list('english_word', flat=True))
+
+    def test_reads_go_to_the_primary_by_default(self):
+        self.assertEqual(self.words(), ['primary'])
+
+    def test_read_replica_reads_from_the_replica(self):
+        with read_replica():
+            self.assertEqual(replica_for_read(), 'replica1')
+            self.assertEqual(self.words(), ['replica'])
+
+    def test_writes_go_to_the_primary(self):
+        with read_replica():
+            Dictionary.objects.create(english_word='written', chinese_translation='写')
+        self.assertEqual(sorted(self.words()), ['primary', 'written'])
+        self.assertFalse(Dictionary.objects.using('replica1').filter(english_word='written').exists())
+
+    def test_pinned_reads_stay_on_the_primary(self):
+        with read_replica(), pinned_to_primary():
+            self.assertEqual(self.words(), ['primary'])
+
+    def test_reads_in_a_transaction_stay_on_the_primary(self):
+        with read_replica(), transaction.atomic():
+            self.assertEqual(self.words(), ['primary'])
+
+    def test_a_write_request_pins_the_next_reads(self):
+        seen = []
+
+        def get_response(request):
+            with read_replica():
+                seen.append(replica_for_read())
+            return HttpResponse()
+
+        middleware = ReplicaPinningMiddleware(get_response)
+        factory = RequestFactory()
+        response = middleware(factory.post('/chat/'))
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        middleware(factory.get('/chat/'))
+        pinned = factory.get('/chat/')
+        pinned.COOKIES[PIN_COOKIE] = '1'
+        middleware(pinned)
+        self.assertEqual(seen, ['replica1', 'replica1', 'default'])
+
+
+class MetricsViewTests(TestCase):
+    @override_settings(METRICS_TOKEN='')
+    def test_not_served_without_a_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
+
+    @override_settings(METRICS_TOKEN='scrape-me')
+    def test_only_served_to_scrapes_with_the_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 401)
+        self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE', response.content)
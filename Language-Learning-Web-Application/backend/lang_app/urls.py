@@ -15,13 +15,20 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 
+import re
+
 from django.urls import include, path, re_path
 from login.views import UserLoginView, UserRegisterView
-from lang_chat.views import ChatView
+from lang_chat.views import (
+    ChatView, ChatStreamView, TranslateChatView, AudioUploadView, AudioUploadChunkView,
+    ReviewDueView, ReviewCardsView, ReviewSubmitView, DictionaryLookupView,
+    DictionaryImportView, DictionaryExportView, MessageSearchView, InboxView, ChatReadView,
+)
+from django.apps import apps
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.views.static import serve
+from lang_app.metrics import metrics_view
+from lang_app.storage import serve_index, serve_static
 
 
 #GoogleLogin, UserRedirectView,
@@ -35,21 +42,52 @@ urlpatterns = [
     
     # i'm currently working on this, so that each chat differs by the chat_id in the link
     path('chat/<int:chat_id>/', ChatView.as_view(), name='chat'),
-    path("api-auth/", include("rest_framework.urls")),
-    path("dj_rest-auth/", include("dj_rest_auth.urls")),
-    path("dj-rest-auth/registration/", include("dj_rest_auth.registration.urls")),
-    path('api/', include('myapi.urls')),
-    re_path(r'^$', serve, kwargs={'path': 'index.html'}),  
- ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-
-if settings.DEBUG:
+    # same as chat/ POST but the reply is streamed back token by token (server-sent events)
+    path("chat/stream/", ChatStreamView.as_view(), name='chat_stream'),
+    path('chat/<int:chat_id>/stream/', ChatStreamView.as_view(), name='chat_stream'),
+    # translates a page of the chat at once, ?target=<language>
+    path('chat/<int:chat_id>/translate/', TranslateChatView.as_view(), name='chat_translate'),
+    # full text search of past messages, in one chat or everything the user wrote/got
+    path('chat/<int:chat_id>/search/', MessageSearchView.as_view(), name='chat_search'),
+    path("search/", MessageSearchView.as_view(), name='message_search'),
+    # the user's chat list with unread counts, and marking a chat as read
+    path("inbox/", InboxView.as_view(), name='inbox'),
+    path('chat/<int:chat_id>/read/', ChatReadView.as_view(), name='chat_read'),
+    # resumable, chunked uploads of pronunciation recordings
+    path("audio/uploads/", AudioUploadView.as_view(), name='audio_upload'),
+    path('audio/uploads/<uuid:upload_id>/', AudioUploadChunkView.as_view(), name='audio_upload_chunk'),
+    # spaced repetition reviews of the dictionary
+    path("review/due/", ReviewDueView.as_view(), name='review_due'),
+    path("review/cards/", ReviewCardsView.as_view(), name='review_cards'),
+    path("review/", ReviewSubmitView.as_view(), name='review_submit'),
+    # dictionary typeahead with typo tolerant matches
+    path("dictionary/lookup/", DictionaryLookupView.as_view(), name='dictionary_lookup'),
+    # bulk word lists for staff, csv or jsonl
+    path("dictionary/import/", DictionaryImportView.as_view(), name='dictionary_import'),
+    path("dictionary/export/", DictionaryExportView.as_view(), name='dictionary_export'),
+    # prometheus metrics (grammar queue depth and throughput...), see lang_app/metrics.py
+    path("metrics/", metrics_view, name='metrics'),
+    # the frontend, index.html and the collected, hashed and precompressed bundles (lang_app/storage.py)
+    path('', serve_index, name='index'),
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.STATIC_URL.lstrip('/')), serve_static, name='static'),
+ ]
+
+# only routed when their apps are installed, settings_production.py leaves them out
+if apps.is_installed('rest_framework'):
+    urlpatterns.append(path("api-auth/", include("rest_framework.urls")))
+if apps.is_installed('dj_rest_auth'):
+    urlpatterns.append(path("dj_rest-auth/", include("dj_rest_auth.urls")))
+if apps.is_installed('dj_rest_auth.registration'):
+    urlpatterns.append(path("dj-rest-auth/registration/", include("dj_rest_auth.registration.urls")))
+if apps.is_installed('myapi'):
+    urlpatterns.append(path('api/', include('myapi.urls')))
+
+if settings.DEBUG and apps.is_installed('debug_toolbar'):
     import debug_toolbar
     urlpatterns = [
         path('__debug__/', include(debug_toolbar.urls)),
     ] + urlpatterns
     
-if settings.DEBUG:
-    urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
     
 """ path("dj-rest-auth/google/", GoogleLogin.as_view(), name="google_login"),
     path("dj-rest-auth/google/login/", GoogleLogin.as_view(), name="google_login"),
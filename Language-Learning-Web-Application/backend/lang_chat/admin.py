@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
-from .models import Message, Translation, GrammarCorrection, AudioSubmission, PronunciationFeedback, Dictionary
+from django.db.models import Q
+from . import search
+from .models import Message, Translation, GrammarCorrection, GrammarCheckJob, AudioSubmission, PronunciationFeedback, Dictionary, ReviewState, ArchivedPartition, ChatMembership
 
 # this is just tedious referencing on the models
 
@@ -22,6 +24,18 @@ class MessageAdmin(admin.ModelAdmin):
             # Don't allow editing the sender and recipient for existing messages
             return self.readonly_fields + ('sender', 'recipient')
         return self.readonly_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        # on postgres the message text is looked up in the full text index (search.py)
+        # instead of the ILIKE '%...%' scan search_fields would do. usernames still have to match exactly
+        if not search_term or not search.is_supported(queryset.db):
+            return super().get_search_results(request, queryset, search_term)
+        matches = queryset.alias(search_vector=search.search_vector()).filter(
+            Q(search_vector=search.any_language_query(search_term))
+            | Q(sender__username=search_term)
+            | Q(recipient__username=search_term)
+        )
+        return matches, False
 admin.site.register(Message, MessageAdmin)
 
 ## TRANSLATIONS
@@ -88,17 +102,30 @@ class GrammarCorrectionAdmin(admin.ModelAdmin):
         return self.readonly_fields
 admin.site.register(GrammarCorrection, GrammarCorrectionAdmin)
 
+## GRAMMAR CORRECTION QUEUE
+class GrammarCheckJobAdmin(admin.ModelAdmin):
+    list_display = ('job_id', 'message', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('message', 'created_at', 'finished_at', 'lease_until')  # the worker fills these in, only status/attempts can be reset
+admin.site.register(GrammarCheckJob, GrammarCheckJobAdmin)
+
 ## AUDIO SUBMISSIONS
 class AudioSubmissionAdmin(admin.ModelAdmin):
-    list_display = ('audio_id', 'user', 'message', 'audio_url', 'submission_date')
-    list_filter = ('submission_date', 'user')
-    search_fields = ('audio_url', 'message__message_text', 'user__username')  # Adjust field lookups according to user model fields
-    readonly_fields = ('submission_date',)  # To ensure the submission date is not editable
+    list_display = ('audio_id', 'user', 'message', 'audio_url', 'status', 'scoring_status', 'size', 'submission_date')
+    list_filter = ('submission_date', 'status', 'scoring_status', 'user')
+    search_fields = ('audio_url', 'content_hash', 'message__message_text', 'user__username')  # Adjust field lookups according to user model fields
+    readonly_fields = ('submission_date', 'content_hash', 'size', 'bytes_received', 'status')  # filled in by the upload, not editable
 
     fieldsets = (
         (None, {
             'fields': ('user', 'message', 'audio_url', 'submission_date')
         }),
+        ('Upload', {
+            'fields': ('status', 'size', 'bytes_received', 'content_hash')
+        }),
+        ('Scoring', {
+            'fields': ('scoring_status', 'scoring_attempts', 'scoring_lease_until')  # set back to pending to have it scored again
+        }),
     )
 admin.site.register(AudioSubmission, AudioSubmissionAdmin)
 
@@ -162,3 +189,29 @@ class DictionaryAdmin(admin.ModelAdmin):
         }),
     )
 admin.site.register(Dictionary, DictionaryAdmin)
+
+## REVIEW STATE
+class ReviewStateAdmin(admin.ModelAdmin):
+    list_display = ('review_id', 'user', 'entry', 'due_at', 'interval_days', 'repetitions', 'lapses', 'suspended')
+    list_filter = ('suspended',)
+    search_fields = ('user__username', 'entry__english_word')
+    raw_id_fields = ('user', 'entry')  # both tables get big, no dropdowns
+    readonly_fields = ('last_reviewed_at',)
+admin.site.register(ReviewState, ReviewStateAdmin)
+
+## ARCHIVED MESSAGES
+class ArchivedPartitionAdmin(admin.ModelAdmin):
+    list_display = ('archive_id', 'chat', 'month', 'message_count', 'path', 'archived_at')
+    list_filter = ('month',)
+    raw_id_fields = ('chat',)
+    readonly_fields = ('path', 'message_count', 'first_timestamp', 'last_timestamp', 'archived_at')
+admin.site.register(ArchivedPartition, ArchivedPartitionAdmin)
+
+## CHAT MEMBERSHIPS
+class ChatMembershipAdmin(admin.ModelAdmin):
+    list_display = ('chat_id', 'user', 'unread_count', 'last_message_at', 'last_read_at')
+    search_fields = ('user__username',)
+    raw_id_fields = ('chat', 'user')
+    # kept up to date by writes.write_turns (inbox.py)
+    readonly_fields = ('unread_count', 'last_message_at')
+admin.site.register(ChatMembership, ChatMembershipAdmin)
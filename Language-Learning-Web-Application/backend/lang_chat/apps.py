@@ -2,4 +2,22 @@ from django.apps import AppConfig
 
 class LangChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'lang_chat'
\ No newline at end of file
+    name = 'lang_chat'
+
+    def ready(self):
+        # registers the grammar and pronunciation queue metrics served at /metrics/.
+        # imported by absolute name, the app lives at lang_chat even though INSTALLED_APPS says backend.lang_chat
+        import lang_chat.grammar  # noqa: F401
+        import lang_chat.scoring  # noqa: F401
+
+        # keeps the in-memory dictionary lookup index (lookup.py) in step with the table
+        from django.db.models.signals import post_delete, post_migrate, post_save
+        from lang_chat import lookup, partitions, search
+        from lang_chat.models import Dictionary
+        post_save.connect(lookup.entry_saved, sender=Dictionary, dispatch_uid='dictionary_lookup_saved')
+        post_delete.connect(lookup.entry_deleted, sender=Dictionary, dispatch_uid='dictionary_lookup_deleted')
+
+        # the full text search column and index on the messages, they aren't part of the model
+        post_migrate.connect(search.install_search, sender=self, dispatch_uid='message_search_install')
+        # the coming months of the partitioned messages table (partitions.py), a no-op until partition_messages ran
+        post_migrate.connect(partitions.ensure_future_partitions, sender=self, dispatch_uid='message_partitions')
@@ -0,0 +1,200 @@
+import functools
+import gzip
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+
+from . import partitions
+from .models import ArchivedPartition, Chat, Message
+
+logger = logging.getLogger(__name__)
+
+# cold storage for old messages.
+# archive_messages writes every month older than MESSAGE_HOT_MONTHS to one gzipped jsonl file per chat
+# (MESSAGE_ARCHIVE_ROOT/<chat_id>/<yyyy-mm>.jsonl.gz), records it as an ArchivedPartition and then removes
+# the month from the database: on a partitioned table by detaching and dropping its partition (no row by
+# row DELETE, no vacuum afterwards), otherwise with a plain delete.
+# the chat history (pagination.history_page) falls through to archived_history once the database has no
+# older messages for a chat, so scrolling back keeps working the same, just from the files.
+# only a chat created before the end of the newest archived month (archive_horizon) can have archived months,
+# for every other chat (and everywhere until something is archived) that costs no query.
+
+# seconds a process keeps the horizon, after an archive run in another process a chat's newest archived
+# month can be missing from its history for that long
+HORIZON_TTL = 60
+
+_horizon = None  # (checked at, horizon)
+
+ARCHIVE_FIELDS = (
+    'message_id',
+    'chat_id',
+    'sender__username',
+    'recipient__username',
+    'is_from_ai',
+    'message_text',
+    'language',
+    'timestamp',
+)
+
+
+def archive_root():
+    return Path(settings.MESSAGE_ARCHIVE_ROOT)
+
+
+def archive_path(chat_id, month):
+    return f'{chat_id}/{month:%Y-%m}.jsonl.gz'
+
+
+def _write_file(path, rows):
+    full_path = archive_root() / path
+    full_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = full_path.with_name(full_path.name + '.tmp')
+    with gzip.open(temporary, 'wt', encoding='utf-8') as f:
+        for row in rows:
+            # full isoformat, DjangoJSONEncoder would cut the timestamp to milliseconds and break the cursors
+            f.write(json.dumps({**row, 'timestamp': row['timestamp'].isoformat()}, ensure_ascii=False) + '\n')
+    # only a complete file ever has the real name
+    os.replace(temporary, full_path)
+    read_archive.cache_clear()
+
+
+@functools.lru_cache(maxsize=32)
+def read_archive(path):
+    """All messages of one archive file, oldest first. Cached, the files never change once written."""
+    rows = []
+    with gzip.open(archive_root() / path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            row['timestamp'] = parse_datetime(row['timestamp'])
+            rows.append(row)
+    rows.sort(key=lambda row: (row['timestamp'], row['message_id']))
+    return tuple(rows)
+
+
+def _archive_chat_month(chat_id, month, rows, existing):
+    path = archive_path(chat_id, month)
+    if chat_id in existing:
+        # archived before (messages turned up later with an old timestamp), keep what's already in the file
+        new_ids = {row['message_id'] for row in rows}
+        rows = [row for row in read_archive(existing[chat_id].path) if row['message_id'] not in new_ids] + rows
+        rows.sort(key=lambda row: (row['timestamp'], row['message_id']))
+    _write_file(path, rows)
+    return ArchivedPartition(
+        chat_id=chat_id,
+        month=month,
+        path=path,
+        message_count=len(rows),
+        first_timestamp=rows[0]['timestamp'],
+        last_timestamp=rows[-1]['timestamp'],
+    )
+
+
+def write_month(month):
+    """Write the files of every chat with messages in month. Returns the (unsaved) ArchivedPartitions."""
+    start, end = partitions.month_bounds(month)
+    existing = {archive.chat_id: archive for archive in ArchivedPartition.objects.filter(month=month)}
+    messages = (
+        Message.objects.filter(timestamp__gte=start, timestamp__lt=end)
+        .order_by('chat_id', 'timestamp', 'message_id')
+        .values(*ARCHIVE_FIELDS)
+        .iterator(chunk_size=5000)
+    )
+    archived, chat_id, rows = [], None, []
+    for row in messages:
+        if row['chat_id'] != chat_id and rows:
+            archived.append(_archive_chat_month(chat_id, month, rows, existing))
+            rows = []
+        chat_id = row['chat_id']
+        rows.append(row)
+    if rows:
+        archived.append(_archive_chat_month(chat_id, month, rows, existing))
+    return archived
+
+
+def _remove_dependents(start, end):
+    # the foreign keys to Message have no database constraint (see Message.Meta), so what the database would
+    # otherwise cascade is done here, following each foreign key's on_delete
+    month_ids = Message.objects.filter(timestamp__gte=start, timestamp__lt=end).values('message_id')
+    for relation in Message._meta.related_objects:
+        related = relation.related_model._base_manager.filter(**{f'{relation.field.name}__in': month_ids})
+        if relation.on_delete is models.SET_NULL:
+            related.update(**{relation.field.name: None})
+        else:
+            related.delete()
+
+
+def _clear_last_messages(start, end):
+    # Chat.last_message is related_name='+', so it isn't among Message's related_objects above. a chat whose
+    # newest message is archived has no newer one left in the database, the inbox shows it without a last
+    # message (last_message_at stays, the chat keeps its place)
+    month_ids = Message.objects.filter(timestamp__gte=start, timestamp__lt=end).values('message_id')
+    return Chat.objects.filter(last_message__in=month_ids).update(last_message=None)
+
+
+def archive_horizon():
+    """The end of the newest archived month, None before anything was archived. Cached for HORIZON_TTL seconds."""
+    global _horizon
+    cached = _horizon
+    if cached is None or time.monotonic() - cached[0] > HORIZON_TTL:
+        newest = ArchivedPartition.objects.aggregate(newest=Max('month'))['newest']
+        cached = _horizon = (time.monotonic(), partitions.month_bounds(newest)[1] if newest else None)
+    return cached[1]
+
+
+def forget_horizon():
+    global _horizon
+    _horizon = None
+
+
+def may_have_archive(chat):
+    # messages are stamped when they're written, so a chat created after the newest archived month has none in it
+    horizon = archive_horizon()
+    return horizon is not None and chat.created_at < horizon
+
+
+def archive_month(month, log=logger.info):
+    """Move one month of messages to the archive. Returns the number of messages archived."""
+    start, end = partitions.month_bounds(month)
+    archived = write_month(month)
+    with transaction.atomic():
+        ArchivedPartition.objects.bulk_create(
+            archived,
+            update_conflicts=True,
+            unique_fields=['chat', 'month'],
+            update_fields=['path', 'message_count', 'first_timestamp', 'last_timestamp', 'archived_at'],
+        )
+        _remove_dependents(start, end)
+        _clear_last_messages(start, end)
+        if partitions.is_partitioned() and partitions.drop_partition(month):
+            log(f'{month:%Y-%m}: detached and dropped partition {partitions.partition_name(month)}')
+        # whatever is left: all of the month on a table that isn't partitioned,
+        # or stray rows of the month in the default partition
+        Message.objects.filter(timestamp__gte=start, timestamp__lt=end).delete()
+    forget_horizon()
+    return sum(archive.message_count for archive in archived)
+
+
+def archived_history(chat_id, before=None, limit=50, fields=None):
+    """
+    Up to limit archived messages of a chat older than before ((timestamp, message_id) or None),
+    newest first, like the database query in history_page.
+    """
+    archives = ArchivedPartition.objects.filter(chat_id=chat_id)
+    if before is not None:
+        archives = archives.filter(first_timestamp__lte=before[0])
+    rows = []
+    for path in archives.order_by('-month').values_list('path', flat=True):
+        for row in reversed(read_archive(path)):
+            if before is not None and (row['timestamp'], row['message_id']) >= before:
+                continue
+            rows.append({field: row.get(field) for field in fields} if fields else dict(row))
+            if len(rows) >= limit:
+                return rows
+    return rows
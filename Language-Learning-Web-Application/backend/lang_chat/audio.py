@@ -0,0 +1,195 @@
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import AudioSubmission
+
+# storage for pronunciation recordings.
+# uploads come in as a series of chunks (see AudioUploadView), each chunk is copied from the request
+# to storage CHUNK_SIZE bytes at a time, so a multi-MB clip is never held in memory as a whole.
+# a chunk is first written to a staging file of its own, however slowly the client sends it, without any lock.
+# only then is the upload's row locked, for as long as it takes to check the offset and copy the staged chunk
+# (local, no client involved) onto the partial file named after the upload id. once the last byte is in,
+# the file is hashed (again streamed) and moved to a path named after its sha256.
+# if that hash is already stored, the new copy is dropped and the submission points at the existing file.
+
+
+class UploadOffsetMismatch(Exception):
+    def __init__(self, expected):
+        super().__init__(f'Upload is at byte {expected}')
+        self.expected = expected
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class LocalAudioStorage:
+    # plain files under AUDIO_STORAGE_ROOT. another backend (object storage...) needs the same methods
+    def __init__(self, root=None, base_url=None):
+        self.root = Path(root or settings.AUDIO_STORAGE_ROOT)
+        self.base_url = base_url or settings.AUDIO_URL
+
+    def _path(self, name):
+        return self.root / name
+
+    def partial_name(self, upload_id):
+        return f'partial/{upload_id}'
+
+    def staging_name(self, upload_id):
+        # one per request, two requests sending the same chunk don't write into each other's file
+        return f'partial/{upload_id}.{uuid.uuid4().hex}'
+
+    def final_name(self, content_hash):
+        # two levels of directories so one folder doesn't end up with every recording
+        return f'{content_hash[:2]}/{content_hash}'
+
+    def exists(self, name):
+        return self._path(name).exists()
+
+    def size(self, name):
+        try:
+            return self._path(name).stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def append(self, name, stream, offset, limit, chunk_size):
+        """
+        Copy at most limit bytes from stream into the file at offset. Returns the bytes written.
+        """
+        path = self._path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        written = 0
+        with open(path, 'r+b' if path.exists() else 'wb') as f:
+            f.seek(offset)
+            # anything past offset is a leftover of an interrupted chunk, it gets rewritten
+            f.truncate()
+            while written < limit:
+                chunk = stream.read(min(chunk_size, limit - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+        return written
+
+    def hash(self, name, chunk_size):
+        digest = hashlib.sha256()
+        with open(self._path(name), 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def promote(self, name, final_name):
+        # returns False if final_name was already stored, the duplicate is deleted
+        final_path = self._path(final_name)
+        if final_path.exists():
+            self.delete(name)
+            return False
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self._path(name), final_path)
+        return True
+
+    def delete(self, name):
+        try:
+            self._path(name).unlink()
+        except FileNotFoundError:
+            pass
+
+    def open(self, name):
+        return open(self._path(name), 'rb')
+
+    def url(self, name):
+        return f'{self.base_url}{name}'
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = import_string(settings.AUDIO_STORAGE_BACKEND)()
+    return _storage
+
+
+def start_upload(size, content_type, user=None, message_id=None):
+    if size > settings.AUDIO_UPLOAD_MAX_SIZE:
+        raise UploadTooLarge(f'Audio uploads are limited to {settings.AUDIO_UPLOAD_MAX_SIZE} bytes')
+    upload_id = uuid.uuid4()
+    return AudioSubmission.objects.create(
+        upload_id=upload_id,
+        user=user,
+        message_id=message_id,
+        content_type=content_type,
+        size=size,
+        storage_path=get_storage().partial_name(upload_id),
+    )
+
+
+def _check_chunk(submission, offset, length):
+    # returns the number of bytes the chunk may have
+    if offset != submission.bytes_received:
+        raise UploadOffsetMismatch(submission.bytes_received)
+    remaining = submission.size - submission.bytes_received
+    if length is not None and length > remaining:
+        raise UploadTooLarge(f'Only {remaining} more bytes were announced for this upload')
+    return remaining if length is None else length
+
+
+def append_chunk(upload_id, stream, offset, length):
+    """
+    Write the next chunk of an upload, starting at offset.
+    Returns the updated submission, which is complete once its last byte arrived.
+    """
+    storage = get_storage()
+    chunk_size = settings.AUDIO_UPLOAD_CHUNK_SIZE
+    # checked before reading the chunk too, so a client that's out of sync finds out without sending it
+    submission = AudioSubmission.objects.get(upload_id=upload_id)
+    if submission.status == 'complete':
+        return submission
+    limit = _check_chunk(submission, offset, length)
+
+    staging_name = storage.staging_name(upload_id)
+    try:
+        written = storage.append(staging_name, stream, 0, limit, chunk_size)
+        # the row lock makes two requests for the same upload take turns, only for the copy and the update
+        with transaction.atomic():
+            submission = AudioSubmission.objects.select_for_update().get(upload_id=upload_id)
+            if submission.status == 'complete':
+                return submission
+            # another request for the same offset may have got in first
+            _check_chunk(submission, offset, length)
+            with storage.open(staging_name) as staged:
+                storage.append(submission.storage_path, staged, offset, written, chunk_size)
+            submission.bytes_received = offset + written
+            update_fields = ['bytes_received']
+
+            submission.deduplicated = False
+            if submission.bytes_received == submission.size:
+                submission.deduplicated = _finish(submission, storage, chunk_size)
+                update_fields += ['content_hash', 'storage_path', 'audio_url', 'status']
+            submission.save(update_fields=update_fields)
+    finally:
+        storage.delete(staging_name)
+    return submission
+
+
+def _finish(submission, storage, chunk_size):
+    content_hash = storage.hash(submission.storage_path, chunk_size)
+    final_name = storage.final_name(content_hash)
+    stored = storage.promote(submission.storage_path, final_name)
+    submission.content_hash = content_hash
+    submission.storage_path = final_name
+    submission.audio_url = storage.url(final_name)
+    submission.status = 'complete'
+    # True when the same recording was already stored
+    return not stored
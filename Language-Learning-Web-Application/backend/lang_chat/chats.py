@@ -0,0 +1,61 @@
+import threading
+
+from .models import Chat
+
+# /chat/ without an id still works for the single local user, it just means this chat
+DEFAULT_CHAT_NAME = 'General'
+
+# chats are never renamed or deleted by the app, so once a chat has been looked up
+# its row is remembered and the next turn in it doesn't need another query.
+# writes.py calls forget_chat() if an insert ever points at a chat that is gone.
+MAX_CACHED_CHATS = 10000
+
+_chats = {}
+_default_chat_id = None
+_lock = threading.Lock()
+
+
+def _remember(chat):
+    with _lock:
+        if len(_chats) >= MAX_CACHED_CHATS:
+            _chats.clear()
+        _chats[chat.chat_id] = chat
+    return chat
+
+
+def get_chat(chat_id=None, create=False):
+    # chat/<int:chat_id>/ looks the chat up by id, returns None if it doesn't exist.
+    # plain chat/ falls back to the default chat, which is only created when a message is posted
+    global _default_chat_id
+    if chat_id is None:
+        chat_id = _default_chat_id
+        if chat_id is None:
+            chat = Chat.objects.filter(chat_name=DEFAULT_CHAT_NAME).order_by('chat_id').first()
+            if chat is None and create:
+                chat = Chat.objects.create(chat_name=DEFAULT_CHAT_NAME)
+            if chat is not None:
+                _default_chat_id = chat.chat_id
+                _remember(chat)
+            return chat
+
+    chat = _chats.get(chat_id)
+    if chat is None:
+        chat = Chat.objects.filter(chat_id=chat_id).first()
+        if chat is not None:
+            _remember(chat)
+    return chat
+
+
+def get_cached_chat(chat_id=None):
+    # the cache-only half of get_chat, lets async views skip the thread hop when the chat is known
+    if chat_id is None:
+        chat_id = _default_chat_id
+    return _chats.get(chat_id)
+
+
+def forget_chat(chat_id):
+    global _default_chat_id
+    with _lock:
+        _chats.pop(chat_id, None)
+        if _default_chat_id == chat_id:
+            _default_chat_id = None
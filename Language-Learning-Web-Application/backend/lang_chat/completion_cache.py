@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# cache of cohere completions.
+# learners send the same beginner prompts over and over ("how do I say hello"), and with temperature 0.2
+# the answer barely changes, so a repeat of the exact same request (same model, history, message and
+# sampling params) is answered from here instead of paying for another completion.
+#
+# - entries expire after a ttl, and the least recently used one is dropped when the cache is full
+# - single flight: if the same request is already waiting on cohere, later callers wait for that
+#   one call instead of sending their own. that goes for streams too (get_or_stream), the callers that
+#   come while one is streaming get the whole text in one piece when it's done
+# - hits, misses and coalesced waits are counted, see stats()
+
+
+class _LeaderCancelled(Exception):
+    # set on the shared future when the caller making the call was cancelled (its client went away),
+    # the callers waiting on it weren't, they go round again and one of them makes the call
+    pass
+
+
+def normalize_text(text):
+    # "How do I say hello? " and "how do i say  hello?" should hit the same entry
+    return ' '.join(text.split()).lower()
+
+
+def completion_key(model, chat_history, message, params):
+    payload = {
+        'model': model,
+        'chat_history': [
+            {'role': entry['role'], 'message': normalize_text(entry['message'])}
+            for entry in chat_history
+        ],
+        'message': normalize_text(message),
+        'params': params,
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':')).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+        self._inflight = {}  # key -> asyncio.Future of the call that is already running
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        # counted lookup, for callers that don't go through get_or_call (the streaming path)
+        text = self._lookup(key)
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, text = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return text
+
+    def set(self, key, text):
+        with self._lock:
+            self._store(key, text)
+
+    def _store(self, key, text):
+        # with the lock held
+        self._entries[key] = (time.monotonic() + self.ttl, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def add(self, key, text):
+        # set, unless there is a live entry for key already. True if this call stored it
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                return False
+            self._store(key, text)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _join(self, key, loop):
+        # (future, leading): the call already in flight for key on this loop to wait on, or a new one that
+        # this caller has to make and resolve
+        with self._lock:
+            inflight = self._inflight.get(key)
+            # a future can only be awaited on its own loop (only matters under wsgi)
+            if inflight is not None and inflight.get_loop() is loop:
+                self.coalesced += 1
+                return inflight, False
+            self.misses += 1
+            future = loop.create_future()
+            self._inflight[key] = future
+            return future, True
+
+    def _hit(self, key):
+        text = self._lookup(key)
+        if text is not None:
+            with self._lock:
+                self.hits += 1
+        return text
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def _fail(self, future, exception):
+        future.set_exception(exception)
+        # nobody may be waiting on it, don't let asyncio complain about an unretrieved exception
+        future.exception()
+
+    async def get_or_call(self, key, call, cache_if=None):
+        """
+        Return the cached text for key, or await call() once and cache its result (only when cache_if(result)
+        is true, if given). Concurrent callers with the same key share the one call.
+        """
+        while True:
+            text = self._hit(key)
+            if text is not None:
+                return text
+            future, leading = self._join(key, asyncio.get_running_loop())
+            if leading:
+                return await self._call(key, future, call, cache_if)
+            try:
+                # shield so one waiter being cancelled doesn't cancel the result for everyone else
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                continue
+
+    async def _call(self, key, future, call, cache_if):
+        try:
+            text = await call()
+        except asyncio.CancelledError:
+            # not future.cancel(), that would cancel every waiter along with this caller
+            self._fail(future, _LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._fail(future, e)
+            raise
+        else:
+            if cache_if is None or cache_if(text):
+                self.set(key, text)
+            future.set_result(text)
+            return text
+        finally:
+            self._done(key, future)
+
+    async def get_or_stream(self, key, stream, cache_if=None):
+        """
+        get_or_call for a call that produces its text in pieces, an async generator. The caller that makes
+        the call yields the pieces of stream() as they come, the others yield the cached text, or the text of
+        the stream already running for key once it's done, in one piece. The text is cached once the stream
+        ran to its end (and cache_if(text) is true, if given), never when it was cut off.
+        """
+        while True:
+            text = self._hit(key)
+            if text is not None:
+                yield text
+                return
+            future, leading = self._join(key, asyncio.get_running_loop())
+            if leading:
+                break
+            try:
+                text = await asyncio.shield(future)
+            except _LeaderCancelled:
+                continue
+            yield text
+            return
+
+        parts = []
+        upstream = stream()
+        try:
+            async for part in upstream:
+                parts.append(part)
+                yield part
+        except (asyncio.CancelledError, GeneratorExit):
+            # the client went away mid stream, the waiters go round again
+            self._fail(future, _LeaderCancelled())
+            raise
+        except BaseException as e:
+            self._fail(future, e)
+            raise
+        else:
+            text = ''.join(parts)
+            if cache_if is None or cache_if(text):
+                self.set(key, text)
+            future.set_result(text)
+        finally:
+            self._done(key, future)
+            # and the upstream call with it, right away rather than whenever it's garbage collected
+            await upstream.aclose()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
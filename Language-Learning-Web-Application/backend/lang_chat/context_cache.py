@@ -0,0 +1,90 @@
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import Message
+
+# per-chat cache of the chat_history that gets sent to cohere.
+# before this, every POST re-queried the last messages and then hit the database again for each
+# message.sender.username (the N+1 problem). now each chat keeps its last CHAT_HISTORY_LENGTH messages,
+# already in cohere's {"role", "message"} format, in the cache set by CHAT_CONTEXT_CACHE_ALIAS.
+# that alias is a normal django cache, so it can be the in-process LRU (LocMemCache)
+# or redis (or anything that speaks the redis protocol), see CACHES in settings.py.
+#
+# the database is only read when a chat isn't cached yet (or was evicted),
+# after that each new turn is appended in place once its messages are committed.
+# appending is a get and a set, two turns of the same chat appended at once would lose one of them.
+# so one writer at a time appends, under a cache.add lock that works the same in every process. a writer
+# that finds the lock taken doesn't wait, it counts itself on the lock and drops the entry, and the
+# holder drops it too if anybody was counted by the time it's done. the next read goes to the database.
+
+KEY_PREFIX = 'chat-context'
+# longer than any get and set of one entry, only matters if a process dies holding the lock
+LOCK_TIMEOUT = 10
+
+
+def _cache():
+    return caches[settings.CHAT_CONTEXT_CACHE_ALIAS]
+
+
+def _key(chat_id):
+    return f'{KEY_PREFIX}:{chat_id}'
+
+
+def _lock_key(chat_id):
+    return f'{KEY_PREFIX}-lock:{chat_id}'
+
+
+def _entry(is_from_ai, message_text):
+    # the ai is always the sender of its own messages, so is_from_ai is enough to pick the role
+    # and the sender doesn't have to be joined at all
+    return {'role': 'CHATBOT' if is_from_ai else 'USER', 'message': message_text}
+
+
+def load_from_db(chat_id):
+    # newest first to hit the (chat_id, timestamp, message_id) index, then flipped to chronological order
+    rows = (
+        Message.objects.filter(chat_id=chat_id)
+        .order_by('-timestamp', '-message_id')
+        .values_list('is_from_ai', 'message_text')[:settings.CHAT_HISTORY_LENGTH]
+    )
+    return [_entry(is_from_ai, text) for is_from_ai, text in reversed(rows)]
+
+
+def get_history(chat_id):
+    cache = _cache()
+    history = cache.get(_key(chat_id))
+    if history is None:
+        history = load_from_db(chat_id)
+        cache.set(_key(chat_id), history, settings.CHAT_CONTEXT_CACHE_TIMEOUT)
+    return list(history)
+
+
+def record_turn(chat_id, user_message_text, ai_message_text):
+    # called after the turn is committed. if the chat isn't cached there is nothing to update,
+    # the next get_history() reads it from the database including this turn
+    cache = _cache()
+    key, lock_key = _key(chat_id), _lock_key(chat_id)
+    # the value counts the writers that came while it was held
+    if not cache.add(lock_key, 0, LOCK_TIMEOUT):
+        try:
+            cache.incr(lock_key)
+        except ValueError:
+            pass  # released in the meantime, the holder's set is done
+        cache.delete(key)
+        return
+    try:
+        history = cache.get(key)
+        if history is None:
+            return
+        history.append(_entry(False, user_message_text))
+        history.append(_entry(True, ai_message_text))
+        cache.set(key, history[-settings.CHAT_HISTORY_LENGTH:], settings.CHAT_CONTEXT_CACHE_TIMEOUT)
+        # a writer counted before this set may have deleted the entry before it, put back without its turn
+        if cache.get(lock_key):
+            cache.delete(key)
+    finally:
+        cache.delete(lock_key)
+
+
+def forget(chat_id):
+    _cache().delete(_key(chat_id))
@@ -0,0 +1,171 @@
+import csv
+import io
+import json
+import logging
+import time
+
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+from . import lookup
+from .models import Dictionary
+
+logger = logging.getLogger(__name__)
+
+# bulk import and export of the dictionary (word lists, language packs) as csv or jsonl.
+# files are read row by row and written CHUNK_SIZE rows at a time with one
+# INSERT ... ON CONFLICT (english_word) DO UPDATE per chunk, so a 50k word list is ten statements
+# instead of 50k admin saves, and it never sits in memory as a whole.
+# exports go the other way round, rows are streamed out of a server side cursor as they come.
+# the api streams them through aexport_lines, under asgi a sync iterator would be read into a list first.
+# used by the import_dictionary / export_dictionary commands and the dictionary/import|export/ api.
+
+FIELDS = ('english_word', 'english_phonetic', 'chinese_translation', 'familiarity_metric')
+# what an import changes on a word that's already in the dictionary
+UPDATE_FIELDS = ['english_phonetic', 'chinese_translation']
+FORMATS = ('csv', 'jsonl')
+CHUNK_SIZE = 5000
+
+FAMILIARITY_VALUES = {value for value, _ in Dictionary.FAMILIARITY_CHOICES}
+
+
+class InvalidRow(ValueError):
+    pass
+
+
+def guess_format(name, default='csv'):
+    for fmt in FORMATS:
+        if name.lower().endswith(f'.{fmt}'):
+            return fmt
+    return default
+
+
+def read_rows(lines, fmt):
+    """Turn an iterable of text lines into dicts, one per word."""
+    if fmt == 'csv':
+        yield from csv.DictReader(lines)
+    elif fmt == 'jsonl':
+        for number, line in enumerate(lines, 1):
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise InvalidRow(f'line {number}: {e}')
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+
+def to_entry(row):
+    if not isinstance(row, dict):
+        raise InvalidRow(f'Expected an object: {row}')
+    english_word = (row.get('english_word') or '').strip()
+    chinese_translation = (row.get('chinese_translation') or '').strip()
+    if not english_word or not chinese_translation:
+        raise InvalidRow(f'english_word and chinese_translation are required: {row}')
+    familiarity_metric = row.get('familiarity_metric') or 'mediocre'
+    if familiarity_metric not in FAMILIARITY_VALUES:
+        raise InvalidRow(f'Unknown familiarity_metric {familiarity_metric!r}: {row}')
+    return Dictionary(
+        english_word=english_word,
+        english_phonetic=(row.get('english_phonetic') or '').strip() or None,
+        chinese_translation=chinese_translation,
+        familiarity_metric=familiarity_metric,
+    )
+
+
+def write_chunk(entries):
+    # the same word twice in one statement is an error in postgres ("cannot affect row a second time"),
+    # the last one in the file wins like it would row by row
+    unique = list({entry.english_word: entry for entry in entries}.values())
+    Dictionary.objects.bulk_create(
+        unique,
+        update_conflicts=True,
+        unique_fields=['english_word'],
+        update_fields=UPDATE_FIELDS,
+    )
+    return len(unique)
+
+
+def import_rows(rows, chunk_size=CHUNK_SIZE, on_chunk=None, skip_invalid=False):
+    """
+    Upsert the rows (dicts) chunk_size at a time. on_chunk(number, rows, seconds) is called after each chunk.
+    Returns (rows written, rows skipped). The whole import is one transaction.
+    """
+    written, skipped, number = 0, 0, 0
+    chunk = []
+
+    def flush():
+        nonlocal written, number
+        started = time.perf_counter()
+        count = write_chunk(chunk)
+        elapsed = time.perf_counter() - started
+        number += 1
+        written += count
+        if on_chunk is not None:
+            on_chunk(number, count, elapsed)
+        chunk.clear()
+
+    with transaction.atomic():
+        for row in rows:
+            try:
+                chunk.append(to_entry(row))
+            except InvalidRow:
+                if not skip_invalid:
+                    raise
+                skipped += 1
+                continue
+            if len(chunk) >= chunk_size:
+                flush()
+        if chunk:
+            flush()
+
+    # bulk_create sends no post_save signals, so the lookup index has to be rebuilt
+    lookup.refresh()
+    return written, skipped
+
+
+def log_chunk(number, rows, seconds):
+    logger.info('Chunk %d: %d words in %.2fs (%.0f/s)', number, rows, seconds, rows / seconds if seconds else 0)
+
+
+def export_lines(fmt, chunk_size=CHUNK_SIZE):
+    """Yield the dictionary as lines of csv or jsonl, read through a server side cursor."""
+    rows = Dictionary.objects.order_by('entry_id').values_list(*FIELDS).iterator(chunk_size=chunk_size)
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            # hand out what's written so far every so often instead of one tiny string per row
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    elif fmt == 'jsonl':
+        lines = []
+        for row in rows:
+            lines.append(json.dumps(dict(zip(FIELDS, row)), ensure_ascii=False) + '\n')
+            if len(lines) >= 1000:
+                yield ''.join(lines)
+                lines.clear()
+        yield ''.join(lines)
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+
+async def aexport_lines(fmt, chunk_size=CHUNK_SIZE):
+    """export_lines as an async iterator, for StreamingHttpResponse under asgi."""
+    lines = export_lines(fmt, chunk_size)
+    # every block is read in django's one sync thread (thread_sensitive), so the cursor stays on its connection
+    next_block = sync_to_async(next)
+    try:
+        while True:
+            block = await next_block(lines, None)
+            if block is None:
+                return
+            yield block
+    finally:
+        # the client went away or we're done, let go of the cursor
+        await sync_to_async(lines.close)()
@@ -0,0 +1,252 @@
+import logging
+import re
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from lang_app import clients, metrics
+
+from .models import GrammarCheckJob, GrammarCorrection
+
+logger = logging.getLogger(__name__)
+
+# background grammar checking.
+# the chat request only adds a GrammarCheckJob next to each user message (see writes.py),
+# then the run_grammar_worker command claims pending jobs in batches with SELECT ... FOR UPDATE SKIP LOCKED
+# (so several workers never grab the same job) and marks them claimed for GRAMMAR_LEASE_SECONDS in a short
+# transaction, runs them through settings.GRAMMAR_CHECKER outside of any transaction, and bulk_creates the
+# GrammarCorrection rows in a second short one. jobs whose worker died go back in the queue once the lease
+# runs out. the chat response never waits on any of this.
+
+
+class GrammarChecker:
+    def check_batch(self, texts):
+        """
+        Return one list of corrections per text, in the same order.
+        A correction is a dict with the GrammarCorrection fields (except message and timestamp).
+        """
+        raise NotImplementedError
+
+
+class StubGrammarChecker(GrammarChecker):
+    # deterministic checker for local development and tests, it only knows that "i" should be "I"
+    LOWERCASE_I = re.compile(r'\bi\b')
+
+    def check_batch(self, texts):
+        return [
+            [
+                {
+                    'confidence': 100,
+                    'should_replace': True,
+                    'correction_type': 2,
+                    'top_category_id': 1,
+                    'top_category_description': 'Capitalization',
+                    'mistake_text': match.group(),
+                    'mistake_from': match.start(),
+                    'mistake_to': match.end() - 1,
+                    'mistake_definition': None,
+                    'lrn_frg': text,
+                    'suggestions': [{'Text': 'I', 'CategoryId': 1}],
+                    'sentences': [],
+                }
+                for match in self.LOWERCASE_I.finditer(text)
+            ]
+            for text in texts
+        ]
+
+
+class GingerGrammarChecker(GrammarChecker):
+    # Ginger Grammar API, one text per call, but the http session (connection) is reused for the batch
+    URL = 'https://services.gingersoftware.com/Ginger/correct/jsonSecured/GingerTheTextFull'
+
+    def __init__(self):
+        # imported here, writes.py imports this module on every chat turn but only the worker calls ginger
+        import requests
+
+        self.session = requests.Session()
+
+    def check_batch(self, texts):
+        return [self._check(text) for text in texts]
+
+    def _check(self, text):
+        response = self.session.get(
+            self.URL,
+            params={
+                'lang': 'US',
+                'clientVersion': '2.0',
+                'apiKey': settings.GINGER_API_KEY,
+                'text': text,
+            },
+            timeout=settings.GRAMMAR_CHECKER_TIMEOUT,
+        )
+        response.raise_for_status()
+        data = response.json()
+        sentences = data.get('Sentences', [])
+        corrections = []
+        for result in data.get('Corrections', []):
+            mistakes = result.get('Mistakes') or [{}]
+            corrections.append({
+                'confidence': result.get('Confidence', 0),
+                'should_replace': result.get('ShouldReplace', False),
+                'correction_type': result.get('Type', 0),
+                'top_category_id': result.get('TopCategoryId', 0),
+                'top_category_description': result.get('TopCategoryIdDescription', ''),
+                'mistake_text': result.get('MistakeText', ''),
+                'mistake_from': mistakes[0].get('From', result.get('From', 0)),
+                'mistake_to': mistakes[0].get('To', result.get('To', 0)),
+                'mistake_definition': mistakes[0].get('Definition'),
+                'lrn_frg': result.get('LrnFrg', ''),
+                'suggestions': result.get('Suggestions', []),
+                'sentences': sentences,
+            })
+        return corrections
+
+
+clients.register('grammar_checker', lambda: import_string(settings.GRAMMAR_CHECKER)())
+
+
+def get_checker():
+    return clients.get('grammar_checker')
+
+
+def enqueue(messages):
+    # called by writes.py inside the transaction that inserts the messages
+    GrammarCheckJob.objects.bulk_create([GrammarCheckJob(message=message) for message in messages])
+
+
+# worker side metrics, these live in the worker process and are logged per batch
+jobs_processed = metrics.counter(
+    'grammar_jobs_processed_total', 'Grammar check jobs processed by this worker', ['status'],
+)
+batch_seconds = metrics.histogram(
+    'grammar_batch_seconds', 'Time to claim, check and store one batch of grammar jobs',
+)
+
+
+def requeue_expired():
+    """Put the claimed jobs of workers that died (their lease ran out) back in the queue, or fail them."""
+    now = timezone.now()
+    expired = GrammarCheckJob.objects.filter(status='claimed', lease_until__lt=now)
+    expired.filter(attempts__gte=settings.GRAMMAR_MAX_ATTEMPTS).update(
+        status='failed', lease_until=None, finished_at=now,
+    )
+    return expired.update(status='pending', lease_until=None)
+
+
+def claim(batch_size):
+    """
+    Claim up to batch_size pending jobs for GRAMMAR_LEASE_SECONDS, in a transaction of its own.
+    Returns (jobs, lease_until), the jobs with their messages.
+    """
+    lease_until = timezone.now() + timedelta(seconds=settings.GRAMMAR_LEASE_SECONDS)
+    with transaction.atomic():
+        # skip_locked: jobs another worker is claiming right now are simply not seen.
+        # of=('self',) only locks the job rows, not the joined messages
+        jobs = list(
+            GrammarCheckJob.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(status='pending')
+            .select_related('message')
+            .order_by('job_id')[:batch_size]
+        )
+        if jobs:
+            # a claim counts as an attempt, so a job that keeps killing its worker runs out of them too
+            GrammarCheckJob.objects.filter(job_id__in=[job.job_id for job in jobs]).update(
+                status='claimed', lease_until=lease_until, attempts=F('attempts') + 1,
+            )
+    return jobs, lease_until
+
+
+def _still_claimed(job_ids, lease_until):
+    # the jobs of this claim that are still ours, locked until the caller's transaction ends.
+    # one whose lease ran out may have been claimed by another worker since, that one stores its result
+    return set(
+        GrammarCheckJob.objects.select_for_update()
+        .filter(job_id__in=job_ids, status='claimed', lease_until=lease_until)
+        .values_list('job_id', flat=True)
+    )
+
+
+def process_batch(batch_size):
+    """Claim up to batch_size pending jobs, check them and store the corrections. Returns the job count."""
+    checker = get_checker()
+    started = time.perf_counter()
+    requeue_expired()
+    jobs, lease_until = claim(batch_size)
+    if not jobs:
+        return 0
+    job_ids = [job.job_id for job in jobs]
+
+    # the claim is committed, no transaction (and no row lock) is held while the checker is called
+    try:
+        results = checker.check_batch([job.message.message_text for job in jobs])
+    except Exception:
+        logger.exception('Grammar check of %d jobs failed', len(jobs))
+        with transaction.atomic():
+            ours = _still_claimed(job_ids, lease_until)
+            # back into the queue, unless they already used up their attempts
+            GrammarCheckJob.objects.filter(job_id__in=ours, attempts__gte=settings.GRAMMAR_MAX_ATTEMPTS).update(
+                status='failed', lease_until=None, finished_at=timezone.now(),
+            )
+            GrammarCheckJob.objects.filter(job_id__in=ours, status='claimed').update(
+                status='pending', lease_until=None,
+            )
+        jobs_processed.inc(len(jobs), status='failed')
+        return len(jobs)
+
+    with transaction.atomic():
+        ours = _still_claimed(job_ids, lease_until)
+        GrammarCorrection.objects.bulk_create([
+            GrammarCorrection(message_id=job.message_id, **correction)
+            for job, corrections in zip(jobs, results) if job.job_id in ours
+            for correction in corrections
+        ])
+        GrammarCheckJob.objects.filter(job_id__in=ours).update(
+            status='done', lease_until=None, finished_at=timezone.now(),
+        )
+
+    elapsed = time.perf_counter() - started
+    batch_seconds.observe(elapsed)
+    jobs_processed.inc(len(ours), status='done')
+    if len(ours) < len(jobs):
+        logger.warning('%d grammar jobs were checked after their lease ran out', len(jobs) - len(ours))
+    return len(jobs)
+
+
+# web side metrics, read from the queue table whenever /metrics/ is scraped,
+# so they are right however many worker processes there are
+THROUGHPUT_WINDOW = timedelta(minutes=1)
+
+
+def queue_depth():
+    return GrammarCheckJob.objects.filter(status='pending').count()
+
+
+def throughput():
+    # jobs finished per second over the last minute, by all workers together
+    since = timezone.now() - THROUGHPUT_WINDOW
+    done = GrammarCheckJob.objects.filter(finished_at__gte=since, status='done').count()
+    return done / THROUGHPUT_WINDOW.total_seconds()
+
+
+def oldest_pending_age():
+    oldest = (
+        GrammarCheckJob.objects.filter(status='pending')
+        .order_by('job_id').values_list('created_at', flat=True).first()
+    )
+    if oldest is None:
+        return 0
+    return (timezone.now() - oldest).total_seconds()
+
+
+metrics.gauge('grammar_queue_depth', 'Grammar check jobs waiting in the queue', callback=queue_depth)
+metrics.gauge(
+    'grammar_jobs_per_second', 'Grammar check jobs finished per second over the last minute', callback=throughput,
+)
+metrics.gauge(
+    'grammar_oldest_pending_seconds', 'Age of the oldest waiting grammar check job', callback=oldest_pending_age,
+)
@@ -0,0 +1,158 @@
+import threading
+from collections import Counter
+
+from django.db.models import Case, DateTimeField, F, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import Chat, ChatMembership
+from .pagination import decode_cursor, encode_cursor
+
+# a user's chat list, newest activity first, with the unread count and the last message of every chat.
+# instead of a max(timestamp) and a count per chat, Chat.last_message(_at) and ChatMembership.unread_count /
+# last_message_at are kept up to date by record_turns, which writes.write_turns calls in the transaction of
+# the insert. a page of the inbox is then one query walking chat_membership_inbox_idx (user, last_message_at desc)
+# with the chat and its last message joined in by primary key.
+
+INBOX_FIELDS = (
+    'chat_id',
+    'chat__chat_name',
+    'unread_count',
+    'last_message_at',
+    'last_read_at',
+    'chat__last_message__message_id',
+    'chat__last_message__message_text',
+    'chat__last_message__sender__username',
+)
+
+DEFAULT_PAGE_SIZE = 30
+
+# (chat_id, user_id) memberships known to exist, so a turn in a known chat doesn't insert them again
+_members = set()
+_members_lock = threading.Lock()
+
+
+def ensure_memberships(memberships):
+    """
+    Insert the missing ones of these (chat_id, user_id) memberships.
+    Returns them, they're only remembered once the caller committed.
+    """
+    missing = [membership for membership in memberships if membership not in _members]
+    if missing:
+        ChatMembership.objects.bulk_create(
+            [ChatMembership(chat_id=chat_id, user_id=user_id) for chat_id, user_id in missing],
+            ignore_conflicts=True,
+        )
+    return missing
+
+
+def remember_memberships(memberships):
+    with _members_lock:
+        if len(_members) > 100000:
+            _members.clear()
+        _members.update(memberships)
+
+
+def forget_memberships():
+    with _members_lock:
+        _members.clear()
+
+
+def record_turns(messages, posted_by=()):
+    """
+    Bring the chats and memberships of these just inserted messages up to date, one UPDATE each.
+    Every member gets the messages they didn't send added to their unread count. posted_by has a
+    (chat_id, user_id) for each turn a logged in user posted (as the local 'user'), that message is theirs too.
+    """
+    newest, total, sent = {}, Counter(), Counter()
+    for message in messages:
+        chat_id = message.chat_id_id
+        total[chat_id] += 1
+        sent[chat_id, message.sender_id] += 1
+        current = newest.get(chat_id)
+        if current is None or (message.timestamp, message.message_id) > (current.timestamp, current.message_id):
+            newest[chat_id] = message
+    for chat_id, user_id in posted_by:
+        if user_id is not None:
+            sent[chat_id, user_id] += 1
+    if not newest:
+        return
+
+    # only moves forward, a slower transaction with older messages doesn't overwrite a newer last message.
+    # both SET expressions see the old last_message_at, so they agree
+    is_newer = {
+        chat_id: Q(chat_id=chat_id) & (Q(last_message_at__isnull=True) | Q(last_message_at__lte=message.timestamp))
+        for chat_id, message in newest.items()
+    }
+    Chat.objects.filter(chat_id__in=newest).update(
+        last_message_id=Case(
+            *[When(is_newer[chat_id], then=Value(message.message_id)) for chat_id, message in newest.items()],
+            default=F('last_message_id'), output_field=IntegerField(),
+        ),
+        last_message_at=Case(
+            *[When(is_newer[chat_id], then=Value(message.timestamp)) for chat_id, message in newest.items()],
+            default=F('last_message_at'), output_field=DateTimeField(),
+        ),
+    )
+
+    received = Case(
+        *[When(chat_id=chat_id, then=Value(count)) for chat_id, count in total.items()],
+        default=Value(0), output_field=IntegerField(),
+    )
+    own = Case(
+        *[When(chat_id=chat_id, user_id=user_id, then=Value(count)) for (chat_id, user_id), count in sent.items()],
+        default=Value(0), output_field=IntegerField(),
+    )
+    ChatMembership.objects.filter(chat_id__in=total).update(
+        unread_count=F('unread_count') + received - own,
+        last_message_at=Greatest(F('last_message_at'), Case(
+            *[When(chat_id=chat_id, then=Value(message.timestamp)) for chat_id, message in newest.items()],
+            output_field=DateTimeField(),
+        )),
+    )
+
+
+def mark_read(chat_id, user_id):
+    """Returns False if the user isn't in the chat."""
+    return bool(
+        ChatMembership.objects.filter(chat_id=chat_id, user_id=user_id)
+        .update(unread_count=0, last_read_at=timezone.now())
+    )
+
+
+def inbox_page(user_id, before=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return (chats, before_cursor) for one page of a user's chats, most recent activity first.
+    Raises pagination.InvalidCursor for a bad before.
+    """
+    memberships = ChatMembership.objects.filter(user_id=user_id)
+    if before:
+        last_message_at, chat_id = decode_cursor(before)
+        memberships = memberships.filter(
+            Q(last_message_at__lte=last_message_at),
+            Q(last_message_at__lt=last_message_at) | Q(chat_id__lt=chat_id),
+        )
+    rows = list(memberships.order_by('-last_message_at', '-chat_id').values(*INBOX_FIELDS)[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    chats = [
+        {
+            'chat_id': row['chat_id'],
+            'chat_name': row['chat__chat_name'],
+            'unread_count': row['unread_count'],
+            'last_message_at': row['last_message_at'],
+            'last_read_at': row['last_read_at'],
+            # None once the message is archived (archive.py clears it) or before the first one
+            'last_message': {
+                'message_id': row['chat__last_message__message_id'],
+                'message_text': row['chat__last_message__message_text'],
+                'sender__username': row['chat__last_message__sender__username'],
+            } if row['chat__last_message__message_id'] is not None else None,
+        }
+        for row in rows
+    ]
+    before_cursor = None
+    if has_more and rows:
+        before_cursor = encode_cursor(rows[-1]['last_message_at'], rows[-1]['chat_id'])
+    return chats, before_cursor
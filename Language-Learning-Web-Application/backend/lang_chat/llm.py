@@ -0,0 +1,110 @@
+from django.conf import settings
+from lang_app import clients
+from lang_app.instrumentation import external_call
+
+from . import throttle
+from .completion_cache import CompletionCache, completion_key
+
+# everything that talks to the cohere chat api lives here, so the views don't have to care about clients.
+# the old view called the blocking co.chat(...) which held a whole worker for the seconds a completion takes.
+# this uses cohere's AsyncClient instead, so under asgi one process can wait on lots of completions at once.
+
+# the sampling parameters i settled on, see the long comment in views.py for why
+CHAT_MODEL = 'command-light'
+CHAT_PARAMS = {
+    'prompt_truncation': 'AUTO',
+    'temperature': 0.2,
+    'k': 10,
+}
+
+_completion_cache = None
+
+
+def make_async_client():
+    # the sdk is imported here, loading it is a good part of a cold start and most processes
+    # (the grammar worker, management commands) never talk to cohere
+    import cohere
+
+    options = {'timeout': settings.COHERE_TIMEOUT}
+    if settings.COHERE_BASE_URL:
+        options['base_url'] = settings.COHERE_BASE_URL
+    return cohere.AsyncClient(settings.COHERE_API_KEY, **options)
+
+
+# the async client (its http connection pool) belongs to one event loop,
+# under wsgi each async view runs in its own loop, so it's one per loop (see lang_app/clients.py)
+clients.register('cohere', make_async_client, per_loop=True)
+
+
+def get_async_client():
+    return clients.get('cohere')
+
+
+def get_completion_cache():
+    # None when COHERE_COMPLETION_CACHE_SIZE is 0
+    global _completion_cache
+    if _completion_cache is None and settings.COHERE_COMPLETION_CACHE_SIZE:
+        _completion_cache = CompletionCache(
+            max_entries=settings.COHERE_COMPLETION_CACHE_SIZE,
+            ttl=settings.COHERE_COMPLETION_CACHE_TTL,
+        )
+    return _completion_cache
+
+
+async def _complete(message, chat_history, priority):
+    # caps how many completions this process has in flight at once and sheds what can't wait, see throttle.py
+    async with throttle.get_governor().slot(priority), external_call('llm'):
+        response = await get_async_client().chat(
+            model=CHAT_MODEL,
+            chat_history=chat_history,
+            message=message,
+            **CHAT_PARAMS,
+        )
+    return response.text
+
+
+async def chat(message, chat_history, priority=throttle.PRIORITY_HIGH):
+    # returns just the generated text, which is all the view stores.
+    # repeated requests are answered from the completion cache, see completion_cache.py.
+    # raises throttle.Overloaded when there's no upstream slot to be had
+    cache = get_completion_cache()
+    if cache is None:
+        return await _complete(message, chat_history, priority)
+    key = completion_key(CHAT_MODEL, chat_history, message, CHAT_PARAMS)
+    return await cache.get_or_call(key, lambda: _complete(message, chat_history, priority))
+
+
+async def _stream(message, chat_history, priority, finished):
+    # the upstream slot is held until the stream is finished.
+    # finished['reason'] is cohere's finish_reason once the stream ended, 'COMPLETE' unless it was cut
+    # short (MAX_TOKENS, ERROR...)
+    async with throttle.get_governor().slot(priority), external_call('llm'):
+        stream = get_async_client().chat_stream(
+            model=CHAT_MODEL,
+            chat_history=chat_history,
+            message=message,
+            **CHAT_PARAMS,
+        )
+        async for event in stream:
+            if event.event_type == 'text-generation':
+                yield event.text
+            elif event.event_type == 'stream-end':
+                finished['reason'] = event.finish_reason
+
+
+def chat_stream(message, chat_history, priority=throttle.PRIORITY_HIGH):
+    # same call as chat() but an async generator of the text as cohere generates it,
+    # so the first words reach the user after the first token instead of after the whole reply.
+    # a cached reply comes out as one piece, and so does the reply to a request that's identical to one
+    # being streamed right now (it waits for that one). only a stream that finished COMPLETE is cached,
+    # for chat() and later streams.
+    # not a generator wrapping these, closing it (the client went away) wouldn't close them until gc
+    finished = {}
+    cache = get_completion_cache()
+    if cache is None:
+        return _stream(message, chat_history, priority, finished)
+    key = completion_key(CHAT_MODEL, chat_history, message, CHAT_PARAMS)
+    return cache.get_or_stream(
+        key, lambda: _stream(message, chat_history, priority, finished),
+        cache_if=lambda text: finished.get('reason') == 'COMPLETE',
+    )
@@ -0,0 +1,291 @@
+import bisect
+import heapq
+import logging
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+from lang_app.db_router import read_replica
+
+from .models import Dictionary
+
+logger = logging.getLogger(__name__)
+
+# dictionary lookup for the typeahead.
+# the admin's search_fields (and any icontains) is an ILIKE '%...%', which reads the whole table every time.
+# instead every process keeps the dictionary in memory in two indexes:
+#   - a sorted list of (normalized word, entry_id) for prefix search, the words starting with "app" are a
+#     contiguous slice found with two binary searches (a flat trie, without the per node dicts)
+#   - a trigram index like postgres' pg_trgm, trigram -> entry ids, for typo tolerant (fuzzy) matches.
+#     similarity is shared trigrams / all trigrams of both words, the same measure pg_trgm uses
+# both english_word and chinese_translation are indexed.
+# the indexes are built on the first lookup and kept up to date by the post_save/post_delete signals
+# (connected in apps.py). writes from other processes show up after DICTIONARY_INDEX_MAX_AGE,
+# when the index is rebuilt in the background while the old one keeps answering.
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# pg_trgm's default similarity threshold
+FUZZY_THRESHOLD = 0.3
+# how many posting list entries a fuzzy lookup may collect candidates from, see DictionaryIndex.fuzzy
+FUZZY_CANDIDATE_BUDGET = 3000
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').casefold().strip()
+
+
+def trigrams(text):
+    # like pg_trgm: two spaces in front and one behind, so the start of a word weighs more than its middle
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DictionaryIndex:
+    def __init__(self, rows=()):
+        """rows: (entry_id, english_word, english_phonetic, chinese_translation) tuples"""
+        self._lock = threading.Lock()
+        self.entries = {}
+        self.keys = []  # sorted (normalized text, entry_id)
+        # the trigram index works on texts rather than entries, text id = entry_id * 2 + 0 for the
+        # english word, + 1 for the chinese translation, so a match is always scored against one text
+        self.postings = {}  # trigram -> set of text ids
+        self.trigram_counts = {}  # text id -> number of trigrams
+        for row in rows:
+            self._add(row, sort=False)
+        self.keys.sort()
+        self.built_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _texts(self, row):
+        # [(text id, normalized text)]
+        entry_id, english_word, _, chinese_translation = row
+        texts = (normalize(english_word), normalize(chinese_translation))
+        return [(entry_id * 2 + field, text) for field, text in enumerate(texts) if text]
+
+    def _add(self, row, sort=True):
+        entry_id = row[0]
+        self.entries[entry_id] = row
+        for text_id, text in self._texts(row):
+            if sort:
+                bisect.insort(self.keys, (text, entry_id))
+            else:
+                self.keys.append((text, entry_id))
+            grams = trigrams(text)
+            self.trigram_counts[text_id] = len(grams)
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(text_id)
+
+    def _remove(self, entry_id):
+        row = self.entries.pop(entry_id, None)
+        if row is None:
+            return
+        for text_id, text in self._texts(row):
+            index = bisect.bisect_left(self.keys, (text, entry_id))
+            if index < len(self.keys) and self.keys[index] == (text, entry_id):
+                del self.keys[index]
+            del self.trigram_counts[text_id]
+            for gram in trigrams(text):
+                ids = self.postings.get(gram)
+                if ids is not None:
+                    ids.discard(text_id)
+                    if not ids:
+                        del self.postings[gram]
+
+    def put(self, row):
+        # an update is a remove and an add, the word may have changed
+        with self._lock:
+            self._remove(row[0])
+            self._add(row)
+
+    def delete(self, entry_id):
+        with self._lock:
+            self._remove(entry_id)
+
+    def prefix(self, query, limit=DEFAULT_LIMIT):
+        """Entry ids whose english word or chinese translation starts with query, shortest/alphabetical first."""
+        query = normalize(query)
+        if not query:
+            return []
+        found = []
+        with self._lock:
+            index = bisect.bisect_left(self.keys, (query,))
+            while index < len(self.keys) and len(found) < limit:
+                text, entry_id = self.keys[index]
+                if not text.startswith(query):
+                    break
+                if entry_id not in found:
+                    found.append(entry_id)
+                index += 1
+        return found
+
+    def fuzzy(self, query, limit=DEFAULT_LIMIT, threshold=FUZZY_THRESHOLD):
+        """[(entry_id, similarity)] of the best trigram matches, best first."""
+        query = normalize(query)
+        if not query:
+            return []
+        grams = trigrams(query)
+        with self._lock:
+            postings = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            # a match above the threshold shares at least needed of the query's trigrams, so it has to be
+            # in one of the len - needed + 1 rarest posting lists. the common ones ('  s'...) are only
+            # intersected with those candidates to finish the counts, never scanned whole.
+            # a short query made of common trigrams would still pull in most of the dictionary, so candidates
+            # only come from as many rare lists as fit in FUZZY_CANDIDATE_BUDGET. that leaves out some of the
+            # weakest matches of such queries, never the close ones.
+            # Counter.update and set & set run in C, the python loop below only sees the candidates
+            needed = max(1, int(threshold * len(grams)))
+            sources, total = 0, 0
+            for ids in postings[:len(postings) - needed + 1]:
+                if sources and total + len(ids) > FUZZY_CANDIDATE_BUDGET:
+                    break
+                sources += 1
+                total += len(ids)
+            shared = Counter()
+            for ids in postings[:sources]:
+                shared.update(ids)
+            candidates = set(shared)
+            for ids in postings[sources:]:
+                shared.update(candidates.intersection(ids))
+
+            scores = {}
+            for text_id, count in shared.items():
+                if count < needed:
+                    continue
+                score = count / (len(grams) + self.trigram_counts[text_id] - count)
+                # an entry whose word and translation both match keeps the better score
+                if score >= threshold and score > scores.get(text_id // 2, 0):
+                    scores[text_id // 2] = score
+        best = heapq.nsmallest(limit, ((-score, entry_id) for entry_id, score in scores.items()))
+        return [(entry_id, -score) for score, entry_id in best]
+
+    def row(self, entry_id):
+        return self.entries.get(entry_id)
+
+
+def load_rows():
+    queryset = Dictionary.objects.order_by().values_list(
+        'entry_id', 'english_word', 'english_phonetic', 'chinese_translation',
+    )
+    # the index is a few minutes behind anyway, a replica can serve the full table read.
+    # the alias is picked here because the rows are only read later, outside the with
+    with read_replica():
+        alias = queryset.db
+    return queryset.using(alias).iterator(chunk_size=5000)
+
+
+_index = None
+_index_lock = threading.Lock()
+# ('put', row) / ('delete', entry_id) changes made while a rebuild runs (the new index may have read the
+# table before them), replayed on it. None when no rebuild is running
+_changed_while_rebuilding = None
+
+
+def get_index():
+    global _index
+    index = _index
+    if index is None:
+        with _index_lock:
+            if _index is None:
+                started = time.perf_counter()
+                _index = DictionaryIndex(load_rows())
+                logger.info('Built the dictionary index (%d entries) in %.2fs', len(_index), time.perf_counter() - started)
+            index = _index
+    elif time.monotonic() - index.built_at > settings.DICTIONARY_INDEX_MAX_AGE:
+        _rebuild_in_background(index)
+    return index
+
+
+def _rebuild_in_background(old):
+    global _changed_while_rebuilding
+    with _index_lock:
+        if _changed_while_rebuilding is not None:
+            return
+        _changed_while_rebuilding = []
+    threading.Thread(target=_rebuild, args=(old,), name='dictionary-index-rebuild', daemon=True).start()
+
+
+def _rebuild(old):
+    global _index, _changed_while_rebuilding
+    try:
+        index = DictionaryIndex(load_rows())
+    except Exception:
+        logger.exception('Could not rebuild the dictionary index, keeping the old one')
+        index = None
+        # try again in DICTIONARY_INDEX_MAX_AGE, not on the next lookup
+        old.built_at = time.monotonic()
+    finally:
+        # the thread's own connections, they would stay open otherwise
+        connections.close_all()
+    with _index_lock:
+        if index is not None:
+            for change, value in _changed_while_rebuilding:
+                if change == 'put':
+                    index.put(value)
+                else:
+                    index.delete(value)
+            _index = index
+        _changed_while_rebuilding = None
+
+
+def refresh():
+    # after writes that don't send signals (bulk_create, queryset.update...), the next lookup reloads everything
+    global _index
+    with _index_lock:
+        _index = None
+
+
+def _changed(change, value):
+    with _index_lock:
+        if _changed_while_rebuilding is not None:
+            _changed_while_rebuilding.append((change, value))
+    # only touches an index that's already built, an unbuilt one will load the row anyway
+    index = _index
+    if index is not None:
+        getattr(index, change)(value)
+
+
+def entry_saved(sender, instance, **kwargs):
+    _changed('put', (instance.entry_id, instance.english_word, instance.english_phonetic, instance.chinese_translation))
+
+
+def entry_deleted(sender, instance, **kwargs):
+    _changed('delete', instance.entry_id)
+
+
+def lookup(query, limit=DEFAULT_LIMIT, mode='auto'):
+    """
+    Dictionary entries matching query, as dicts.
+    mode is 'prefix', 'fuzzy', or 'auto' (prefix matches first, topped up with fuzzy ones).
+    """
+    index = get_index()
+    matches = []
+    if mode in ('prefix', 'auto'):
+        matches = [(entry_id, 'prefix', 1.0) for entry_id in index.prefix(query, limit)]
+    if mode in ('fuzzy', 'auto') and len(matches) < limit:
+        seen = {entry_id for entry_id, _, _ in matches}
+        matches += [
+            (entry_id, 'fuzzy', score)
+            for entry_id, score in index.fuzzy(query, limit + len(seen))
+            if entry_id not in seen
+        ][:limit - len(matches)]
+
+    results = []
+    for entry_id, match, score in matches:
+        row = index.row(entry_id)
+        if row is None:  # deleted in between
+            continue
+        results.append({
+            'entry_id': row[0],
+            'english_word': row[1],
+            'english_phonetic': row[2],
+            'chinese_translation': row[3],
+            'match': match,
+            'score': round(score, 3),
+        })
+    return results
@@ -0,0 +1,41 @@
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from lang_chat import archive, partitions
+from lang_chat.models import Message
+
+
+class Command(BaseCommand):
+    help = 'Move months of messages older than MESSAGE_HOT_MONTHS out of the database into archive files.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-months', type=int, default=settings.MESSAGE_HOT_MONTHS)
+        parser.add_argument('--dry-run', action='store_true', help='only list the months that would be archived')
+
+    def cold_months(self, cutoff):
+        start, _ = partitions.month_bounds(cutoff)
+        months = {
+            partitions.month_start(month) for month in Message.objects.filter(timestamp__lt=start)
+            .annotate(month=TruncMonth('timestamp', tzinfo=dt_timezone.utc)).values_list('month', flat=True).distinct()
+        }
+        if partitions.is_partitioned():
+            # empty partitions have no rows to find above but should go as well
+            months.update(month for month in partitions.list_partitions() if month < cutoff)
+        return sorted(months)
+
+    def handle(self, *args, **options):
+        cutoff = partitions.add_months(partitions.month_start(timezone.now()), -options['older_than_months'])
+        months = self.cold_months(cutoff)
+        if not months:
+            self.stdout.write(f'Nothing older than {cutoff:%Y-%m}.')
+            return
+        for month in months:
+            if options['dry_run']:
+                self.stdout.write(f'{month:%Y-%m}: would be archived')
+                continue
+            count = archive.archive_month(month, log=self.stdout.write)
+            self.stdout.write(f'{month:%Y-%m}: archived {count} messages')
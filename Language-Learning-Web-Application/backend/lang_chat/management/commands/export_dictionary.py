@@ -0,0 +1,24 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from lang_chat.dictionary_io import FORMATS, export_lines, guess_format
+
+
+class Command(BaseCommand):
+    help = 'Write the whole dictionary to a csv or jsonl file, streamed row by row.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='output file, - (the default) for stdout')
+        parser.add_argument('--format', choices=FORMATS, help='default: from the file extension, csv for stdout')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+        f = sys.stdout if path == '-' else open(path, 'w', encoding='utf-8', newline='')
+        try:
+            for text in export_lines(fmt):
+                f.write(text)
+        finally:
+            if f is not sys.stdout:
+                f.close()
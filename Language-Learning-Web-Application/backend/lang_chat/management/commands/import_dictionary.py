@@ -0,0 +1,41 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from lang_chat.dictionary_io import CHUNK_SIZE, FORMATS, InvalidRow, guess_format, import_rows, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Add or update dictionary words from a csv or jsonl file, in chunks. Words already there are updated.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="csv or jsonl file, - for stdin")
+        parser.add_argument('--format', choices=FORMATS, help='default: from the file extension, csv for stdin')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='words per insert statement')
+        parser.add_argument('--skip-invalid', action='store_true',
+                            help='skip rows without a word or translation instead of stopping')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or guess_format(path)
+
+        def on_chunk(number, rows, seconds):
+            self.stdout.write(f'chunk {number}: {rows} words in {seconds:.2f}s ({rows / seconds if seconds else 0:.0f}/s)')
+
+        started = time.perf_counter()
+        f = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        try:
+            written, skipped = import_rows(
+                read_rows(f, fmt), options['chunk_size'], on_chunk=on_chunk, skip_invalid=options['skip_invalid'],
+            )
+        except InvalidRow as e:
+            raise CommandError(f'Nothing was imported, {e}')
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f'Imported {written} words in {elapsed:.2f}s ({written / elapsed if elapsed else 0:.0f}/s), skipped {skipped}.'
+        )
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from lang_chat import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        'Partition the messages table by month (postgres only). The first run converts the table, '
+        'every run creates the partitions of the coming months, run it monthly.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3, help='months to create partitions for in advance')
+
+    def handle(self, *args, **options):
+        if not partitions.is_supported():
+            raise CommandError('Partitioning needs postgres.')
+        with transaction.atomic():
+            if not partitions.is_partitioned():
+                self.stdout.write(f'Converting "{partitions.TABLE}" to a partitioned table, it is locked until done')
+                partitions.convert(options['months_ahead'], log=self.stdout.write)
+            created = partitions.ensure_partitions(options['months_ahead'])
+        if created:
+            self.stdout.write('Created partitions for ' + ', '.join(f'{month:%Y-%m}' for month in created))
+        self.stdout.write(f'{len(partitions.list_partitions())} monthly partitions.')
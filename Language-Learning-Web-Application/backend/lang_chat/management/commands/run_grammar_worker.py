@@ -0,0 +1,46 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from lang_chat.grammar import process_batch
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Work through the grammar check queue in the background. Run as many of these as needed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.GRAMMAR_BATCH_SIZE,
+                            help='jobs claimed and sent to the grammar checker at once')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='seconds to sleep when the queue is empty')
+        parser.add_argument('--once', action='store_true',
+                            help='stop as soon as the queue is empty instead of polling')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        total = 0
+        started = time.perf_counter()
+        while True:
+            # the worker runs for days, so drop the connection when it went stale like a request would
+            close_old_connections()
+            batch_started = time.perf_counter()
+            count = process_batch(batch_size)
+            if count:
+                total += count
+                elapsed = time.perf_counter() - batch_started
+                logger.info(
+                    'Checked %d messages in %.2fs (%.1f/s), %d since start (%.1f/s)',
+                    count, elapsed, count / elapsed if elapsed else 0,
+                    total, total / (time.perf_counter() - started),
+                )
+                continue
+            if options['once']:
+                break
+            time.sleep(options['poll_interval'])
+
+        self.stdout.write(f'Checked {total} messages.')
@@ -0,0 +1,67 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from lang_chat.scoring import available_cores, get_pool, process_batch, shutdown_pool, stage_seconds
+
+logger = logging.getLogger(__name__)
+
+
+def _stage_totals():
+    return {
+        stage: stage_seconds.snapshot(stage=stage)[1:]
+        for stage in ('decode', 'score', 'persist')
+    }
+
+
+class Command(BaseCommand):
+    help = 'Score uploaded pronunciation recordings in a pool of processes, one per core by default.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.PRONUNCIATION_BATCH_SIZE,
+                            help='submissions claimed and spread over the pool at once')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='scoring processes (default: PRONUNCIATION_SCORER_WORKERS, or one per available core)')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='seconds to sleep when nothing is waiting')
+        parser.add_argument('--once', action='store_true',
+                            help='stop as soon as nothing is waiting instead of polling')
+
+    def handle(self, *args, **options):
+        workers = options['workers'] or settings.PRONUNCIATION_SCORER_WORKERS or available_cores()
+        # started here with the number of processes asked for, process_batch uses (and if it breaks, restarts) it
+        get_pool(workers)
+        # a batch smaller than the pool would leave processes idle
+        batch_size = max(options['batch_size'], workers)
+        total = 0
+        started = time.perf_counter()
+        try:
+            while True:
+                close_old_connections()
+                before = _stage_totals()
+                batch_started = time.perf_counter()
+                count = process_batch(batch_size)
+                if count:
+                    total += count
+                    elapsed = time.perf_counter() - batch_started
+                    # decode and score are summed over the processes, so they can add up to more than elapsed
+                    stages = ', '.join(
+                        f'{stage} {seconds - before[stage][0]:.2f}s'
+                        for stage, (seconds, _) in _stage_totals().items()
+                    )
+                    logger.info(
+                        'Scored %d recordings in %.2fs (%.1f/s, %s), %d since start (%.1f/s)',
+                        count, elapsed, count / elapsed if elapsed else 0, stages,
+                        total, total / (time.perf_counter() - started),
+                    )
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+        finally:
+            shutdown_pool()
+
+        self.stdout.write(f'Scored {total} recordings with {workers} processes.')
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# boots the app in a fresh interpreter with python -X importtime, the way a worker does
+# (django.setup, the middleware, the urlconf), and breaks the time down per top level package
+# (each app, django, the sdks...) and per module. this process has already paid for its imports,
+# so the measuring has to happen in another one.
+
+BOOT = '''
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup_done = time.perf_counter()
+from django.core.handlers.wsgi import WSGIHandler
+WSGIHandler()
+middleware_done = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+urls_done = time.perf_counter()
+sys.stdout.write(json.dumps({
+    'django.setup (settings, apps, models)': setup_done - started,
+    'middleware': middleware_done - setup_done,
+    'urlconf (views)': urls_done - middleware_done,
+}))
+'''
+
+
+def parse_importtime(output):
+    """[(module, self seconds, cumulative seconds, depth)] from python -X importtime's stderr."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6, depth))
+    return modules
+
+
+class Command(BaseCommand):
+    help = 'Show where the time of a cold start goes: the boot phases, and imports per package and module.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='how many packages and modules to list')
+        parser.add_argument('--json', action='store_true', help='print the numbers as json')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        env['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', BOOT], env=env, capture_output=True, text=True,
+        )
+        if result.returncode:
+            raise CommandError(f'The app did not boot:\n{result.stderr[-4000:]}')
+
+        phases = json.loads(result.stdout.strip().splitlines()[-1])
+        modules = parse_importtime(result.stderr)
+        packages = defaultdict(float)
+        for name, self_seconds, _, _ in modules:
+            packages[name.partition('.')[0]] += self_seconds
+        top_packages = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:options['top']]
+        # the slowest modules counting what they import, without a package's submodules repeating it
+        top_modules = sorted(modules, key=lambda module: module[2], reverse=True)
+        top_modules = [module for module in top_modules if module[3] <= 1][:options['top']]
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'phases': phases,
+                'import_seconds': sum(self_seconds for _, self_seconds, _, _ in modules),
+                'packages': dict(top_packages),
+                'modules': {name: cumulative for name, _, cumulative, _ in top_modules},
+            }, indent=2))
+            return
+
+        self.stdout.write(f'Boot with {settings.SETTINGS_MODULE}, {sum(phases.values()):.3f}s:')
+        for phase, seconds in phases.items():
+            self.stdout.write(f'  {seconds:8.3f}s  {phase}')
+        total = sum(self_seconds for _, self_seconds, _, _ in modules)
+        self.stdout.write(f'\nImports, {len(modules)} modules in {total:.3f}s, per package:')
+        for package, seconds in top_packages:
+            self.stdout.write(f'  {seconds:8.3f}s  {seconds / total:6.1%}  {package}')
+        self.stdout.write('\nSlowest modules (with what they import):')
+        for name, _, cumulative, _ in top_modules:
+            self.stdout.write(f'  {cumulative:8.3f}s  {name}')
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -13,9 +15,15 @@ from django.db.models import JSONField
 class Chat(models.Model):
     chat_id = models.AutoField(primary_key=True)
     chat_name = models.CharField(max_length=30)
-    participants = models.ManyToManyField(User, related_name='chats')
+    participants = models.ManyToManyField(User, related_name='chats', through='ChatMembership')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # the newest message, kept up to date by writes.write_turns in the same transaction as the insert,
+    # so the inbox doesn't need a max(timestamp) per chat. db_constraint=False like every foreign key to Message
+    last_message = models.ForeignKey(
+        'Message', related_name='+', on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False,
+    )
+    last_message_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         participant_usernames = ', '.join([user.username for user in self.participants.all()])
@@ -23,6 +31,30 @@ class Chat(models.Model):
 
     class Meta:
         db_table = 'Chats'
+
+# Chat Memberships
+# the participants table of Chat with a few columns of its own (it's the same "Chats_participants" table the
+# plain many to many used). unread_count and last_message_at are copies kept up to date by writes.write_turns,
+# so a user's inbox is one range scan of chat_membership_inbox_idx, however many chats they have
+class ChatMembership(models.Model):
+    chat = models.ForeignKey(Chat, related_name='memberships', on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='chat_memberships', on_delete=models.CASCADE)
+    unread_count = models.IntegerField(default=0)
+    # of the chat, the time of joining until the first message
+    last_message_at = models.DateTimeField(default=timezone.now)
+    last_read_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.user_id} in Chat {self.chat_id} ({self.unread_count} unread)'
+
+    class Meta:
+        db_table = 'Chats_participants'
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'user'], name='chat_membership_chat_user_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_message_at', '-chat'], name='chat_membership_inbox_idx'),
+        ]
         
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -52,6 +84,43 @@ class Message(models.Model):
 
     class Meta:
         db_table = 'Original Messages'
+        # on postgres this table can be partitioned by month on timestamp (python manage.py partition_messages).
+        # a partitioned table's primary key has to include the partition column, so there it is really
+        # (message_id, timestamp). message_id stays unique because it comes from one sequence, but the database
+        # can't point foreign keys at it anymore, that's why the foreign keys to Message below are db_constraint=False
+        #
+        # the chat history endpoint pages through one chat at a time by (timestamp, message_id),
+        # so this index lets it jump straight to the newest messages of a chat instead of scanning the table
+        indexes = [
+            models.Index(fields=['chat_id', 'timestamp', 'message_id'], name='message_chat_history_idx'),
+        ]
+
+# Archived Messages
+# old months of messages are moved out of the database into one jsonl.gz file per chat and month
+# (python manage.py archive_messages, see archive.py). this row is what's left behind, the chat history
+# reads the file when a user scrolls back that far
+class ArchivedPartition(models.Model):
+    archive_id = models.AutoField(primary_key=True)
+    chat = models.ForeignKey(Chat, related_name='archives', on_delete=models.CASCADE)
+    month = models.DateField()  # first day of the month
+    path = models.CharField(max_length=500)  # relative to MESSAGE_ARCHIVE_ROOT
+    message_count = models.IntegerField()
+    first_timestamp = models.DateTimeField()
+    last_timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'Chat {self.chat_id} {self.month:%Y-%m} ({self.message_count} messages)'
+
+    class Meta:
+        db_table = 'Archived Message Months'
+        constraints = [
+            models.UniqueConstraint(fields=['chat', 'month'], name='archived_partition_chat_month_unique'),
+        ]
+        indexes = [
+            # the newest archived month (archive.archive_horizon) and the months archive_month writes
+            models.Index(fields=['month'], name='archived_partition_month_idx'),
+        ]
 
 # all the below models are for functionalities and apis. 
 # i look at what is availale in the responses of the apis and take into consideration what i need, 
@@ -64,11 +133,15 @@ class Message(models.Model):
 # Translations
 class Translation(models.Model):
     translation_id = models.AutoField(primary_key=True)
-    message = models.ForeignKey('Message', on_delete=models.CASCADE)  # Assuming 'Message' is already defined
+    # db_constraint=False: Message can be partitioned, see Message.Meta
+    message = models.ForeignKey('Message', on_delete=models.CASCADE, db_constraint=False)  # Assuming 'Message' is already defined
     original_language = models.CharField(max_length=10)
     translated_language = models.CharField(max_length=10)
     translated_text = models.TextField()
     timestamp = models.DateTimeField(default=timezone.now)
+    # sha256 of (source text, original_language, translated_language), see translation.py.
+    # the same sentence is only ever translated once, every later message with that text reuses this row
+    source_hash = models.CharField(max_length=64, unique=True, null=True, blank=True)
 
     def __str__(self):
         return f"Translation from {self.original_language} to {self.translated_language}"
@@ -79,7 +152,7 @@ class Translation(models.Model):
 # Grammar Correction
 class GrammarCorrection(models.Model):
     correction_id = models.AutoField(primary_key=True)
-    message = models.ForeignKey(Message, related_name='corrections', on_delete=models.CASCADE)
+    message = models.ForeignKey(Message, related_name='corrections', on_delete=models.CASCADE, db_constraint=False)
     confidence = models.IntegerField()
     should_replace = models.BooleanField()
     correction_type = models.IntegerField()
@@ -100,6 +173,96 @@ class GrammarCorrection(models.Model):
     class Meta:
         db_table = 'User Message Corrections'
 
+# Grammar Correction Queue
+# grammar checking is too slow to do inside the chat request, so every user message gets a job here
+# (in the same transaction as the message) and the run_grammar_worker command works through them
+# in the background, see grammar.py
+class GrammarCheckJob(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('claimed', 'Claimed'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    job_id = models.AutoField(primary_key=True)
+    message = models.ForeignKey(Message, related_name='grammar_jobs', on_delete=models.CASCADE, db_constraint=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # a claimed job belongs to the worker that claimed it until then, after that it goes back in the queue
+    lease_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Grammar check {self.job_id} for message {self.message_id} ({self.status})'
+
+    class Meta:
+        db_table = 'Grammar Correction Queue'
+        indexes = [
+            # only the pending jobs are indexed, so claiming work stays cheap however many jobs are done
+            models.Index(fields=['job_id'], name='grammar_job_pending_idx', condition=models.Q(status='pending')),
+            # the few claimed jobs, to find the expired leases of workers that died
+            models.Index(fields=['lease_until'], name='grammar_job_lease_idx', condition=models.Q(status='claimed')),
+            # for the throughput metric (jobs finished in the last minute)
+            models.Index(fields=['finished_at'], name='grammar_job_finished_idx'),
+        ]
+
+# Audio Submissions
+# recordings for pronunciation practice. they are uploaded in chunks (and can be resumed),
+# the bytes live in the audio storage (see audio.py), this row only keeps track of them.
+# identical recordings are stored once, content_hash points every copy at the same file.
+# complete uploads wait with scoring_status 'pending' until the score_pronunciation worker (scoring.py) gets to them
+class AudioSubmission(models.Model):
+    STATUS_CHOICES = [
+        ('uploading', 'Uploading'),
+        ('complete', 'Complete'),
+    ]
+    SCORING_STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('claimed', 'Claimed'),
+        ('scored', 'Scored'),
+        ('failed', 'Failed'),
+    ]
+
+    audio_id = models.AutoField(primary_key=True)
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, related_name='audio_submissions', on_delete=models.SET_NULL, null=True, blank=True)
+    message = models.ForeignKey(
+        Message, related_name='audio_submissions', on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False,
+    )
+    audio_url = models.CharField(max_length=500, blank=True)
+    storage_path = models.CharField(max_length=500, blank=True)
+    content_type = models.CharField(max_length=100, default='audio/wav')
+    size = models.BigIntegerField()  # total bytes announced when the upload started
+    bytes_received = models.BigIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # sha256, the dedup index
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='uploading')
+    scoring_status = models.CharField(max_length=10, choices=SCORING_STATUS_CHOICES, default='pending')
+    scoring_attempts = models.IntegerField(default=0)
+    # a claimed submission belongs to the scoring worker that claimed it until then, like GrammarCheckJob.lease_until
+    scoring_lease_until = models.DateTimeField(null=True, blank=True)
+    submission_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'Audio {self.audio_id} from {self.user}'
+
+    class Meta:
+        db_table = 'User Audio Submissions'
+        indexes = [
+            # the scoring worker only looks for finished uploads that haven't been scored,
+            # this partial index stays as small as that backlog
+            models.Index(
+                fields=['audio_id'], name='audio_scoring_pending_idx',
+                condition=models.Q(status='complete', scoring_status='pending'),
+            ),
+            # the few claimed ones, to find the expired leases of workers that died
+            models.Index(
+                fields=['scoring_lease_until'], name='audio_scoring_lease_idx',
+                condition=models.Q(scoring_status='claimed'),
+            ),
+        ]
+
 # Pronounciation Feedback
 class PronunciationFeedback(models.Model):
     feedback_id = models.AutoField(primary_key=True)
@@ -146,3 +309,33 @@ class Dictionary(models.Model):
     class Meta:
         unique_together = (('english_word', 'chinese_translation'),)
         db_table = 'User Dictionary'
+
+
+# Review State (spaced repetition, see srs.py)
+# the dictionary entries are shared, this is where each user's progress on an entry lives.
+# one row per (user, entry) the user is learning, with the SM-2 scheduling state.
+# the due cards of a user are read straight off the partial (user, due_at) index,
+# so a review session never looks at the rest of the dictionary
+class ReviewState(models.Model):
+    review_id = models.AutoField(primary_key=True)
+    user = models.ForeignKey(User, related_name='review_states', on_delete=models.CASCADE)
+    entry = models.ForeignKey(Dictionary, related_name='review_states', on_delete=models.CASCADE)
+    due_at = models.DateTimeField(default=timezone.now)
+    interval_days = models.PositiveIntegerField(default=0)
+    ease_factor = models.FloatField(default=2.5)
+    repetitions = models.PositiveSmallIntegerField(default=0)  # correct answers in a row
+    lapses = models.PositiveSmallIntegerField(default=0)
+    last_reviewed_at = models.DateTimeField(null=True, blank=True)
+    suspended = models.BooleanField(default=False)  # taken out of the reviews without losing the progress
+
+    def __str__(self):
+        return f'{self.entry} for {self.user}, due {self.due_at}'
+
+    class Meta:
+        db_table = 'Dictionary Review State'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'entry'], name='review_state_user_entry_unique'),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'due_at'], name='review_due_idx', condition=models.Q(suspended=False)),
+        ]
@@ -0,0 +1,98 @@
+import base64
+import binascii
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from .archive import archived_history, may_have_archive
+from .models import Message
+
+# keyset (cursor) pagination for the chat history.
+# the old GET dumped the whole messages table on every page load, which gets slower with every message ever sent.
+# instead, a page is "the newest `limit` messages of one chat that are older than the cursor".
+# the cursor is just the (timestamp, message_id) of the oldest message on the current page,
+# so the database walks the (chat_id, timestamp, message_id) index from that point and stops after limit + 1 rows,
+# no matter how big the table is. OFFSET pagination would still have to skip over all the newer rows.
+# months that were archived out of the database (archive.py) are read from their files the same way.
+
+# these are the exact keys the frontend reads in chat.js, don't rename them
+HISTORY_FIELDS = ('message_id', 'sender__username', 'recipient__username', 'message_text', 'timestamp')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, message_id):
+    # opaque to the frontend, it should only ever pass it back as ?before=...
+    raw = f'{timestamp.isoformat()}|{message_id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp_text, message_id = base64.urlsafe_b64decode(padded).decode().rsplit('|', 1)
+        timestamp = parse_datetime(timestamp_text)
+        message_id = int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f'Invalid cursor: {cursor}') from e
+    if timestamp is None:
+        raise InvalidCursor(f'Invalid cursor: {cursor}')
+    return timestamp, message_id
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    if value in (None, ''):
+        return default
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid limit: {value}')
+    if limit < 1:
+        raise ValueError(f'Invalid limit: {value}')
+    return min(limit, MAX_PAGE_SIZE)
+
+
+def history_page(chat, before=None, limit=DEFAULT_PAGE_SIZE, fields=HISTORY_FIELDS):
+    """
+    Return (messages, before_cursor) for one page of a Chat's history.
+
+    messages are in chronological order (oldest first) like the frontend expects,
+    before_cursor is None when there is nothing older left to load.
+    """
+    chat_id = chat.chat_id
+    queryset = Message.objects.filter(chat_id=chat_id)
+
+    cursor = None
+    if before:
+        cursor = timestamp, message_id = decode_cursor(before)
+        # the timestamp__lte part gives postgres a plain range bound on the index,
+        # the OR only breaks ties between messages that share the same timestamp
+        queryset = queryset.filter(
+            Q(timestamp__lte=timestamp),
+            Q(timestamp__lt=timestamp) | Q(message_id__lt=message_id),
+        )
+
+    # newest first so the index is scanned backwards from the cursor, then flipped below.
+    # fetching one extra row tells whether there is another page without a COUNT(*)
+    rows = list(
+        queryset.order_by('-timestamp', '-message_id').values(*fields)[:limit + 1]
+    )
+    if len(rows) <= limit and may_have_archive(chat):
+        # the database has nothing older, the rest of the page may be in the archive (archive.py)
+        if rows:
+            cursor = rows[-1]['timestamp'], rows[-1]['message_id']
+        rows += archived_history(chat_id, cursor, limit + 1 - len(rows), fields)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+
+    before_cursor = None
+    if has_more and rows:
+        before_cursor = encode_cursor(rows[0]['timestamp'], rows[0]['message_id'])
+
+    return rows, before_cursor
@@ -0,0 +1,204 @@
+import logging
+import re
+from datetime import date, datetime, timezone as dt_timezone
+
+from django.db import connections
+from django.utils import timezone
+
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# monthly range partitioning of "Original Messages" on timestamp (postgres only).
+# every month of messages is its own table, "Original Messages_p2024_05" and so on, plus a default partition
+# that catches anything outside the months that exist. postgres only touches the partitions a query's
+# timestamp range can hit, the history page of an active chat reads the last month or two and nothing else,
+# and vacuum works on the small recent partitions instead of the whole history.
+# old months are moved out with archive_messages (archive.py), which just detaches and drops a partition.
+#
+# python manage.py partition_messages converts the table once and then creates the coming months,
+# it should run every month (cron) so rows never land in the default partition. migrate also creates them.
+
+TABLE = Message._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME = re.compile(r'_p(\d{4})_(\d{2})$')
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def month_start(value):
+    """The first day of the month value (a date or datetime) is in."""
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def month_bounds(month):
+    # partitions are cut at midnight utc, like the timestamps are stored
+    start = datetime(month.year, month.month, 1, tzinfo=dt_timezone.utc)
+    end_month = add_months(month, 1)
+    return start, datetime(end_month.year, end_month.month, 1, tzinfo=dt_timezone.utc)
+
+
+def partition_name(month):
+    return f'{TABLE}_p{month:%Y_%m}'
+
+
+def is_supported(using='default'):
+    return connections[using].vendor == 'postgresql'
+
+
+def is_partitioned(using='default'):
+    if not is_supported(using):
+        return False
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)', [quote(TABLE)])
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def list_partitions(using='default'):
+    """{month: partition name} of the monthly partitions (not the default one)."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(%s)',
+            [quote(TABLE)],
+        )
+        names = [name for name, in cursor.fetchall()]
+    partitions = {}
+    for name in names:
+        match = PARTITION_NAME.search(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def create_partition(month, using='default'):
+    start, end = month_bounds(month)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            f'CREATE TABLE IF NOT EXISTS {quote(partition_name(month))} PARTITION OF {quote(TABLE)} '
+            'FOR VALUES FROM (%s) TO (%s)',
+            [start, end],
+        )
+
+
+def ensure_partitions(months_ahead=3, first_month=None, using='default'):
+    """Create the monthly partitions from first_month (default: this month) to months_ahead months from now."""
+    existing = list_partitions(using)
+    month = first_month or month_start(timezone.now())
+    last = add_months(month_start(timezone.now()), months_ahead)
+    created = []
+    while month <= last:
+        if month not in existing:
+            create_partition(month, using)
+            created.append(month)
+        month = add_months(month, 1)
+    return created
+
+
+def ensure_future_partitions(using='default', **kwargs):
+    # post_migrate handler, so a deploy never leaves the coming months without a partition
+    if is_partitioned(using):
+        created = ensure_partitions(using=using)
+        if created:
+            logger.info('Created message partitions for %s', ', '.join(f'{month:%Y-%m}' for month in created))
+
+
+def convert(months_ahead=3, using='default', log=logger.info):
+    """
+    Turn the plain messages table into a partitioned one, in the caller's transaction.
+    The rows are copied over, so on a big table this takes a while and holds the table locked throughout.
+    """
+    legacy = f'{TABLE}_unpartitioned'
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'LOCK TABLE {quote(TABLE)} IN ACCESS EXCLUSIVE MODE')
+
+        # what has to be rebuilt on the new table: indexes (except the primary key) and the outgoing foreign keys.
+        # they are recreated under the same names after the old table is gone
+        cursor.execute(
+            'SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT IN '
+            "(SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p')",
+            [TABLE, quote(TABLE)],
+        )
+        index_definitions = [definition for definition, in cursor.fetchall()]
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+            [quote(TABLE)],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            'SELECT conrelid::regclass::text, conname FROM pg_constraint '
+            "WHERE confrelid = to_regclass(%s) AND contype = 'f'",
+            [quote(TABLE)],
+        )
+        incoming = cursor.fetchall()
+        cursor.execute(
+            "SELECT attidentity FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'message_id'",
+            [quote(TABLE)],
+        )
+        identity = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns "
+            "WHERE table_name = %s AND is_generated = 'NEVER' ORDER BY ordinal_position",
+            [TABLE],
+        )
+        columns = ', '.join(quote(name) for name, in cursor.fetchall())
+
+        cursor.execute(f'ALTER TABLE {quote(TABLE)} RENAME TO {quote(legacy)}')
+        cursor.execute(
+            f'CREATE TABLE {quote(TABLE)} (LIKE {quote(legacy)} INCLUDING DEFAULTS INCLUDING GENERATED '
+            'INCLUDING IDENTITY INCLUDING STORAGE INCLUDING COMMENTS) PARTITION BY RANGE ("timestamp")'
+        )
+        if not identity:
+            # a serial column, its sequence belongs to the old table and would be dropped with it
+            cursor.execute("SELECT pg_get_serial_sequence(%s, 'message_id')", [quote(legacy)])
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {quote(TABLE)}.message_id')
+
+        cursor.execute(f'SELECT min("timestamp"), count(*) FROM {quote(legacy)}')
+        oldest, count = cursor.fetchone()
+        created = ensure_partitions(months_ahead, month_start(oldest) if oldest else None, using)
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {quote(DEFAULT_PARTITION)} PARTITION OF {quote(TABLE)} DEFAULT')
+        log(f'Created {len(created)} monthly partitions, copying {count} messages')
+
+        overriding = 'OVERRIDING SYSTEM VALUE ' if identity else ''
+        cursor.execute(
+            f'INSERT INTO {quote(TABLE)} ({columns}) {overriding}SELECT {columns} FROM {quote(legacy)}'
+        )
+        for table, constraint in incoming:
+            # left over from before the foreign keys to Message became db_constraint=False
+            log(f'Dropping foreign key {constraint} on {table}, it can not point at a partitioned table')
+        cursor.execute(f'DROP TABLE {quote(legacy)} CASCADE')
+
+        cursor.execute(f'ALTER TABLE {quote(TABLE)} ADD PRIMARY KEY (message_id, "timestamp")')
+        # the definitions were read before the rename, so they already name the new table
+        for definition in index_definitions:
+            cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {quote(TABLE)} ADD CONSTRAINT {quote(name)} {definition}')
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'message_id'), coalesce(max(message_id), 0) + 1, false) "
+            f'FROM {quote(TABLE)}',
+            [quote(TABLE)],
+        )
+        cursor.execute(f'ANALYZE {quote(TABLE)}')
+
+
+def drop_partition(month, using='default'):
+    """Detach and drop the partition of month. Returns False if there is no such partition."""
+    name = list_partitions(using).get(month)
+    if name is None:
+        return False
+    with connections[using].cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {quote(TABLE)} DETACH PARTITION {quote(name)}')
+        cursor.execute(f'DROP TABLE {quote(name)}')
+    return True
@@ -0,0 +1,309 @@
+import array
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from lang_app import metrics
+
+from .audio import get_storage
+from .models import AudioSubmission, PronunciationFeedback
+
+logger = logging.getLogger(__name__)
+
+# pronunciation scoring.
+# finished uploads (audio.py) are left with scoring_status 'pending'. the score_pronunciation command
+# claims them in batches for PRONUNCIATION_LEASE_SECONDS like the grammar worker does (a short SELECT ...
+# FOR UPDATE SKIP LOCKED transaction, no lock held while scoring), and hands every recording to a pool
+# of processes (one per core by default), because decoding and scoring are
+# pure cpu work that would otherwise be stuck behind the GIL. the processes only get the storage path,
+# they read and decode the file themselves so the audio is never pickled across.
+# the scores come back to the command, which bulk_creates the PronunciationFeedback rows.
+# none of this runs in the web processes, the upload request only leaves the submission behind.
+
+SCORE_FIELDS = (
+    'accuracy_score',
+    'fluency_score',
+    'completeness_score',
+    'prosody_score',
+    'pron_score',
+    'grammar_score',
+    'topic_score',
+)
+
+
+class PronunciationScorer:
+    def decode(self, f, content_type):
+        """Read the recording from the open file f and return whatever score() works on."""
+        raise NotImplementedError
+
+    def score(self, audio, reference_text):
+        """
+        Return a dict with a 0-100 value for each of SCORE_FIELDS, plus 'error_type' (anything json).
+        reference_text is the chat message the recording belongs to, or '' if there is none.
+        """
+        raise NotImplementedError
+
+
+class StubPronunciationScorer(PronunciationScorer):
+    # deterministic scorer for local development and tests, the same recording always gets the same scores.
+    # it decodes 16 bit wav for real and treats anything else as raw 8 bit samples,
+    # then makes the scores up from a few signal statistics
+    def decode(self, f, content_type):
+        if content_type in ('audio/wav', 'audio/x-wav', 'audio/wave'):
+            try:
+                with wave.open(f, 'rb') as w:
+                    if w.getsampwidth() == 2:
+                        samples = array.array('h')
+                        samples.frombytes(w.readframes(w.getnframes()))
+                        return samples, w.getframerate() * w.getnchannels()
+            except (wave.Error, EOFError):
+                f.seek(0)
+        data = f.read()
+        return array.array('h', ((byte - 128) * 256 for byte in data)), 8000
+
+    def score(self, audio, reference_text):
+        samples, rate = audio
+        count = len(samples) or 1
+        rms = math.sqrt(sum(sample * sample for sample in samples) / count) / 32768
+        crossings = sum(1 for a, b in zip(samples, samples[1:]) if (a < 0) != (b < 0)) / count
+        duration = len(samples) / rate
+        words = len(reference_text.split())
+        # roughly 2.5 words a second is a comfortable speaking pace
+        expected = words / 2.5 if words else duration
+        pace = min(duration, expected) / max(duration, expected) if duration and expected else 0
+
+        # a stable per recording offset, so two recordings with the same statistics still differ a bit
+        digest = hashlib.sha256(samples.tobytes() + reference_text.encode()).digest()
+
+        def clamp(value, salt):
+            return max(0.0, min(100.0, value + (digest[salt] - 128) / 32))
+
+        scores = {
+            'accuracy_score': clamp(60 + 40 * min(rms * 4, 1), 0),
+            'fluency_score': clamp(100 * pace, 1),
+            'completeness_score': clamp(100 * min(duration / expected, 1) if expected else 0, 2),
+            'prosody_score': clamp(100 - 200 * abs(crossings - 0.1), 3),
+            'grammar_score': clamp(70 + words, 4),
+            'topic_score': clamp(50 + 50 * pace, 5),
+        }
+        scores['pron_score'] = (
+            scores['accuracy_score'] + scores['fluency_score']
+            + scores['completeness_score'] + scores['prosody_score']
+        ) / 4
+        scores['error_type'] = [] if rms > 0.01 else ['too_quiet']
+        return scores
+
+
+# the pool processes keep their own scorer, created once by _init_process
+_process_scorer = None
+
+
+def _init_process(scorer_path):
+    global _process_scorer
+    # with the spawn start method (macos, windows) the child starts with nothing set up
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+    _process_scorer = import_string(scorer_path)()
+
+
+def score_recording(storage_path, content_type, reference_text):
+    """
+    Runs in a pool process. Returns (scores, decode_seconds, score_seconds).
+    """
+    started = time.perf_counter()
+    with get_storage().open(storage_path) as f:
+        audio = _process_scorer.decode(f, content_type)
+    decoded = time.perf_counter()
+    scores = _process_scorer.score(audio, reference_text)
+    return scores, decoded - started, time.perf_counter() - decoded
+
+
+def available_cores():
+    # the cores this process may actually run on, which is less than cpu_count() in a container with a cpu set
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(workers=None):
+    global _pool, _pool_workers
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool_workers = workers or _pool_workers or settings.PRONUNCIATION_SCORER_WORKERS or available_cores()
+                _pool = ProcessPoolExecutor(
+                    max_workers=_pool_workers,
+                    initializer=_init_process,
+                    initargs=(settings.PRONUNCIATION_SCORER,),
+                )
+    return _pool
+
+
+def rebuild_pool(broken):
+    # a process of the pool died (killed by the oom killer, a crash in a decoder), after that the pool
+    # fails everything submitted to it. the next get_pool() starts a new one with as many processes
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+
+
+stage_seconds = metrics.histogram(
+    'pronunciation_stage_seconds', 'Time spent per recording (decode, score) or per batch (persist)', ['stage'],
+)
+submissions_scored = metrics.counter(
+    'pronunciation_submissions_scored_total', 'Audio submissions scored by this worker', ['status'],
+)
+
+
+def _decimal(value):
+    return Decimal(f'{value:.2f}')
+
+
+def requeue_expired():
+    """Put the claimed submissions of workers that died (their lease ran out) back in the queue, or fail them."""
+    expired = AudioSubmission.objects.filter(scoring_status='claimed', scoring_lease_until__lt=timezone.now())
+    expired.filter(scoring_attempts__gte=settings.PRONUNCIATION_MAX_ATTEMPTS).update(
+        scoring_status='failed', scoring_lease_until=None,
+    )
+    return expired.update(scoring_status='pending', scoring_lease_until=None)
+
+
+def claim(batch_size):
+    """
+    Claim up to batch_size complete, unscored submissions for PRONUNCIATION_LEASE_SECONDS, in a transaction
+    of its own. Returns (submissions, lease_until), the submissions with their messages.
+    """
+    lease_until = timezone.now() + timedelta(seconds=settings.PRONUNCIATION_LEASE_SECONDS)
+    with transaction.atomic():
+        submissions = list(
+            AudioSubmission.objects.select_for_update(skip_locked=True, of=('self',))
+            .filter(status='complete', scoring_status='pending')
+            .select_related('message')
+            .order_by('audio_id')[:batch_size]
+        )
+        if submissions:
+            # a claim counts as an attempt, so a recording that keeps killing its worker runs out of them too
+            AudioSubmission.objects.filter(audio_id__in=[s.audio_id for s in submissions]).update(
+                scoring_status='claimed', scoring_lease_until=lease_until, scoring_attempts=F('scoring_attempts') + 1,
+            )
+    return submissions, lease_until
+
+
+def _still_claimed(audio_ids, lease_until):
+    # the submissions of this claim that are still ours, locked until the caller's transaction ends
+    return set(
+        AudioSubmission.objects.select_for_update()
+        .filter(audio_id__in=audio_ids, scoring_status='claimed', scoring_lease_until=lease_until)
+        .values_list('audio_id', flat=True)
+    )
+
+
+def process_batch(batch_size):
+    """
+    Claim up to batch_size complete, unscored submissions, score them in the process pool
+    and store the feedback. Returns the number of submissions claimed.
+    """
+    requeue_expired()
+    submissions, lease_until = claim(batch_size)
+    if not submissions:
+        return 0
+
+    # the claim is committed, no transaction (and no row lock) is held while the pool scores
+    pool = get_pool()
+    futures = []
+    for submission in submissions:
+        try:
+            futures.append(pool.submit(
+                score_recording, submission.storage_path, submission.content_type,
+                submission.message.message_text if submission.message else '',
+            ))
+        except BrokenProcessPool:
+            break
+
+    # the ones submitted after the pool broke, or that were still in it when it did
+    broken_ids = [submission.audio_id for submission in submissions[len(futures):]]
+    feedback, scored_ids, failed_ids = [], [], []
+    for submission, future in zip(submissions, futures):
+        try:
+            scores, decode_seconds, score_seconds = future.result()
+        except BrokenProcessPool:
+            broken_ids.append(submission.audio_id)
+            continue
+        except Exception:
+            logger.exception('Scoring audio %s failed', submission.audio_id)
+            failed_ids.append(submission.audio_id)
+            continue
+        stage_seconds.observe(decode_seconds, stage='decode')
+        stage_seconds.observe(score_seconds, stage='score')
+        feedback.append(PronunciationFeedback(
+            audio_submission=submission,
+            error_type=scores.get('error_type'),
+            **{field: _decimal(scores[field]) for field in SCORE_FIELDS},
+        ))
+        scored_ids.append(submission.audio_id)
+
+    if broken_ids:
+        logger.warning('The scoring pool broke, starting a new one, %d recordings go back in the queue', len(broken_ids))
+        rebuild_pool(pool)
+
+    with stage_seconds.time(stage='persist'), transaction.atomic():
+        # one whose lease ran out may have been claimed by another worker since, that one stores its scores
+        ours = _still_claimed([submission.audio_id for submission in submissions], lease_until)
+        PronunciationFeedback.objects.bulk_create([f for f in feedback if f.audio_submission_id in ours])
+        AudioSubmission.objects.filter(audio_id__in=ours.intersection(scored_ids)).update(
+            scoring_status='scored', scoring_lease_until=None,
+        )
+        # back into the queue, unless they already used up their attempts
+        failed = AudioSubmission.objects.filter(audio_id__in=ours.intersection(failed_ids))
+        failed.filter(scoring_attempts__gte=settings.PRONUNCIATION_MAX_ATTEMPTS).update(
+            scoring_status='failed', scoring_lease_until=None,
+        )
+        failed.filter(scoring_status='claimed').update(scoring_status='pending', scoring_lease_until=None)
+        # not the recordings' fault, they get their attempt back
+        AudioSubmission.objects.filter(audio_id__in=ours.intersection(broken_ids)).update(
+            scoring_status='pending', scoring_lease_until=None, scoring_attempts=F('scoring_attempts') - 1,
+        )
+
+    submissions_scored.inc(len(ours.intersection(scored_ids)), status='scored')
+    submissions_scored.inc(len(ours.intersection(failed_ids)), status='failed')
+    if len(ours) < len(submissions):
+        logger.warning('%d recordings were scored after their lease ran out', len(submissions) - len(ours))
+    return len(submissions)
+
+
+def queue_depth():
+    return AudioSubmission.objects.filter(status='complete', scoring_status='pending').count()
+
+
+metrics.gauge('pronunciation_queue_depth', 'Uploaded recordings waiting to be scored', callback=queue_depth)
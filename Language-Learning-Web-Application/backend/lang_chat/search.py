@@ -0,0 +1,139 @@
+import logging
+
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank, SearchVectorField
+from django.db import connections
+from django.db.models import F, FloatField, Value
+from django.db.models.expressions import RawSQL
+
+from .models import ChatMembership, Message
+
+logger = logging.getLogger(__name__)
+
+# full text search over the messages.
+# postgres keeps a search_vector column on "Original Messages", generated from message_text with the
+# text search config of the message's language (english stemming for 'en' and so on), and a GIN index on it.
+# the column isn't on the Message model (django 4.2 has no generated fields), it's added by install_search
+# after every migrate (connected in apps.py), which does nothing once it's there.
+# queries reach it through RawSQL typed as a SearchVectorField, so `search_vector=SearchQuery(...)`
+# turns into `search_vector @@ websearch_to_tsquery(...)` and is answered from the index.
+# other databases (sqlite for local development) fall back to a plain substring match.
+
+TABLE = Message._meta.db_table
+COLUMN = 'search_vector'
+INDEX = 'message_search_vector_idx'
+
+# message language -> postgres text search config, anything else is indexed word for word ('simple')
+LANGUAGE_CONFIGS = {
+    'ar': 'arabic',
+    'da': 'danish',
+    'de': 'german',
+    'en': 'english',
+    'es': 'spanish',
+    'fi': 'finnish',
+    'fr': 'french',
+    'hu': 'hungarian',
+    'it': 'italian',
+    'nl': 'dutch',
+    'no': 'norwegian',
+    'pt': 'portuguese',
+    'ro': 'romanian',
+    'ru': 'russian',
+    'sv': 'swedish',
+    'tr': 'turkish',
+}
+DEFAULT_CONFIG = 'simple'
+
+DEFAULT_PAGE_SIZE = 20
+
+
+def config_for(language):
+    return LANGUAGE_CONFIGS.get((language or '').split('-')[0].lower(), DEFAULT_CONFIG)
+
+
+def _config_case():
+    whens = ' '.join(
+        f"WHEN '{language}' THEN '{config}'::regconfig" for language, config in sorted(LANGUAGE_CONFIGS.items())
+    )
+    return f"CASE split_part(lower(language), '-', 1) {whens} ELSE '{DEFAULT_CONFIG}'::regconfig END"
+
+
+def install_search(using='default', **kwargs):
+    """post_migrate handler, adds the generated column and its GIN index if they aren't there yet."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        # adding a stored generated column rewrites the table once, on a big table run the first migrate
+        # in a quiet moment. every migrate after that finds the column and skips it
+        cursor.execute(
+            f'ALTER TABLE "{TABLE}" ADD COLUMN IF NOT EXISTS "{COLUMN}" tsvector '
+            f"GENERATED ALWAYS AS (to_tsvector({_config_case()}, coalesce(message_text, ''))) STORED"
+        )
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS "{INDEX}" ON "{TABLE}" USING GIN ("{COLUMN}")')
+
+
+def any_language_query(text):
+    # for searches that don't know the language (the admin), matches english stemmed and word for word messages
+    return SearchQuery(text, search_type='websearch', config='english') | SearchQuery(
+        text, search_type='websearch', config=DEFAULT_CONFIG,
+    )
+
+
+def search_vector():
+    return RawSQL(f'"{TABLE}"."{COLUMN}"', [], output_field=SearchVectorField())
+
+
+def is_supported(using='default'):
+    return connections[using].vendor == 'postgresql'
+
+
+def search_queryset(queryset, text, language=None):
+    """
+    Narrow a Message queryset down to the messages matching text, best matches first.
+    The rows get a rank annotation (None without postgres).
+    """
+    if not is_supported(queryset.db):
+        return (
+            queryset.filter(message_text__icontains=text)
+            .annotate(rank=Value(None, output_field=FloatField()))
+            .order_by('-timestamp', '-message_id')
+        )
+    query = SearchQuery(text, search_type='websearch', config=config_for(language))
+    return (
+        queryset.alias(search_vector=search_vector())
+        .filter(search_vector=query)
+        .annotate(rank=SearchRank(F('search_vector'), query))
+        .order_by('-rank', '-timestamp', '-message_id')
+    )
+
+
+def search_messages(text, chat_id=None, user=None, language=None, page=1, limit=DEFAULT_PAGE_SIZE):
+    """
+    One page of messages matching text, in one chat and/or in the chats one user is a member of.
+    Returns (results, has_more).
+    """
+    messages = Message.objects.all()
+    if chat_id is not None:
+        messages = messages.filter(chat_id=chat_id)
+    if user is not None:
+        # the chat endpoints post every turn as the local 'user' and 'ai' (writes.get_principals), a logged in
+        # user's own id is only on the memberships of the chats they posted in
+        messages = messages.filter(chat_id__in=ChatMembership.objects.filter(user=user).values('chat_id'))
+    messages = search_queryset(messages, text, language)
+    if is_supported(messages.db):
+        # the highlighted snippet is only worked out for the rows on the page
+        messages = messages.annotate(headline=SearchHeadline(
+            'message_text', SearchQuery(text, search_type='websearch', config=config_for(language)),
+            config=config_for(language), start_sel='<b>', stop_sel='</b>',
+        ))
+    else:
+        messages = messages.annotate(headline=F('message_text'))
+
+    offset = (page - 1) * limit
+    rows = list(
+        messages.values(
+            'message_id', 'chat_id', 'sender__username', 'recipient__username',
+            'message_text', 'language', 'timestamp', 'rank', 'headline',
+        )[offset:offset + limit + 1]
+    )
+    return rows[:limit], len(rows) > limit
@@ -0,0 +1,123 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Dictionary, ReviewState
+
+# spaced repetition for the dictionary, with the SM-2 algorithm
+# (https://super-memory.com/english/ol/sm2.htm).
+# every answer is graded 0-5, 3 and up counts as remembered. remembered cards come back after
+# 1 day, then 6 days, then the last interval times the card's ease factor. forgotten cards start
+# over at 1 day. the ease factor goes up or down with the grade and never drops below 1.3.
+#
+# the scheduling state is kept per user in ReviewState. due_cards reads the next cards off the
+# (user, due_at) index and submit_reviews writes a whole batch of answers with one bulk_update,
+# so neither of them cost more as the dictionary grows.
+
+MIN_EASE_FACTOR = 1.3
+MIN_QUALITY, MAX_QUALITY = 0, 5
+PASSING_QUALITY = 3
+
+REVIEW_FIELDS = (
+    'entry_id',
+    'entry__english_word',
+    'entry__english_phonetic',
+    'entry__chinese_translation',
+    'due_at',
+    'interval_days',
+    'repetitions',
+)
+
+
+class InvalidReview(ValueError):
+    pass
+
+
+def sm2(repetitions, interval_days, ease_factor, quality):
+    """Return the (repetitions, interval_days, ease_factor) after an answer of the given quality."""
+    if quality >= PASSING_QUALITY:
+        if repetitions == 0:
+            interval_days = 1
+        elif repetitions == 1:
+            interval_days = 6
+        else:
+            interval_days = round(interval_days * ease_factor)
+        repetitions += 1
+    else:
+        repetitions = 0
+        interval_days = 1
+    ease_factor += 0.1 - (MAX_QUALITY - quality) * (0.08 + (MAX_QUALITY - quality) * 0.02)
+    return repetitions, interval_days, max(ease_factor, MIN_EASE_FACTOR)
+
+
+def parse_reviews(reviews):
+    """Validate [{"entry_id": .., "quality": ..}, ...] into a list of (entry_id, quality)."""
+    if not isinstance(reviews, list) or not reviews:
+        raise InvalidReview('reviews must be a non-empty list')
+    parsed = []
+    for review in reviews:
+        try:
+            entry_id, quality = int(review['entry_id']), int(review['quality'])
+        except (KeyError, TypeError, ValueError):
+            raise InvalidReview(f'Invalid review: {review}')
+        if not MIN_QUALITY <= quality <= MAX_QUALITY:
+            raise InvalidReview(f'quality must be between {MIN_QUALITY} and {MAX_QUALITY}, got {quality}')
+        parsed.append((entry_id, quality))
+    return parsed
+
+
+def due_cards(user_id, limit, now=None):
+    # index range scan on review_due_idx, stops after limit rows
+    now = now or timezone.now()
+    return list(
+        ReviewState.objects.filter(user_id=user_id, suspended=False, due_at__lte=now)
+        .order_by('due_at')
+        .values(*REVIEW_FIELDS)[:limit]
+    )
+
+
+def add_cards(user_id, entry_ids):
+    """Start reviewing these dictionary entries, due right away. Entries already in the deck are left alone."""
+    existing = set(Dictionary.objects.filter(entry_id__in=entry_ids).values_list('entry_id', flat=True))
+    ReviewState.objects.bulk_create(
+        [ReviewState(user_id=user_id, entry_id=entry_id) for entry_id in existing],
+        ignore_conflicts=True,
+    )
+    return len(existing)
+
+
+def submit_reviews(user_id, reviews, now=None):
+    """
+    Apply a batch of (entry_id, quality) answers. Returns the updated ReviewStates,
+    entries that aren't in the user's deck are skipped.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        # one query for every card in the batch, locked so two sessions of the same user take turns
+        states = {
+            state.entry_id: state
+            for state in ReviewState.objects.select_for_update()
+            .filter(user_id=user_id, entry_id__in={entry_id for entry_id, _ in reviews})
+        }
+        updated = {}
+        # in order, a card answered twice in the batch is scheduled twice
+        for entry_id, quality in reviews:
+            state = states.get(entry_id)
+            if state is None:
+                continue
+            state.repetitions, state.interval_days, state.ease_factor = sm2(
+                state.repetitions, state.interval_days, state.ease_factor, quality,
+            )
+            if quality < PASSING_QUALITY:
+                state.lapses += 1
+            state.due_at = now + timedelta(days=state.interval_days)
+            state.last_reviewed_at = now
+            updated[entry_id] = state
+
+        # one UPDATE ... SET x = CASE review_id WHEN ... for the whole batch
+        ReviewState.objects.bulk_update(
+            updated.values(),
+            ['repetitions', 'interval_days', 'ease_factor', 'lapses', 'due_at', 'last_reviewed_at'],
+        )
+    return list(updated.values())
@@ -0,0 +1,250 @@
+import asyncio
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import audio, context_cache, lookup, scoring
+from login.session_backend import get_writer
+from login.tokens import make_token
+
+from .completion_cache import CompletionCache
+from .models import AudioSubmission, Chat, ChatMembership, Dictionary, Message, PronunciationFeedback
+from .writes import GroupCommitter, forget_principals
+
+
+class GroupCommitterTests(TransactionTestCase):
+    # the committer thread writes through its own connection, so the turns have to be really committed
+    def setUp(self):
+        forget_principals()
+        self.chat = Chat.objects.create(chat_name='group commit')
+
+    def test_cancelled_awaiter_does_not_stop_the_committer(self):
+        # a batch stays open long enough for the first request to go away while it waits
+        committer = GroupCommitter(max_batch=8, max_wait=0.3)
+
+        async def run():
+            gone = asyncio.ensure_future(asyncio.wrap_future(committer.submit(self.chat, 'first', 'reply')))
+            staying = asyncio.wrap_future(committer.submit(self.chat, 'second', 'reply'))
+            await asyncio.sleep(0.05)
+            gone.cancel()
+            second = await asyncio.wait_for(staying, 10)
+            # the next batch, after the one with the cancelled future in it
+            third = await asyncio.wait_for(asyncio.wrap_future(committer.submit(self.chat, 'third', 'reply')), 10)
+            return second, third
+
+        second, third = asyncio.run(run())
+        self.assertEqual(second[0]['message_text'], 'second')
+        self.assertEqual(third[0]['message_text'], 'third')
+        self.assertTrue(committer._thread.is_alive())
+        # the turn of the request that went away is written all the same
+        self.assertEqual(
+            sorted(Message.objects.filter(chat_id=self.chat, is_from_ai=False).values_list('message_text', flat=True)),
+            ['first', 'second', 'third'],
+        )
+
+
+class CrashingScorer(scoring.StubPronunciationScorer):
+    # takes its pool process down with it, like the oom killer would
+    def score(self, audio, reference_text):
+        if reference_text == 'crash':
+            os._exit(1)
+        return super().score(audio, reference_text)
+
+
+@override_settings(PRONUNCIATION_SCORER='lang_chat.tests.CrashingScorer', PRONUNCIATION_SCORER_WORKERS=2)
+class ScoringTests(TransactionTestCase):
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.addCleanup(setattr, audio, '_storage', None)
+        audio._storage = audio.LocalAudioStorage(root=root.name)
+        with open(os.path.join(root.name, 'recording'), 'wb') as f:
+            f.write(bytes(range(256)) * 8)
+        self.addCleanup(scoring.shutdown_pool)
+        self.chat = Chat.objects.create(chat_name='scoring')
+
+    def submit(self, text):
+        message = Message.objects.create(chat_id=self.chat, message_text=text, language='en')
+        return AudioSubmission.objects.create(
+            message=message, storage_path='recording', content_type='audio/basic', size=2048, status='complete',
+        )
+
+    def test_scored_submissions_are_released(self):
+        submission = self.submit('hello')
+        self.assertEqual(scoring.process_batch(8), 1)
+        submission.refresh_from_db()
+        self.assertEqual((submission.scoring_status, submission.scoring_attempts), ('scored', 1))
+        self.assertIsNone(submission.scoring_lease_until)
+        self.assertTrue(PronunciationFeedback.objects.filter(audio_submission=submission).exists())
+
+    def test_a_broken_pool_is_restarted_without_using_up_attempts(self):
+        submissions = [self.submit('crash'), self.submit('crash')]
+        pool = scoring.get_pool()
+        self.assertEqual(scoring.process_batch(8), 2)
+        self.assertIsNot(scoring.get_pool(), pool)
+        for submission in submissions:
+            submission.refresh_from_db()
+            self.assertEqual((submission.scoring_status, submission.scoring_attempts), ('pending', 0))
+
+    def test_expired_leases_go_back_in_the_queue(self):
+        submission = self.submit('hello')
+        AudioSubmission.objects.filter(pk=submission.pk).update(
+            scoring_status='claimed', scoring_attempts=1, scoring_lease_until=timezone.now() - timedelta(seconds=1),
+        )
+        self.assertEqual(scoring.requeue_expired(), 1)
+        submission.refresh_from_db()
+        self.assertEqual((submission.scoring_status, submission.scoring_attempts), ('pending', 1))
+
+
+class InboxTests(TestCase):
+    def setUp(self):
+        self.chat = Chat.objects.create(chat_name='inbox')
+        self.learner = User.objects.create_user('learner', password='pw')
+        ChatMembership.objects.create(chat_id=self.chat.chat_id, user_id=self.learner.pk, unread_count=3)
+
+    def test_anonymous_requests_are_refused(self):
+        self.assertEqual(self.client.get('/inbox/').status_code, 401)
+        self.assertEqual(self.client.post(f'/chat/{self.chat.chat_id}/read/').status_code, 401)
+        self.assertEqual(ChatMembership.objects.get(user_id=self.learner.pk).unread_count, 3)
+
+    def test_a_learner_reads_their_own_inbox(self):
+        authorization = f'Bearer {make_token(self.learner)}'
+        response = self.client.get('/inbox/', HTTP_AUTHORIZATION=authorization)
+        self.assertEqual([chat['chat_id'] for chat in response.json()['chats']], [self.chat.chat_id])
+        response = self.client.post(f'/chat/{self.chat.chat_id}/read/', HTTP_AUTHORIZATION=authorization)
+        self.assertEqual(response.json(), {'unread_count': 0})
+        self.assertEqual(ChatMembership.objects.get(user_id=self.learner.pk).unread_count, 0)
+
+
+class DictionaryImportTests(TransactionTestCase):
+    def setUp(self):
+        self.client = Client(enforce_csrf_checks=True)
+        # the sessions written behind the requests (login/session_backend.py) go in before the test database does
+        self.addCleanup(get_writer().flush)
+        self.client.force_login(User.objects.create_user('editor', password='pw', is_staff=True))
+
+    def post(self, **headers):
+        return self.client.post(
+            '/dictionary/import/?format=csv', 'english_word,chinese_translation\nhello,你好\n',
+            content_type='text/csv', **headers,
+        )
+
+    def test_a_forged_request_from_a_staff_browser_is_refused(self):
+        self.assertEqual(self.post().status_code, 403)
+        self.assertFalse(Dictionary.objects.exists())
+
+    def test_import_with_the_csrf_token(self):
+        # as set by the admin pages
+        self.client.cookies['csrftoken'] = 'a' * 32
+        response = self.post(HTTP_X_CSRFTOKEN='a' * 32)
+        self.assertEqual(response.json()['imported'], 1)
+        self.assertEqual(Dictionary.objects.get().chinese_translation, '你好')
+
+
+class ContextCacheTests(SimpleTestCase):
+    chat_id = 'context-cache-test'
+
+    def setUp(self):
+        cache = context_cache._cache()
+        self.addCleanup(cache.delete_many, [context_cache._key(self.chat_id), context_cache._lock_key(self.chat_id)])
+        cache.set(context_cache._key(self.chat_id), [{'role': 'USER', 'message': 'hi'}])
+
+    def test_a_turn_is_appended(self):
+        context_cache.record_turn(self.chat_id, 'how are you', 'fine')
+        self.assertEqual(
+            [entry['message'] for entry in context_cache._cache().get(context_cache._key(self.chat_id))],
+            ['hi', 'how are you', 'fine'],
+        )
+
+    def test_a_turn_recorded_while_another_is_drops_the_entry(self):
+        cache = context_cache._cache()
+        cache.add(context_cache._lock_key(self.chat_id), 0)
+        context_cache.record_turn(self.chat_id, 'how are you', 'fine')
+        self.assertIsNone(cache.get(context_cache._key(self.chat_id)))
+        # counted, so the writer holding the lock drops what it sets as well
+        self.assertEqual(cache.get(context_cache._lock_key(self.chat_id)), 1)
+
+
+class DictionaryIndexRebuildTests(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(setattr, lookup, '_index', None)
+        self.old = lookup._index = lookup.DictionaryIndex([(1, 'apple', '', '苹果'), (2, 'apricot', '', '杏')])
+        self.old.built_at -= 3600
+        lookup._changed_while_rebuilding = []
+        self.addCleanup(setattr, lookup, '_changed_while_rebuilding', None)
+
+    def test_changes_made_during_a_rebuild_are_replayed(self):
+        # the rebuild read the table before these
+        lookup.entry_saved(Dictionary, Dictionary(entry_id=3, english_word='apply', chinese_translation='申请'))
+        lookup.entry_deleted(Dictionary, Dictionary(entry_id=2))
+        with mock.patch.object(lookup, 'load_rows', return_value=list(self.old.entries.values())):
+            lookup._rebuild(self.old)
+        self.assertIsNot(lookup._index, self.old)
+        self.assertEqual(sorted(lookup._index.entries), [1, 3])
+        self.assertIsNone(lookup._changed_while_rebuilding)
+
+    def test_a_failed_rebuild_keeps_the_old_index_until_the_next_max_age(self):
+        with mock.patch.object(lookup, 'load_rows', side_effect=RuntimeError('replica down')):
+            with self.assertLogs(lookup.logger, 'ERROR'):
+                lookup._rebuild(self.old)
+        self.assertIs(lookup._index, self.old)
+        self.assertLess(time.monotonic() - self.old.built_at, 60)
+
+
+class CompletionStreamTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = CompletionCache()
+        self.calls = 0
+
+    def stream(self, parts=('Hello', ' there'), gap=0.01):
+        async def generate():
+            self.calls += 1
+            for part in parts:
+                await asyncio.sleep(gap)
+                yield part
+        return generate
+
+    async def collect(self, stream):
+        return [part async for part in stream]
+
+    def test_identical_streams_share_one_call(self):
+        async def run():
+            return await asyncio.gather(
+                self.collect(self.cache.get_or_stream('key', self.stream())),
+                self.collect(self.cache.get_or_stream('key', self.stream())),
+            )
+
+        streamed, waited = asyncio.run(run())
+        self.assertEqual(streamed, ['Hello', ' there'])
+        self.assertEqual(waited, ['Hello there'])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.cache.get('key'), 'Hello there')
+
+    def test_a_stream_that_did_not_finish_is_not_cached(self):
+        async def run():
+            await self.collect(self.cache.get_or_stream('key', self.stream(), cache_if=lambda text: False))
+            stream = self.cache.get_or_stream('key', self.stream(gap=0))
+            await stream.__anext__()
+            await stream.aclose()
+
+        asyncio.run(run())
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(self.calls, 2)
+
+    def test_a_waiter_makes_its_own_call_when_the_streaming_client_goes_away(self):
+        async def run():
+            leader = self.cache.get_or_stream('key', self.stream(gap=0.05))
+            await leader.__anext__()
+            waiter = asyncio.ensure_future(self.collect(self.cache.get_or_stream('key', self.stream())))
+            await asyncio.sleep(0.01)
+            await leader.aclose()
+            return await asyncio.wait_for(waiter, 5)
+
+        self.assertEqual(asyncio.run(run()), ['Hello', ' there'])
+        self.assertEqual(self.calls, 2)
@@ -0,0 +1,191 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+import weakref
+
+from django.conf import settings
+from django.core.cache import caches
+from lang_app import metrics
+
+# keeping a burst of chats from taking the upstream (cohere) down with it.
+#
+# 1. a token bucket per user (or per ip when not logged in) in front of ChatView.post / ChatStreamView.post.
+#    every client gets CHAT_RATE_LIMIT['BURST'] messages at once, refilled at PER_MINUTE a minute. the
+#    buckets live in a django cache (CHAT_RATE_LIMIT['CACHE_ALIAS']), so with redis behind it all processes
+#    share them. a client that's out of tokens gets a 429 with Retry-After right away.
+# 2. UpstreamGovernor, in front of every cohere call (llm.py), replaces the plain semaphore that capped the
+#    calls in flight. it still lets COHERE_MAX_CONCURRENT_REQUESTS through at once, but the rest wait in a
+#    priority queue (logged in users before anonymous ones) that is at most CHAT_UPSTREAM['MAX_QUEUE'] long,
+#    and nobody waits more than CHAT_UPSTREAM['MAX_WAIT'] seconds. past either of those the request is shed
+#    (Overloaded, a 429 in the views) instead of piling up until every request times out.
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_LOW: 'low'}
+
+queue_wait = metrics.histogram(
+    'llm_queue_wait_seconds', 'Time calls waited for an upstream slot', ['priority'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+shed = metrics.counter('llm_requests_shed_total', 'Calls turned away by the upstream governor', ['reason'])
+rate_limited = metrics.counter('chat_rate_limited_total', 'Chat requests refused by the per client rate limit')
+
+
+class Overloaded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """Token buckets kept in a django cache, (tokens, last refill) per key."""
+
+    def __init__(self, rate, burst, cache_alias='default', prefix='chat-rate'):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.cache = caches[cache_alias]
+        self.prefix = prefix
+        # the read, refill and write below isn't atomic across processes, two racing requests
+        # can both take the last token. within a process the lock makes it exact
+        self._lock = threading.Lock()
+
+    def take(self, key, now=None):
+        """(allowed, seconds until the next token)"""
+        now = time.time() if now is None else now
+        cache_key = f'{self.prefix}:{key}'
+        with self._lock:
+            tokens, updated_at = self.cache.get(cache_key) or (self.burst, now)
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            # kept until the bucket would be full again, then it's the same as no entry
+            self.cache.set(cache_key, (tokens, now), math.ceil((self.burst - tokens) / self.rate) + 1)
+        return allowed, 0 if allowed else (1 - tokens) / self.rate
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    # None when CHAT_RATE_LIMIT['PER_MINUTE'] is 0
+    global _limiter
+    options = settings.CHAT_RATE_LIMIT
+    if not options.get('PER_MINUTE'):
+        return None
+    if _limiter is None:
+        _limiter = RateLimiter(options['PER_MINUTE'] / 60, options['BURST'], options.get('CACHE_ALIAS', 'default'))
+    return _limiter
+
+
+def client_key(request, principal):
+    if principal is not None:
+        return f'user:{principal.user_id}'
+    return f"ip:{request.META.get('REMOTE_ADDR', '')}"
+
+
+def check_rate_limit(request, principal):
+    """Raises Overloaded when this client is over its rate."""
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return
+    allowed, retry_after = limiter.take(client_key(request, principal))
+    if not allowed:
+        rate_limited.inc()
+        raise Overloaded('Too many messages, slow down a little.', retry_after)
+
+
+class UpstreamGovernor:
+    """An asyncio semaphore with a bounded priority queue and a wait limit. Belongs to one event loop."""
+
+    def __init__(self, max_concurrent, max_queue, max_wait):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        # moving average of how long a call holds its slot, for Retry-After
+        self._hold_seconds = 1.0
+
+    def retry_after(self):
+        # roughly when the queue ahead would have drained
+        return max(1.0, (self.queued + 1) / self.max_concurrent * self._hold_seconds)
+
+    async def acquire(self, priority=PRIORITY_HIGH):
+        started = time.perf_counter()
+        if self.active < self.max_concurrent and not self.queued:
+            self.active += 1
+            queue_wait.observe(0, priority=PRIORITY_NAMES[priority])
+            return
+        if self.queued >= self.max_queue:
+            shed.inc(reason='queue_full')
+            raise Overloaded('The chat is very busy right now, try again in a moment.', self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as the wait ended, pass it on
+                self.release(held=None)
+            else:
+                future.cancel()
+                self.queued -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                shed.inc(reason='timeout')
+                raise Overloaded('The chat is very busy right now, try again in a moment.', self.retry_after())
+            raise
+        finally:
+            queue_wait.observe(time.perf_counter() - started, priority=PRIORITY_NAMES[priority])
+
+    def release(self, held=None):
+        if held is not None:
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held
+        # hand the slot straight to the next waiter, so nobody new can jump the queue
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self.queued -= 1
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    def slot(self, priority=PRIORITY_HIGH):
+        return _Slot(self, priority)
+
+
+class _Slot:
+    def __init__(self, governor, priority):
+        self.governor = governor
+        self.priority = priority
+
+    async def __aenter__(self):
+        await self.governor.acquire(self.priority)
+        self._started = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.governor.release(held=time.perf_counter() - self._started)
+
+
+_governors = weakref.WeakKeyDictionary()
+
+
+def get_governor():
+    # per loop, like the cohere client (under wsgi every async view has its own loop)
+    loop = asyncio.get_running_loop()
+    governor = _governors.get(loop)
+    if governor is None:
+        options = settings.CHAT_UPSTREAM
+        governor = _governors[loop] = UpstreamGovernor(
+            settings.COHERE_MAX_CONCURRENT_REQUESTS, options['MAX_QUEUE'], options['MAX_WAIT'],
+        )
+    return governor
@@ -0,0 +1,113 @@
+import hashlib
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from lang_app import clients
+from lang_app.instrumentation import external_call
+
+from .models import Translation
+
+# translation memory on top of the Translation model ("Message Translations").
+# every translation is stored under a hash of (source text, source language, target language),
+# so a sentence that shows up again ("hello", "thank you") is read back from the table instead of
+# being sent to the translation api again. whatever isn't in the table yet is translated in one
+# batched call to the backend in settings.TRANSLATION_BACKEND.
+
+
+def translation_key(text, source_language, target_language):
+    raw = f'{source_language}\x1f{target_language}\x1f{text}'.encode()
+    return hashlib.sha256(raw).hexdigest()
+
+
+class TranslationBackend:
+    def translate_batch(self, texts, source_language, target_language):
+        """Return the translations of texts, in the same order."""
+        raise NotImplementedError
+
+
+class StubTranslationBackend(TranslationBackend):
+    # for local development and tests, doesn't call anything.
+    # calls counts the batches it was asked for, so tests can check what reached the "api"
+    def __init__(self):
+        self.calls = 0
+
+    def translate_batch(self, texts, source_language, target_language):
+        self.calls += 1
+        return [f'[{target_language}] {text}' for text in texts]
+
+
+class GoogleTranslationBackend(TranslationBackend):
+    # Google Cloud Translation API, credentials come from GOOGLE_APPLICATION_CREDENTIALS like the other google clients
+    def __init__(self):
+        try:
+            from google.cloud import translate_v2
+        except ImportError as e:
+            raise ImportError(
+                'GoogleTranslationBackend needs google-cloud-translate, '
+                'pip install google-cloud-translate or set TRANSLATION_BACKEND to another backend'
+            ) from e
+        self.client = translate_v2.Client()
+
+    def translate_batch(self, texts, source_language, target_language):
+        results = self.client.translate(
+            list(texts),
+            source_language=source_language,
+            target_language=target_language,
+            format_='text',
+        )
+        return [result['translatedText'] for result in results]
+
+
+clients.register('translation', lambda: import_string(settings.TRANSLATION_BACKEND)())
+
+
+def get_backend():
+    return clients.get('translation')
+
+
+def translate_messages(messages, target_language):
+    """
+    Translate a page of messages (dicts with message_id, message_text and language).
+    Returns {message_id: translated_text}.
+
+    One query reads everything already in the translation memory, the rest goes to the backend
+    in one batch per source language (normally just one), and one insert stores the new translations.
+    """
+    keys = {
+        message['message_id']: translation_key(message['message_text'], message['language'], target_language)
+        for message in messages
+    }
+    known = dict(
+        Translation.objects.filter(source_hash__in=set(keys.values()))
+        .values_list('source_hash', 'translated_text')
+    )
+
+    # the misses, deduplicated so a sentence repeated on the page is only translated once
+    missing = {}  # source language -> {key: (message_id, text)}
+    for message in messages:
+        key = keys[message['message_id']]
+        if key not in known:
+            missing.setdefault(message['language'], {}).setdefault(
+                key, (message['message_id'], message['message_text'])
+            )
+
+    new_rows = []
+    for source_language, pending in missing.items():
+        texts = [text for _, text in pending.values()]
+        with external_call('translation'):
+            translated = get_backend().translate_batch(texts, source_language, target_language)
+        for (key, (message_id, _)), translated_text in zip(pending.items(), translated):
+            known[key] = translated_text
+            new_rows.append(Translation(
+                message_id=message_id,
+                original_language=source_language,
+                translated_language=target_language,
+                translated_text=translated_text,
+                source_hash=key,
+            ))
+
+    if new_rows:
+        # another request may have translated the same sentence in the meantime, the first one wins
+        Translation.objects.bulk_create(new_rows, ignore_conflicts=True)
+
+    return {message_id: known[key] for message_id, key in keys.items()}
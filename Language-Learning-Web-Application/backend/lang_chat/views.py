@@ -1,49 +1,110 @@
-from django.contrib.auth import get_user_model
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.core.exceptions import ValidationError
-from django.http import JsonResponse
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views import View
-from django.utils import timezone
-from django.db import transaction
+from django.conf import settings
+from asgiref.sync import sync_to_async
+from lang_app.db_router import read_replica
+from login.tokens import request_principal
 
-from .models import Message
-from rest_framework.parsers import JSONParser
-import cohere
+from .chats import get_cached_chat, get_chat
+from .models import AudioSubmission
+from .pagination import HISTORY_FIELDS, InvalidCursor, history_page, parse_page_size
+from .translation import translate_messages
+from .writes import asave_turn
+from . import audio, context_cache, dictionary_io, inbox, llm, lookup, search, srs, throttle
+import json
+import math
 import traceback
 
-# Initialize Cohere client with API key
-co = cohere.Client('my-cohere-api-key') # privacy reasons, replaced it
+# the cohere client used to be created right here (co = cohere.Client(...)),
+# it moved to llm.py when the chat endpoint became async
 
+
+def load_history_page(chat_id, before, limit):
+    # returns None when the chat in the url doesn't exist
+    chat = get_chat(chat_id)
+    if chat is None:
+        if chat_id is not None:
+            return None
+        # nobody has posted in the default chat yet
+        return [], None
+    return history_page(chat, before=before, limit=limit)
+
+
+def build_chat_history(chat):
+    # Fetch the last 5 messages of this chat
+    # why? I am using cohere's chat api https://docs.cohere.com/reference/chat
+    # which has parameters for chat_history. which is good, because it allows the response to 
+    # be more contextual and adapted to the user's previous messages.
+    # 
+    # the requirements for chat history is aas such:
+    # chat_history=[
+    #   {"role": "USER", "message": "Who discovered gravity?"},
+    #   {"role": "CHATBOT", "message": "The man who is widely credited with discovering gravity is Sir Isaac Newton"}
+    # ]
+    # this used to query the whole message table every time and look up message.sender.username one by one.
+    # the history of each chat is now cached already in that format (CHAT_HISTORY_LENGTH messages),
+    # so the database is only read when the chat isn't in the cache. see context_cache.py
+    return context_cache.get_history(chat.chat_id)
+
+
+def admit(request):
+    # who is asking and whether they're over their message rate (throttle.py), both read the cache.
+    # logged in users get ahead of anonymous ones in the upstream queue.
+    # returns (priority, the user id to make a member of the chat or None)
+    principal = request_principal(request)
+    throttle.check_rate_limit(request, principal)
+    if principal is None:
+        return throttle.PRIORITY_LOW, None
+    return throttle.PRIORITY_HIGH, principal.user_id
+
+
+def overloaded_response(e):
+    response = JsonResponse({'error': str(e)}, status=429)
+    response['Retry-After'] = str(math.ceil(e.retry_after))
+    return response
+
+
+# the chat view is async, so it should be served through lang_app/asgi.py (e.g. uvicorn).
+# while a turn waits on cohere, the event loop keeps serving other chats instead of a whole worker sitting idle.
+# the ORM is still synchronous, so every database step goes through sync_to_async.
 @method_decorator(csrf_exempt, name='dispatch')
 class ChatView(View):
     # handler for GET requests
     # when the frontend makes a GET request to the backend, it will call this function
-    def get(self, request, *args, **kwargs):
-        # from models.py, Message is a class, and a table in the database. 
-        # this line queries the database for all Message objects, and then order them chronologically according to the timestap
-        # it is important for showing the past messages in the order order. 
-        # these exact fields are present in the Message class in models.py,
-        # and values allow to fetch only these fields. 
-        # these fields are needed for the frontend to display the messages
-
-        # for now its just fetching ALL past message from the message table in the database, 
-        # becase i have not implemented an authentication system to the chat
-        messages = list(Message.objects.order_by('timestamp').values(
-            'message_id', 'sender__username', 'recipient__username', 'message_text', 'timestamp'
-        ))
-        # the JsonReppnse function returns the messages above in json format, 
-        # with the key 'messages' and the value being the list of messages
-        return JsonResponse({'messages': messages})
+    async def get(self, request, chat_id=None, *args, **kwargs):
+        # this used to fetch ALL past messages from the message table on every page load.
+        # now it only returns the latest page of the requested chat (?limit=, default 50),
+        # plus a 'before' cursor. passing ?before=<cursor> back loads the next older page.
+        # see pagination.py for how the cursor works
+        try:
+            limit = parse_page_size(request.GET.get('limit'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
-    def post(self, request, *args, **kwargs):
-        # because i'm using django's default user model to store user details, 
-        # i imported get_user_model() to enable easy access to the user model
-        User = get_user_model()
-        
         try:
+            # a replica is fine here, right after this browser posted ReplicaPinningMiddleware keeps it on the primary
+            with read_replica():
+                page = await sync_to_async(load_history_page)(chat_id, request.GET.get('before'), limit)
+        except InvalidCursor as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        if page is None:
+            return JsonResponse({'error': 'Chat not found.'}, status=404)
+
+        messages, before = page
+        # the JsonReppnse function returns the messages above in json format,
+        # with the key 'messages' and the value being the list of messages (oldest first)
+        return JsonResponse({'messages': messages, 'before': before})
+
+    async def post(self, request, chat_id=None, *args, **kwargs):
+        try:
+            priority, member_id = await sync_to_async(admit)(request)
+
             # Parse the incoming message from the frontend, store it in data variable
-            data = JSONParser().parse(request)
+            data = json.loads(request.body)
             # get the message from the data variable like a key. 
             # this is text which the user inputted in the frontend text box, 
             # from line 186 in frontend/src/chat.js, the message state variable is posted in a json format. 
@@ -52,50 +113,16 @@ class ChatView(View):
             # this checks if user_message_text is empty, and if it is, it raises an error
             if not user_message_text:
                 raise ValidationError("No message provided.")
-            
-            # Fetch the last 5 exchanges from the database
-            # why? I am using cohere's chat api https://docs.cohere.com/reference/chat
-            # which has parameters for chat_history. which is good, because it allows the response to 
-            # be more contextual and adapted to the user's previous messages.
-            # i fetched the first 6 messages by reversed time, which means descening order of time. 
-            # this way, the most recent 6 messages are used. 
-            last_messages = Message.objects.order_by('-timestamp')[:5]
-            
-            # Create a list of dictionaries with last_messages. 
-            # the requirements for chat history is aas such:
-            # chat_history=[
-            #   {"role": "USER", "message": "Who discovered gravity?"},
-            #   {"role": "CHATBOT", "message": "The man who is widely credited with discovering gravity is Sir Isaac Newton"}
-            # ]
-            
-            # Initialize an empty list for the chat history
-            chat_history = []
-
-            # Loop over the last messages in reverse order
-            for message in reversed(last_messages):
-                # messages in last_messages are from the message table in the database which has the sender column
-                # message.sender.username points to the username
-                # if the username is 'user', then the role is 'USER', else it is 'CHATBOT'
-                # currently i'm only developing locally and user is my username, so the message i sent will def be USER
-                # for widespread application, user if username !== 'ai' else chatbot should work, 
-                # because message by ai is created in the database under username ai, always, under line 172
-                role = 'USER' if message.sender.username == 'user' else 'CHATBOT'
-                
-                # Create a dictionary for the message
-                # the role is from the previous line, 
-                # message.message_text points to the actual message. also a column in the message table.
-                # does not need to be index for alignment or anything, because both items are accesing the same message from last_messages.
-                message_dict = {
-                    'role': role,
-                    'message': message.message_text
-                }
-                
-                # Add the dictionary to the chat history
-                chat_history.append(message_dict)
+
+            # the messages of this turn belong to the chat in the url (or the default chat for plain /chat/)
+            chat = get_cached_chat(chat_id) or await sync_to_async(get_chat)(chat_id, create=True)
+            if chat is None:
+                return JsonResponse({'error': 'Chat not found.'}, status=404)
+
+            chat_history = await sync_to_async(build_chat_history)(chat)
             
             # fun part where the magic kind of happens
-            # this is the api request for the cohere chat api. 
-            # the response is saved as the variable response. 
+            # this is the api request for the cohere chat api, see llm.py. 
             # chat_history is the dictionary of the last 6 messages,
             # message is the user's message from the frontend.
             # prompt_truncation is a parameter that i set as attempt to decrease the length of the response, 
@@ -105,14 +132,7 @@ class ChatView(View):
             # 10 tokens are very low, which means it selects only the 10 words with the highest probability of being the next word in text generation. 
             # less samples make less randomness in generation, which is what i want in this case for a conversational and conventional chat function,
             # which i want to stimulate reality. 
-            response = co.chat(
-                model="command-light",
-                chat_history=chat_history,
-                message=user_message_text,
-                prompt_truncation="AUTO",
-                temperature=0.2,
-                k=10
-            )
+            # awaiting it frees up the event loop for other requests until cohere answers.
             
             # this is a sample reponse from the cohere chat api.
             """ cohere.Chat {
@@ -135,80 +155,409 @@ class ChatView(View):
                 search_queries: None
             } """
             
-            # the ai's reponse has the key 'text',
-            # so response.text points to the actual response. save it to ai_message_text.
-            ai_message_text = response.text
-
-            # transaction.atmoic() is a context manager that wraps a block of code into a database transaction.
-            # it just seemed like a very suave and clean way to handle the database interaction. 
-            # this block executes immedialtey after the previous code.     
-            with transaction.atomic():
-                # Get or create the User instances for the user and the AI
-                # i added this when i got errors trying to run the chat as a local user (with name 'user'), 
-                # because I am not registerd in the user database. 
-                # so i created this to create me as a user. 
-                
-                # the get_or_create method combines http request functionalities of get and create. 
-                # it tries to get the user named user, if that fails it creates a user named user, same thing for ai. 
-                # it helped create the user at start but then now that they are registered in the database, 
-                # just get will work okay to fetch the user and ai object from the Uer table. 
-                user, _ = User.objects.get_or_create(username='user')
-                ai, _ = User.objects.get_or_create(username='ai')
-
-                # testing locally will always result in sender being user, so i put sender as user.
-                # later when I consider large scale user implementations, user will be replaced by the actual username. 
-
-                # Create the user's message
-                user_message = Message.objects.create(
-                    sender=user,
-                    recipient=ai,
-                    is_from_ai=False, 
-                    # user message fetched in line 47 
-                    message_text=user_message_text,
-                    language='en', 
-                    timestamp=timezone.now()
-                )
-
-                # Create the AI's response message
-                ai_message = Message.objects.create(
-                    sender=ai,
-                    recipient=user,
-                    is_from_ai=True,
-                    # ai api response from line 137
-                    message_text=ai_message_text,
-                    language='en',  
-                    timestamp=timezone.now()
-                )
-
-            # Return both messages in the response
-            # the name has to be the SAME as the fetched chat history parameter names in the frontend js file
-            # orelse a lot of frontend functions will not work, because this is the jsonresponse that the
-            # frontend will get and it access each key by its exact name
-            return JsonResponse({
-                # accesing values from the user_message and ai_message using keys
-                'messages': [
-                    {
-                        'message_id': user_message.message_id,
-                        'sender__username': user.username,
-                        'recipient__username': ai, 
-                        'message_text': user_message.message_text,
-                        'timestamp': user_message.timestamp
-                    },
-                    {
-                        'message_id': ai_message.message_id,
-                        'sender__username': ai.username,
-                        'recipient__username': user.username,
-                        'message_text': ai_message.message_text,
-                        'timestamp': ai_message.timestamp
-                    }
-                ]
-            })
+            # the ai's reponse has the key 'text', llm.chat returns just that
+            ai_message_text = await llm.chat(user_message_text, chat_history, priority)
+
+            # both messages go in with one insert, see writes.py
+            messages = await asave_turn(chat, user_message_text, ai_message_text, member_id)
+
+            # accesing values from the user_message and ai_message using keys
+            return JsonResponse({'messages': messages})
         # the caught exception is assigned to the variable e, used in the error message
         # raised when data fails form or model field validation
         except ValidationError as e:
             return JsonResponse({'error': str(e)}, status=400)
 
+        # over the rate limit, or the upstream queue is full, see throttle.py
+        except throttle.Overloaded as e:
+            return overloaded_response(e)
+
         # raised when any kind of exception that occurs in the post method. 
         except Exception as e:
             traceback.print_exc()
-            return JsonResponse({'error': 'Could not process your message.' + str(e)}, status=500)
\ No newline at end of file
+            return JsonResponse({'error': 'Could not process your message.' + str(e)}, status=500)
+
+
+def sse_event(event, data):
+    # one server-sent event, the frontend splits the stream on the blank lines
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+# streaming version of ChatView.post, at chat/stream/ and chat/<int:chat_id>/stream/.
+# instead of waiting for the whole cohere reply, it forwards each piece of text as a server-sent event:
+#   event: token  data: {"text": "..."}      as the reply is generated
+#   event: done   data: {"messages": [...]}  once both messages are saved, same shape as ChatView.post
+#   event: error  data: {"error": "..."}     if cohere or the database fails halfway
+# this only really streams under asgi, under wsgi django collects the whole stream first.
+@method_decorator(csrf_exempt, name='dispatch')
+class ChatStreamView(View):
+    async def post(self, request, chat_id=None, *args, **kwargs):
+        # everything that can fail before the stream starts still gets a normal json error
+        try:
+            priority, member_id = await sync_to_async(admit)(request)
+
+            data = json.loads(request.body)
+            user_message_text = data.get('message')
+            if not user_message_text:
+                raise ValidationError("No message provided.")
+
+            chat = get_cached_chat(chat_id) or await sync_to_async(get_chat)(chat_id, create=True)
+            if chat is None:
+                return JsonResponse({'error': 'Chat not found.'}, status=404)
+
+            chat_history = await sync_to_async(build_chat_history)(chat)
+
+            # the first piece is awaited before the response starts, so a request the upstream governor
+            # sheds still gets a proper 429 instead of an error event
+            stream = llm.chat_stream(user_message_text, chat_history, priority)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                first = None
+        except ValidationError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except throttle.Overloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            traceback.print_exc()
+            return JsonResponse({'error': 'Could not process your message.' + str(e)}, status=500)
+
+        response = StreamingHttpResponse(
+            self.stream_turn(chat, user_message_text, stream, first, member_id),
+            content_type='text/event-stream',
+        )
+        # don't let a proxy (or the browser) sit on the tokens
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream_turn(self, chat, user_message_text, stream, first, member_id):
+        parts = []
+        try:
+            if first is not None:
+                parts.append(first)
+                yield sse_event('token', {'text': first})
+            async for text in stream:
+                parts.append(text)
+                yield sse_event('token', {'text': text})
+
+            # the ai message is only saved once the reply is complete,
+            # if the client disconnects halfway nothing gets stored
+            messages = await asave_turn(chat, user_message_text, ''.join(parts), member_id)
+            yield sse_event('done', {'messages': messages})
+        except Exception as e:
+            traceback.print_exc()
+            yield sse_event('error', {'error': 'Could not process your message.' + str(e)})
+        finally:
+            # the client went away: the upstream stream (and its slot) ends now, not whenever it's collected,
+            # and the identical requests waiting on it (llm.chat_stream) make their own call
+            await stream.aclose()
+
+
+# translates a whole page of a chat at once: chat/<int:chat_id>/translate/?target=zh
+# it takes the same ?before= and ?limit= as the history GET, so the frontend can translate exactly the page it shows.
+# repeated sentences come out of the translation memory, see translation.py
+@method_decorator(csrf_exempt, name='dispatch')
+class TranslateChatView(View):
+    def get(self, request, chat_id, *args, **kwargs):
+        target_language = request.GET.get('target')
+        if not target_language:
+            return JsonResponse({'error': 'No target language provided.'}, status=400)
+        try:
+            limit = parse_page_size(request.GET.get('limit'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        chat = get_chat(chat_id)
+        if chat is None:
+            return JsonResponse({'error': 'Chat not found.'}, status=404)
+
+        try:
+            messages, before = history_page(
+                chat,
+                before=request.GET.get('before'),
+                limit=limit,
+                fields=HISTORY_FIELDS + ('language',),
+            )
+        except InvalidCursor as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        try:
+            translations = translate_messages(messages, target_language)
+        except Exception as e:
+            traceback.print_exc()
+            return JsonResponse({'error': 'Could not translate this chat.' + str(e)}, status=502)
+
+        return JsonResponse({
+            'translations': [
+                {
+                    'message_id': message['message_id'],
+                    'original_language': message['language'],
+                    'translated_language': target_language,
+                    'translated_text': translations[message['message_id']],
+                }
+                for message in messages
+            ],
+            'before': before,
+        })
+
+
+def upload_status(submission):
+    return {
+        'upload_id': str(submission.upload_id),
+        'audio_id': submission.audio_id,
+        'status': submission.status,
+        'offset': submission.bytes_received,
+        'size': submission.size,
+        'audio_url': submission.audio_url or None,
+    }
+
+
+# resumable audio uploads for pronunciation practice, in the spirit of the tus protocol:
+#   POST  audio/uploads/              {"size": <bytes>, "content_type": "audio/wav", "message_id": <optional>}
+#   PATCH audio/uploads/<upload_id>/  body = the next bytes, Upload-Offset header = where they start
+#   GET   audio/uploads/<upload_id>/  where the upload is at, to resume after a dropped connection
+# the request body is copied to storage in fixed size chunks and never read into memory at once, see audio.py
+@method_decorator(csrf_exempt, name='dispatch')
+class AudioUploadView(View):
+    def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body)
+            size = int(data.get('size'))
+            if size <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'The upload size must be a positive number of bytes.'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        user = request.user if request.user.is_authenticated else None
+        try:
+            submission = audio.start_upload(
+                size,
+                data.get('content_type') or 'audio/wav',
+                user=user,
+                message_id=data.get('message_id'),
+            )
+        except audio.UploadTooLarge as e:
+            return JsonResponse({'error': str(e)}, status=413)
+
+        status = upload_status(submission)
+        status['chunk_size'] = settings.AUDIO_UPLOAD_CHUNK_SIZE
+        return JsonResponse(status, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AudioUploadChunkView(View):
+    def get(self, request, upload_id, *args, **kwargs):
+        submission = AudioSubmission.objects.filter(upload_id=upload_id).first()
+        if submission is None:
+            return JsonResponse({'error': 'Upload not found.'}, status=404)
+        return JsonResponse(upload_status(submission))
+
+    def patch(self, request, upload_id, *args, **kwargs):
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            return JsonResponse({'error': 'The Upload-Offset header is required.'}, status=400)
+        length = request.META.get('CONTENT_LENGTH')
+        length = int(length) if length else None
+
+        try:
+            # request is read like a file here, never through request.body
+            submission = audio.append_chunk(upload_id, request, offset, length)
+        except ObjectDoesNotExist:
+            return JsonResponse({'error': 'Upload not found.'}, status=404)
+        except audio.UploadOffsetMismatch as e:
+            # the client is out of sync (e.g. a chunk got lost), it should continue from here
+            return JsonResponse({'error': str(e), 'offset': e.expected}, status=409)
+        except audio.UploadTooLarge as e:
+            return JsonResponse({'error': str(e)}, status=413)
+
+        status = upload_status(submission)
+        status['deduplicated'] = getattr(submission, 'deduplicated', False)
+        return JsonResponse(status)
+
+
+# spaced repetition reviews of the dictionary, for the logged in user (see srs.py).
+# the user comes from the session or a bearer token (login/tokens.py), the user row isn't loaded:
+#   GET  review/due/?limit=N   the next N cards that are due, most overdue first
+#   POST review/cards/         {"entry_ids": [...]} start reviewing these entries
+#   POST review/               {"reviews": [{"entry_id": .., "quality": 0-5}, ...]} a whole session's answers at once
+def review_state(state):
+    return {
+        'entry_id': state.entry_id,
+        'due_at': state.due_at,
+        'interval_days': state.interval_days,
+        'repetitions': state.repetitions,
+        'ease_factor': round(state.ease_factor, 2),
+    }
+
+
+class ReviewDueView(View):
+    def get(self, request, *args, **kwargs):
+        principal = request_principal(request)
+        if principal is None:
+            return JsonResponse({'error': 'Log in to review.'}, status=401)
+        try:
+            limit = parse_page_size(request.GET.get('limit'), default=20)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'cards': srs.due_cards(principal.user_id, limit)})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ReviewCardsView(View):
+    def post(self, request, *args, **kwargs):
+        principal = request_principal(request)
+        if principal is None:
+            return JsonResponse({'error': 'Log in to review.'}, status=401)
+        try:
+            entry_ids = [int(entry_id) for entry_id in json.loads(request.body)['entry_ids']]
+        except (KeyError, TypeError, ValueError):
+            return JsonResponse({'error': 'entry_ids must be a list of dictionary entry ids.'}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'added': srs.add_cards(principal.user_id, entry_ids)}, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ReviewSubmitView(View):
+    def post(self, request, *args, **kwargs):
+        principal = request_principal(request)
+        if principal is None:
+            return JsonResponse({'error': 'Log in to review.'}, status=401)
+        try:
+            reviews = srs.parse_reviews(json.loads(request.body).get('reviews'))
+        except srs.InvalidReview as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        states = srs.submit_reviews(principal.user_id, reviews)
+        return JsonResponse({'cards': [review_state(state) for state in states]})
+
+
+# dictionary typeahead, GET dictionary/lookup/?q=<text>&limit=10&mode=auto|prefix|fuzzy
+# answered from the in-memory index in lookup.py, the database isn't queried
+class DictionaryLookupView(View):
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('q', '')
+        mode = request.GET.get('mode', 'auto')
+        if mode not in ('auto', 'prefix', 'fuzzy'):
+            return JsonResponse({'error': f'Invalid mode: {mode}'}, status=400)
+        try:
+            limit = min(parse_page_size(request.GET.get('limit'), default=lookup.DEFAULT_LIMIT), lookup.MAX_LIMIT)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'results': lookup.lookup(query, limit, mode)})
+
+
+# bulk dictionary import/export for staff (see dictionary_io.py)
+#   POST dictionary/import/?format=csv|jsonl   body = the file, read line by line, never all in memory
+#   GET  dictionary/export/?format=csv|jsonl   streamed out, never built in memory
+# under asgi django spools the whole body (to a temporary file once it's big) before the view runs, so the
+# import starts when the upload is done. only under wsgi are the lines read as they arrive.
+# staff are recognized by their session, so unlike the bearer token endpoints the import isn't csrf_exempt:
+# send the csrftoken cookie (the admin pages set it) back in an X-CSRFToken header
+class DictionaryImportView(View):
+    def post(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return JsonResponse({'error': 'Only staff can import words.'}, status=403)
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in dictionary_io.FORMATS:
+            return JsonResponse({'error': f'Invalid format: {fmt}'}, status=400)
+
+        chunks = []
+
+        def on_chunk(number, rows, seconds):
+            dictionary_io.log_chunk(number, rows, seconds)
+            chunks.append({'chunk': number, 'rows': rows, 'seconds': round(seconds, 3)})
+
+        # iterating the request reads the body one line at a time, not through request.body
+        lines = (line.decode('utf-8-sig') for line in request)
+        try:
+            written, skipped = dictionary_io.import_rows(
+                dictionary_io.read_rows(lines, fmt),
+                on_chunk=on_chunk,
+                skip_invalid=request.GET.get('skip_invalid') == '1',
+            )
+        except (dictionary_io.InvalidRow, UnicodeDecodeError) as e:
+            return JsonResponse({'error': f'Nothing was imported, {e}'}, status=400)
+        return JsonResponse({'imported': written, 'skipped': skipped, 'chunks': chunks})
+
+
+class DictionaryExportView(View):
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_staff:
+            return JsonResponse({'error': 'Only staff can export the dictionary.'}, status=403)
+        fmt = request.GET.get('format', 'csv')
+        if fmt not in dictionary_io.FORMATS:
+            return JsonResponse({'error': f'Invalid format: {fmt}'}, status=400)
+        response = StreamingHttpResponse(
+            dictionary_io.aexport_lines(fmt),
+            content_type='text/csv; charset=utf-8' if fmt == 'csv' else 'application/jsonl; charset=utf-8',
+        )
+        response['Content-Disposition'] = f'attachment; filename="dictionary.{fmt}"'
+        return response
+
+
+# full text search of past messages (see search.py), best matches first
+#   GET chat/<chat_id>/search/?q=<words>&page=1&limit=20&language=en   within one chat
+#   GET search/?q=<words>&...                                          the messages of the logged in user's chats
+# q takes web search syntax: "quoted phrases", -excluded, or
+class MessageSearchView(View):
+    def get(self, request, chat_id=None, *args, **kwargs):
+        text = request.GET.get('q', '').strip()
+        if not text:
+            return JsonResponse({'error': 'No search text provided.'}, status=400)
+        try:
+            limit = parse_page_size(request.GET.get('limit'), default=search.DEFAULT_PAGE_SIZE)
+            page = int(request.GET.get('page') or 1)
+            if page < 1:
+                raise ValueError(f'Invalid page: {page}')
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        user = None
+        if chat_id is None:
+            principal = request_principal(request)
+            if principal is None:
+                return JsonResponse({'error': 'Log in to search your messages.'}, status=401)
+            user = principal.user_id
+        elif get_chat(chat_id) is None:
+            return JsonResponse({'error': 'Chat not found.'}, status=404)
+
+        results, has_more = search.search_messages(
+            text, chat_id=chat_id, user=user, language=request.GET.get('language', 'en'), page=page, limit=limit,
+        )
+        return JsonResponse({'results': results, 'page': page, 'next_page': page + 1 if has_more else None})
+
+
+# the chat list of the logged in user (see inbox.py):
+#   GET  inbox/?limit=30&before=<cursor>   chats with the newest activity first, each with its unread count and last message
+#   POST chat/<chat_id>/read/               the user has seen everything in the chat, its unread count goes back to 0
+# a logged in user is a member of every chat they posted in (writes.write_turns).
+# there is no inbox without a login: the chats posted anonymously all belong to the one shared local 'user'
+# (writes.get_principals), its inbox would show everybody's chats to anybody
+class InboxView(View):
+    def get(self, request, *args, **kwargs):
+        principal = request_principal(request)
+        if principal is None:
+            return JsonResponse({'error': 'Log in to see your chats.'}, status=401)
+        try:
+            limit = parse_page_size(request.GET.get('limit'), default=inbox.DEFAULT_PAGE_SIZE)
+            chats, before = inbox.inbox_page(principal.user_id, request.GET.get('before'), limit)
+        except (InvalidCursor, ValueError) as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'chats': chats, 'before': before})
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ChatReadView(View):
+    def post(self, request, chat_id, *args, **kwargs):
+        principal = request_principal(request)
+        if principal is None:
+            return JsonResponse({'error': 'Log in to see your chats.'}, status=401)
+        if not inbox.mark_read(chat_id, principal.user_id):
+            return JsonResponse({'error': 'Chat not found.'}, status=404)
+        return JsonResponse({'unread_count': 0})
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from . import context_cache, grammar, inbox
+from .chats import forget_chat
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# the write path of a chat turn.
+# it used to be two get_or_create calls for the user and the ai, then two separate inserts,
+# so 6 or so round trips to the cloud sql database (through the proxy) per message.
+# now the user and ai rows are looked up once per process, and both messages go in with a single
+# bulk_create, which on postgres is one INSERT ... RETURNING that hands back both message_ids.
+#
+# with CHAT_GROUP_COMMIT enabled, turns from many concurrent requests are collected for a few
+# milliseconds and written together in one transaction (group commit), so a burst of chats costs
+# a handful of inserts instead of one each.
+# the user messages also get a grammar check job, inserted in the same transaction.
+#
+# the messages are still posted as the local 'user' and 'ai' (get_principals), a turn posted by a logged in
+# user additionally makes that user a member of the chat (member_id), so the chat is in their inbox and search.
+
+_principals = None
+_principals_lock = threading.Lock()
+
+
+def get_principals():
+    # Get or create the User instances for the user and the AI
+    # i added this when i got errors trying to run the chat as a local user (with name 'user'),
+    # because I am not registerd in the user database.
+    # testing locally will always result in sender being user, so i put sender as user.
+    # later when I consider large scale user implementations, user will be replaced by the actual username.
+    # they never change, so they are only fetched the first time
+    global _principals
+    if _principals is None:
+        with _principals_lock:
+            if _principals is None:
+                # because i'm using django's default user model to store user details,
+                # i imported get_user_model() to enable easy access to the user model
+                User = get_user_model()
+                user, _ = User.objects.get_or_create(username='user')
+                ai, _ = User.objects.get_or_create(username='ai')
+                _principals = (user, ai)
+    return _principals
+
+
+def forget_principals():
+    global _principals
+    _principals = None
+
+
+def _turn_messages(chat, user_message_text, ai_message_text, user, ai):
+    user_message = Message(
+        chat_id=chat,
+        sender=user,
+        recipient=ai,
+        is_from_ai=False,
+        # user message posted by the frontend
+        message_text=user_message_text,
+        language='en',
+        timestamp=timezone.now()
+    )
+    ai_message = Message(
+        chat_id=chat,
+        sender=ai,
+        recipient=user,
+        is_from_ai=True,
+        # ai api response text
+        message_text=ai_message_text,
+        language='en',
+        timestamp=timezone.now()
+    )
+    return user_message, ai_message
+
+
+def _serialize_turn(user_message, ai_message, user, ai):
+    # the name has to be the SAME as the fetched chat history parameter names in the frontend js file
+    # orelse a lot of frontend functions will not work, because this is the jsonresponse that the
+    # frontend will get and it access each key by its exact name
+    return [
+        {
+            'message_id': user_message.message_id,
+            'sender__username': user.username,
+            'recipient__username': ai.username,
+            'message_text': user_message.message_text,
+            'timestamp': user_message.timestamp
+        },
+        {
+            'message_id': ai_message.message_id,
+            'sender__username': ai.username,
+            'recipient__username': user.username,
+            'message_text': ai_message.message_text,
+            'timestamp': ai_message.timestamp
+        }
+    ]
+
+
+def write_turns(turns):
+    """
+    Insert the messages of several (chat, user_message_text, ai_message_text, member_id) turns at once,
+    member_id being the logged in user who posted the turn (None when nobody is logged in).
+    Returns the serialized message pair of each turn, in the same order.
+    """
+    user, ai = get_principals()
+    pairs = [_turn_messages(chat, user_text, ai_text, user, ai) for chat, user_text, ai_text, _ in turns]
+    members = {(chat.chat_id, member_id) for chat, _, _, member_id in turns if member_id is not None}
+
+    try:
+        with transaction.atomic():
+            # one INSERT for every message of every turn, the ids come back through RETURNING
+            messages = Message.objects.bulk_create([message for pair in pairs for message in pair])
+            # grammar checking happens in the background (grammar.py), here it's just queued
+            grammar.enqueue([user_message for user_message, _ in pairs])
+            # last message and unread counts for the inbox (inbox.py), in the same transaction
+            new_members = inbox.ensure_memberships(
+                {(chat.chat_id, principal.pk) for chat, _, _, _ in turns for principal in (user, ai)} | members
+            )
+            # the member's own message of a turn isn't unread for them
+            inbox.record_turns(messages, posted_by=[(chat.chat_id, member_id) for chat, _, _, member_id in turns])
+    except IntegrityError:
+        # a cached chat or user row must have been deleted, look them up again next time
+        forget_principals()
+        inbox.forget_memberships()
+        for chat, _, _, _ in turns:
+            forget_chat(chat.chat_id)
+        raise
+    inbox.remember_memberships(new_members)
+
+    # committed, so the cached chat_history of each chat can be brought up to date
+    for chat, user_text, ai_text, _ in turns:
+        context_cache.record_turn(chat.chat_id, user_text, ai_text)
+
+    return [_serialize_turn(user_message, ai_message, user, ai) for user_message, ai_message in pairs]
+
+
+def save_turn(chat, user_message_text, ai_message_text, member_id=None):
+    return write_turns([(chat, user_message_text, ai_message_text, member_id)])[0]
+
+
+class GroupCommitter:
+    # one background thread that writes the queued turns in batches.
+    # a batch is closed after max_batch turns or max_wait seconds after its first turn,
+    # whichever comes first, so a lone request only waits max_wait extra
+    def __init__(self, max_batch=64, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, chat, user_message_text, ai_message_text, member_id=None):
+        future = Future()
+        self._ensure_started()
+        self._queue.put(((chat, user_message_text, ai_message_text, member_id), future))
+        return future
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='chat-group-commit', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._take(self._queue.get())]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._take(self._queue.get(timeout=remaining)))
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # this thread is the only one writing queued turns, it must not die with a batch
+                logger.exception('Group commit of %d turns failed', len(batch))
+                for _, future in batch:
+                    if future is not None and not future.done():
+                        future.set_exception(e)
+
+    def _take(self, item):
+        # a turn whose request went away (the awaiting task was cancelled, and its future with it) is still
+        # written, like save_turn finishing in its thread, there's just nobody to tell. once running,
+        # a future can't be cancelled anymore, so setting its result below can't fail
+        turn, future = item
+        return turn, future if future.set_running_or_notify_cancel() else None
+
+    def _commit(self, batch):
+        # this thread keeps its own connection, drop it if it went stale like a request would
+        close_old_connections()
+        try:
+            results = write_turns([turn for turn, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _resolve(batch[0][1], exception=e)
+                return
+            # one bad turn shouldn't fail everyone else's, retry them one at a time
+            logger.warning('Group commit of %d turns failed, writing them one by one: %s', len(batch), e)
+            for turn, future in batch:
+                try:
+                    result = write_turns([turn])[0]
+                except Exception as e:
+                    _resolve(future, exception=e)
+                else:
+                    _resolve(future, result)
+        else:
+            for (_, future), result in zip(batch, results):
+                _resolve(future, result)
+
+
+def _resolve(future, result=None, exception=None):
+    # future is None for a turn nobody waits on anymore
+    if future is None:
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)
+
+
+_committer = None
+_committer_lock = threading.Lock()
+
+
+def get_group_committer():
+    # None unless CHAT_GROUP_COMMIT['ENABLED']
+    global _committer
+    options = settings.CHAT_GROUP_COMMIT
+    if not options.get('ENABLED'):
+        return None
+    if _committer is None:
+        with _committer_lock:
+            if _committer is None:
+                _committer = GroupCommitter(
+                    max_batch=options.get('MAX_BATCH', 64),
+                    max_wait=options.get('MAX_WAIT_MS', 5) / 1000,
+                )
+    return _committer
+
+
+async def asave_turn(chat, user_message_text, ai_message_text, member_id=None):
+    # the async views call this. with group commit the turn is handed to the committer thread
+    # and awaited directly, otherwise it's a normal save_turn in the orm's thread
+    committer = get_group_committer()
+    if committer is not None:
+        return await asyncio.wrap_future(committer.submit(chat, user_message_text, ai_message_text, member_id))
+    return await sync_to_async(save_turn)(chat, user_message_text, ai_message_text, member_id)
@@ -4,6 +4,14 @@ class LoginConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'login'
 
+    def ready(self):
+        # new users go into the availability filters (availability.py) right away.
+        # absolute imports, the app is importable as login even though INSTALLED_APPS says backend.login
+        from django.contrib.auth import get_user_model
+        from django.db.models.signals import post_save
+        from login import availability
+        post_save.connect(availability.user_saved, sender=get_user_model(), dispatch_uid='username_filter_saved')
+
 # defines a subclass of AppConfig, called LoginConfig. 
 
 # AppConfig provides metadata for an application, to specify settings and behaviors for the application.
@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+from lang_app import clients, metrics
+from lang_app.instrumentation import external_call
+from lang_chat.completion_cache import CompletionCache
+
+logger = logging.getLogger(__name__)
+
+# the slow parts of login and registration, kept off the request thread.
+#
+# password hashing: PBKDF2 with django's default 600k iterations is a few hundred ms of cpu per login.
+# it runs in a small thread pool (hashlib releases the GIL while it hashes, so threads really run in
+# parallel, no process pool needed). the event loop only hands PASSWORD_HASHING_WORKERS hashes to the pool
+# at once, the rest wait on a semaphore in the loop, where a login whose client went away is simply
+# cancelled instead of still being hashed later.
+#
+# reCAPTCHA: verified through one keep-alive httpx.AsyncClient per event loop (like the cohere client in
+# lang_chat/llm.py) with a timeout, instead of a fresh blocking requests.post for every registration.
+# a token is good for one registration: concurrent submits of the same token share one verification, and only
+# the first of them gets a valid verdict, the token is then remembered as used (like a failed one) for
+# RECAPTCHA_CACHE_TTL seconds. valid verdicts themselves are never cached, so a token can't be replayed.
+# point RECAPTCHA_VERIFY_URL at a local fake server for tests and benchmarks.
+
+login_seconds = metrics.histogram('login_duration_seconds', 'Login requests, end to end', ['outcome'])
+hashing_seconds = metrics.histogram(
+    'password_hashing_seconds', 'Password hashing, including the wait for a pool thread', ['operation'],
+)
+recaptcha_seconds = metrics.histogram('recaptcha_verify_seconds', 'reCAPTCHA verification calls', ['result'])
+
+_pool = None
+_pool_lock = threading.Lock()
+_semaphores = weakref.WeakKeyDictionary()
+_recaptcha_cache = None
+
+
+def hashing_workers():
+    return settings.PASSWORD_HASHING_WORKERS or min(4, os.cpu_count() or 1)
+
+
+def get_hashing_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=hashing_workers(), thread_name_prefix='password-hashing')
+    return _pool
+
+
+def _hashing_semaphore():
+    # per loop, an asyncio.Semaphore belongs to the loop it's used on (wsgi runs a loop per async view)
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(hashing_workers())
+    return semaphore
+
+
+async def _in_pool(operation, fn, *args):
+    with hashing_seconds.time(operation=operation):
+        async with _hashing_semaphore():
+            return await asyncio.get_running_loop().run_in_executor(get_hashing_pool(), fn, *args)
+
+
+async def hash_password(password):
+    return await _in_pool('hash', make_password, password)
+
+
+def _find_user(email):
+    users = get_user_model()
+    try:
+        return users.objects.get(email=email)
+    except (users.DoesNotExist, users.MultipleObjectsReturned):
+        return None
+
+
+def _save_password(user, encoded):
+    user.password = encoded
+    user.save(update_fields=['password'])
+
+
+async def authenticate(email, password):
+    """The active user with this email and password, or None. Same checks as login.views.EmailBackend."""
+    if not email or password is None:
+        return None
+    user = await sync_to_async(_find_user)(email)
+    if user is None:
+        # hash anyway, so an unknown email takes as long as a wrong password (like django's ModelBackend)
+        await hash_password(password)
+        return None
+    if not await _in_pool('check', check_password, password, user.password):
+        return None
+    if not getattr(user, 'is_active', True):
+        return None
+    try:
+        must_update = identify_hasher(user.password).must_update(user.password)
+    except ValueError:
+        must_update = False
+    if must_update:
+        # what user.check_password does with its setter: rehash with the current iterations
+        await sync_to_async(_save_password)(user, await hash_password(password))
+    return user
+
+
+def make_recaptcha_client():
+    import httpx
+
+    return httpx.AsyncClient(
+        timeout=settings.RECAPTCHA_TIMEOUT,
+        limits=httpx.Limits(max_connections=settings.RECAPTCHA_MAX_CONNECTIONS, max_keepalive_connections=20),
+    )
+
+
+clients.register('recaptcha', make_recaptcha_client, per_loop=True)
+
+
+def get_recaptcha_client():
+    return clients.get('recaptcha')
+
+
+def get_recaptcha_cache():
+    global _recaptcha_cache
+    if _recaptcha_cache is None:
+        _recaptcha_cache = CompletionCache(max_entries=10000, ttl=settings.RECAPTCHA_CACHE_TTL)
+    return _recaptcha_cache
+
+
+async def _assess(token):
+    with external_call('recaptcha'):
+        response = await get_recaptcha_client().post(
+            settings.RECAPTCHA_VERIFY_URL,
+            json={'event': {'token': token, 'siteKey': settings.RECAPTCHA_SITE_KEY}},
+        )
+    response.raise_for_status()
+    response_data = response.json()
+    logger.info('reCAPTCHA response: %s', response_data)
+    return response_data.get('tokenProperties', {}).get('valid', False)
+
+
+async def verify_recaptcha(token):
+    """
+    Whether the token is valid and unused, it counts as used from then on.
+    False when the verifier can't be reached, those aren't cached.
+    """
+    if not token:
+        return False
+    import httpx  # loaded with the client, only registration needs it
+
+    key = hashlib.sha256(token.encode()).hexdigest()
+    started = time.perf_counter()
+    try:
+        # only failures are kept, a valid verdict is handed to the callers waiting on this call and that's it
+        valid = await get_recaptcha_cache().get_or_call(
+            key, lambda: _assess(token), cache_if=lambda valid: not valid,
+        )
+    except (httpx.HTTPError, ValueError) as e:
+        recaptcha_seconds.observe(time.perf_counter() - started, result='error')
+        logger.error('reCAPTCHA verification failed: %s', e)
+        return False
+    if valid and not get_recaptcha_cache().add(key, False):
+        # another request (a coalesced double submit) already used this token
+        recaptcha_seconds.observe(time.perf_counter() - started, result='reused')
+        return False
+    recaptcha_seconds.observe(time.perf_counter() - started, result='valid' if valid else 'invalid')
+    return valid
+
+
+def _save_new_user(username, email, encoded_password):
+    if not username:
+        raise ValueError('The given username must be set')
+    users = get_user_model()
+    user = users(
+        username=users.normalize_username(username),
+        email=users.objects.normalize_email(email),
+        password=encoded_password,
+    )
+    user.save()
+    return user
+
+
+async def create_user(username, email, password):
+    """create_user with the hashing done in the pool."""
+    return await sync_to_async(_save_new_user)(username, email, await hash_password(password))
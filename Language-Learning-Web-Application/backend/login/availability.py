@@ -0,0 +1,180 @@
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connections
+from lang_app import metrics
+from lang_app.db_router import read_replica
+
+logger = logging.getLogger(__name__)
+
+# username/email availability for the register form.
+# the form asks on every keystroke, and almost every one of those names is free. every process keeps a
+# bloom filter of the taken usernames and emails: a name the filter has never seen is free for sure and is
+# answered without a query, only a "probably taken" goes to the database to make sure (about 1% of the free
+# names are false positives at USERNAME_FILTER_ERROR_RATE).
+# the filters are loaded on first use, get the names of new users from post_save (connected in apps.py)
+# and are rebuilt every USERNAME_FILTER_MAX_AGE seconds for the registrations other processes took.
+# the rebuild runs in a background thread, requests keep getting answers from the old filters until the new
+# ones replace them, only the very first load is waited for.
+# a name registered in another process since can look free for that long, the unique constraint
+# still stops the actual registration.
+
+FIELDS = ('username', 'email')
+
+checks = metrics.counter(
+    'username_availability_checks_total', 'Availability checks, by how they were answered', ['field', 'answer'],
+)
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(capacity, 1)
+        # the usual sizing: m = -n ln p / (ln 2)^2 bits and k = m/n ln 2 hashes
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / self.capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value):
+        # two halves of one blake2b digest, combined into k positions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        a = int.from_bytes(digest[:8], 'little')
+        b = int.from_bytes(digest[8:], 'little') | 1
+        return [(a + i * b) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+def normalize(field, value):
+    # emails are matched case-insensitively, like the database check below
+    return value.lower() if field == 'email' else value
+
+
+class TakenNames:
+    def __init__(self):
+        users = get_user_model()
+        with read_replica():
+            count = users.objects.count()
+        # room to grow, a filter over capacity gets more false positives, not wrong answers
+        capacity = max(count * 2, settings.USERNAME_FILTER_CAPACITY)
+        self.filters = {field: BloomFilter(capacity, settings.USERNAME_FILTER_ERROR_RATE) for field in FIELDS}
+        rows = users.objects.order_by().values_list(*FIELDS)
+        with read_replica():
+            alias = rows.db
+        for username, email in rows.using(alias).iterator(chunk_size=5000):
+            self.add(username, email)
+        self.built_at = time.monotonic()
+
+    def add(self, username, email):
+        if username:
+            self.filters['username'].add(normalize('username', username))
+        if email:
+            self.filters['email'].add(normalize('email', email))
+
+    def might_be_taken(self, field, value):
+        return normalize(field, value) in self.filters[field]
+
+    def over_capacity(self):
+        return any(bloom.count > bloom.capacity for bloom in self.filters.values())
+
+
+_names = None
+_names_lock = threading.Lock()
+# names saved while a rebuild runs (the new filters may have read the table before they were there),
+# None when no rebuild is running
+_saved_while_rebuilding = None
+_rebuild_lock = threading.Lock()
+
+
+def _build():
+    started = time.perf_counter()
+    names = TakenNames()
+    logger.info('Loaded the username filters in %.2fs', time.perf_counter() - started)
+    return names
+
+
+def _rebuild(old):
+    global _names, _saved_while_rebuilding
+    try:
+        names = _build()
+    except Exception:
+        logger.exception('Rebuilding the username filters failed, keeping the old ones')
+        names = None
+        # try again in USERNAME_FILTER_MAX_AGE, not on the next request
+        old.built_at = time.monotonic()
+    finally:
+        # this thread's own database connections, nothing else closes them
+        connections.close_all()
+    with _rebuild_lock:
+        if names is not None:
+            for username, email in _saved_while_rebuilding:
+                names.add(username, email)
+            _names = names
+        _saved_while_rebuilding = None
+
+
+def is_stale(names):
+    return time.monotonic() - names.built_at > settings.USERNAME_FILTER_MAX_AGE or names.over_capacity()
+
+
+def get_taken_names():
+    global _names, _saved_while_rebuilding
+    names = _names
+    if names is None:
+        # nothing to answer from yet, the first requests wait for the load
+        with _names_lock:
+            if _names is None:
+                _names = _build()
+            names = _names
+    elif is_stale(names):
+        with _rebuild_lock:
+            start = _saved_while_rebuilding is None
+            if start:
+                _saved_while_rebuilding = []
+        if start:
+            threading.Thread(target=_rebuild, args=(names,), name='username-filter-rebuild', daemon=True).start()
+    return names
+
+
+def is_taken(field, value, replica=False):
+    """
+    Whether a user already has this username or email. A value the filter never saw is answered without
+    the database. replica=True lets the check read a replica (the form's live check), registration itself
+    checks the primary.
+    """
+    if not value:
+        return False
+    if not get_taken_names().might_be_taken(field, value):
+        checks.inc(field=field, answer='filter')
+        return False
+    users = get_user_model().objects.all()
+    lookup = {f'{field}__iexact' if field == 'email' else field: value}
+    if replica:
+        with read_replica():
+            taken = users.filter(**lookup).exists()
+    else:
+        taken = users.filter(**lookup).exists()
+    checks.inc(field=field, answer='taken' if taken else 'false_positive')
+    return taken
+
+
+def user_saved(sender, instance, **kwargs):
+    # only touches filters that are already loaded, unloaded ones read the row anyway
+    username, email = getattr(instance, 'username', None), getattr(instance, 'email', None)
+    with _rebuild_lock:
+        if _saved_while_rebuilding is not None:
+            _saved_while_rebuilding.append((username, email))
+    names = _names
+    if names is not None:
+        names.add(username, email)
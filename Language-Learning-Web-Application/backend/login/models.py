@@ -19,6 +19,41 @@ from django.utils import timezone
 # due to the many requirements it needs, i probably will migrate to this database later in the development stage
 # its just me, a singular localhost user on the default django auth user table anyways.
 
+# Custom User Manager
+# it has to come before User, which uses it as its manager (it was below it, a NameError on import)
+class CustomUserManager(BaseUserManager):
+    def create_user(self, username, email, password=None):
+        if not email:
+            raise ValueError('Users must have an email address')
+        if not username:
+            raise ValueError('Users must have a username')
+
+        if self.model.objects.filter(email=email).exists():
+            raise ValueError('A user with this email already exists')
+        if self.model.objects.filter(username=username).exists():
+            raise ValueError('A user with this username already exists')
+
+        user = self.model(
+            username=username,
+            email=self.normalize_email(email),
+        )
+
+        user.set_password(password)
+        user.save(using=self._db)
+        return user
+
+    def create_superuser(self, username, email, password):
+        user = self.create_user(
+            username,
+            email,
+            password=password,
+        )
+        user.is_superuser = True
+        user.is_staff = True
+        user.is_active = True
+        user.save(using=self._db)
+        return user
+
 # Users
 class User(AbstractBaseUser):
     user_id = models.AutoField(primary_key=True)
@@ -53,37 +88,3 @@ class User(AbstractBaseUser):
     
     class Meta:
         db_table = 'User'  # Use the exact table name
-
-# Custom User Manager
-class CustomUserManager(BaseUserManager):
-    def create_user(self, username, email, password=None):
-        if not email:
-            raise ValueError('Users must have an email address')
-        if not username:
-            raise ValueError('Users must have a username')
-
-        if self.model.objects.filter(email=email).exists():
-            raise ValueError('A user with this email already exists')
-        if self.model.objects.filter(username=username).exists():
-            raise ValueError('A user with this username already exists')
-
-        user = self.model(
-            username=username,
-            email=self.normalize_email(email),
-        )
-
-        user.set_password(password)
-        user.save(using=self._db)
-        return user
-
-    def create_superuser(self, username, email, password):
-        user = self.create_user(
-            username,
-            email,
-            password=password,
-        )
-        user.is_superuser = True
-        user.is_staff = True
-        user.is_active = True
-        user.save(using=self._db)
-        return user
\ No newline at end of file
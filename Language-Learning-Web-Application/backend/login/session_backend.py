@@ -0,0 +1,152 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBStore
+from django.core.cache import caches
+from django.db import close_old_connections
+from lang_app import metrics
+
+logger = logging.getLogger(__name__)
+
+# sessions kept in the cache, written to the database behind the request (SESSION_ENGINE = 'login.session_backend').
+# django's cached_db reads from the cache but still writes every change to the session table before the
+# response goes out. here a changed session goes to the cache right away and is queued, and a background
+# thread writes the queued sessions every SESSION_WRITE_BEHIND_INTERVAL seconds, all of them with one UPDATE.
+# a session saved again before its write goes out is only written once. one that is gone from the table by
+# then (logged out through another process) is dropped, and taken out of the cache, not written back.
+# reads go cache -> not yet written queue -> database, so a session survives the cache being flushed or
+# restarted (SESSION_CACHE_ALIAS, local memory or redis). what's lost when the process dies is at most
+# the last interval of changes to sessions that already existed, new sessions are always written right away
+# (the key has to be claimed in the database so two sessions can't end up with the same one).
+
+sessions_written = metrics.counter('session_write_behind_total', 'Sessions written to the database behind requests')
+flush_seconds = metrics.histogram('session_write_behind_flush_seconds', 'One write behind flush of the sessions')
+
+
+class SessionWriter:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._pending = {}  # session_key -> Session instance, the latest version wins
+        self._lock = threading.Lock()
+        # held for a whole flush, see discard
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, session):
+        with self._lock:
+            self._pending[session.session_key] = session
+        self._ensure_started()
+
+    def pending(self, session_key):
+        with self._lock:
+            return self._pending.get(session_key)
+
+    def discard(self, session_key):
+        # waits out a flush in progress, otherwise a session that is being deleted (logout) could be
+        # written back by it right after the delete
+        with self._flush_lock, self._lock:
+            self._pending.pop(session_key, None)
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='session-write-behind', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not write the sessions behind')
+
+    def flush(self):
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        # this thread keeps its own connection, drop it if it went stale like a request would
+        close_old_connections()
+        model = next(iter(batch.values())).__class__
+        try:
+            with flush_seconds.time():
+                # only queued by save() for keys that were already in the table, so an update is enough.
+                # an upsert would bring back a session deleted since it was queued
+                existing = set(
+                    model.objects.filter(session_key__in=list(batch)).values_list('session_key', flat=True)
+                )
+                model.objects.bulk_update(
+                    [session for session_key, session in batch.items() if session_key in existing],
+                    ['session_data', 'expire_date'],
+                )
+        except Exception:
+            # put them back for the next round, unless a newer version was queued meanwhile
+            with self._lock:
+                for session_key, session in batch.items():
+                    self._pending.setdefault(session_key, session)
+            raise
+        deleted = [session_key for session_key in batch if session_key not in existing]
+        if deleted:
+            caches[settings.SESSION_CACHE_ALIAS].delete_many(
+                [SessionStore.cache_key_prefix + session_key for session_key in deleted]
+            )
+        sessions_written.inc(len(existing))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = SessionWriter(settings.SESSION_WRITE_BEHIND_INTERVAL)
+    return _writer
+
+
+class SessionStore(CachedDBStore):
+    cache_key_prefix = 'login.session_backend'
+
+    def load(self):
+        try:
+            data = self._cache.get(self.cache_key)
+        except Exception:
+            data = None
+        if data is not None:
+            return data
+        # the cache lost it (eviction, restart), the queue or the table still has it
+        pending = get_writer().pending(self.session_key)
+        if pending is not None:
+            data = self.decode(pending.session_data)
+            self._cache.set(self.cache_key, data, self.get_expiry_age(expiry=pending.expire_date))
+            return data
+        return super().load()
+
+    def exists(self, session_key):
+        return bool(session_key and get_writer().pending(session_key)) or super().exists(session_key)
+
+    def save(self, must_create=False):
+        if must_create or self.session_key is None:
+            super().save(must_create)
+            return
+        data = self._get_session()
+        self._cache.set(self.cache_key, data, self.get_expiry_age())
+        get_writer().enqueue(self.create_model_instance(data))
+
+    def delete(self, session_key=None):
+        key = session_key or self.session_key
+        if key is not None:
+            get_writer().discard(key)
+        super().delete(session_key)
@@ -0,0 +1,28 @@
+from django.contrib.sessions.models import Session
+from django.test import TransactionTestCase
+
+from .session_backend import SessionStore, get_writer
+
+
+class SessionWriteBehindTests(TransactionTestCase):
+    def setUp(self):
+        self.addCleanup(get_writer().flush)
+        self.session = SessionStore()
+        self.session['step'] = 1
+        self.session.create()
+
+    def test_a_change_is_written_behind(self):
+        self.session['step'] = 2
+        self.session.save()
+        get_writer().flush()
+        stored = Session.objects.get(session_key=self.session.session_key)
+        self.assertEqual(SessionStore().decode(stored.session_data)['step'], 2)
+
+    def test_a_session_deleted_meanwhile_is_not_written_back(self):
+        self.session['step'] = 2
+        self.session.save()
+        # logged out through another process: its row and its cache entry are gone, this one's queue still has it
+        Session.objects.filter(session_key=self.session.session_key).delete()
+        get_writer().flush()
+        self.assertFalse(Session.objects.filter(session_key=self.session.session_key).exists())
+        self.assertEqual(SessionStore(self.session.session_key).load(), {})
@@ -0,0 +1,54 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core import signing
+
+# stateless api tokens and the "who is asking" helper for the hot paths.
+# the login view used to hand out default_token_generator tokens, which are password reset tokens and
+# can't be checked without loading the user. these are the user's id and username signed with
+# SECRET_KEY and a timestamp, checked with nothing but an hmac: no session, no user row.
+# the other side of that is they can't be revoked one by one, they run out after API_TOKEN_MAX_AGE
+# (rotating SECRET_KEY ends all of them).
+
+SALT = 'login.tokens'
+# put in the session by the login view, so a session principal doesn't need the user row either
+SESSION_USERNAME_KEY = '_auth_username'
+
+Principal = namedtuple('Principal', ['user_id', 'username'])
+
+
+def make_token(user):
+    return signing.TimestampSigner(salt=SALT).sign_object({'id': user.pk, 'username': user.get_username()})
+
+
+def read_token(token, max_age=None):
+    """The Principal of a token, None if it's forged, broken or expired."""
+    try:
+        payload = signing.TimestampSigner(salt=SALT).unsign_object(
+            token, max_age=settings.API_TOKEN_MAX_AGE if max_age is None else max_age,
+        )
+        return Principal(int(payload['id']), payload['username'])
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+def request_principal(request):
+    """
+    Who is making the request, or None: an "Authorization: Bearer <token>" header, else the session.
+    Neither touches the database (the session comes out of the cache, see session_backend.py), only a
+    session from before SESSION_USERNAME_KEY existed falls back to request.user.
+    """
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        return read_token(authorization[len('Bearer '):].strip())
+    session = getattr(request, 'session', None)
+    if session is None or SESSION_KEY not in session:
+        return None
+    username = session.get(SESSION_USERNAME_KEY)
+    if username is None:
+        user = request.user
+        if not user.is_authenticated:
+            return None
+        return Principal(user.pk, user.get_username())
+    return Principal(int(session[SESSION_KEY]), username)
@@ -2,16 +2,17 @@ from django.contrib.auth import login, get_user_model
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.contrib.auth.backends import ModelBackend
-from django.contrib.auth.models import User
 from django.http import JsonResponse
 from django.views import View
 from django.db import IntegrityError
-from rest_framework.exceptions import ValidationError
-from django.contrib.auth.tokens import default_token_generator
-import requests
+from django.core.exceptions import ValidationError
+import time
+from asgiref.sync import sync_to_async
 import json
 import logging
 
+from . import auth_pipeline, availability, tokens
+
 
 logger = logging.getLogger(__name__)
 # peppered a lot of logger lines because i needed lots of debugging
@@ -36,40 +37,56 @@ class EmailBackend(ModelBackend):
         except UserModel.DoesNotExist:
             return None
         
+def start_session(request, user):
+    login(request, user, backend='login.views.EmailBackend')
+    # so tokens.request_principal can answer from the session alone
+    request.session[tokens.SESSION_USERNAME_KEY] = user.get_username()
+
+# async since the password check moved to a thread pool (auth_pipeline.py), a burst of logins no longer
+# holds one worker per PBKDF2 hash. EmailBackend above is still what the session remembers
 @method_decorator(csrf_exempt, name='dispatch')
 class UserLoginView(View):
-    def post(self, request):
+    async def post(self, request):
+        started = time.perf_counter()
+        outcome = 'error'
         try:
             data = json.loads(request.body)
             email = data.get('email')
             password = data.get('password')
 
-            logger.info(f'Authenticating user with email: {email} and password: {password}')
+            logger.info('Authenticating user with email: %s', email)
             
-            backend = EmailBackend()
-            user = backend.authenticate(request, username=email, password=password)
+            user = await auth_pipeline.authenticate(email, password)
 
-            logger.info(f'Authenticated user: {user}')
+            logger.info('Authenticated user: %s', user)
 
             if user is not None:
-                login(request, user, backend='login.views.EmailBackend')
-                token = default_token_generator.make_token(user)
+                await sync_to_async(start_session)(request, user)
+                # signed and stateless, checked without the database (tokens.py)
+                token = tokens.make_token(user)
+                outcome = 'success'
                 return JsonResponse({'status': 'success', 'token': token})
             else:
+                outcome = 'invalid'
                 return JsonResponse({'status': 'error', 'message': 'Invalid email or password'}, status=401)
         except Exception as e:
             return JsonResponse({'status': 'error', 'message': str(e)}, status=500)
+        finally:
+            auth_pipeline.login_seconds.observe(time.perf_counter() - started, outcome=outcome)
 
 @method_decorator(csrf_exempt, name='dispatch')
 class UserRegisterView(View):
     
     def check_username_exists(self, username):
-        return User.objects.filter(username=username).exists()
+        # answered by the availability filters (availability.py), the database is only asked about names
+        # that are probably taken. create_user below doesn't check again, the unique constraint backs this up
+        return availability.is_taken('username', username)
     
-    def post(self, request, *args, **kwargs):
+    async def post(self, request, *args, **kwargs):
         
         data = json.loads(request.body)
-        logger.info('Received data: %s', data)
+        # not the whole body, it has the password in it
+        logger.info('Registration attempt for username: %s', data.get('username'))
         
         username = data.get('username')
         email = data.get('email')
@@ -77,15 +94,16 @@ class UserRegisterView(View):
         recaptcha_token = data.get('recaptchaToken')
 
        # Check if the reCAPTCHA is valid
-        if not self.verify_recaptcha(recaptcha_token):
+        if not await self.verify_recaptcha(recaptcha_token):
             return JsonResponse({'error': 'Invalid reCAPTCHA.'}, status=400)
         
         # Check if the username already exists
-        if self.check_username_exists(username):
+        if await sync_to_async(self.check_username_exists)(username):
             return JsonResponse({'error': 'This username is already taken.'}, status=400)
 
         try:
-            user = User.objects.create_user(username, email, password)
+            # hashed in the pool, see auth_pipeline.py
+            user = await auth_pipeline.create_user(username, email, password)
             # If the user was created successfully, return a success response
             return JsonResponse({'message': 'Registration successful'}, status=201)
         except IntegrityError as e:
@@ -99,32 +117,18 @@ class UserRegisterView(View):
             return JsonResponse({'error': 'Registration failed.'}, status=400)
 
     
-    def verify_recaptcha(self, token):
-        recaptcha_verify_url = f'https://recaptchaenterprise.googleapis.com/v1/projects/lang-aide/assessments?key=my-recaptcha-key'
-        response = requests.post(
-            recaptcha_verify_url,
-            json={
-                'event': {
-                    'token': token,
-                    'siteKey': 'my-recaptcha-sitekey',
-                }
-            },
-            headers={
-                'Content-Type': 'application/json'
-            }
-        )
-        response_data = response.json()
-        logger.info('reCAPTCHA response: %s', response_data)
-        
-        return response_data.get('tokenProperties', {}).get('valid', False)
+    async def verify_recaptcha(self, token):
+        # pooled keep-alive client with a timeout and a short cache, see auth_pipeline.py
+        return await auth_pipeline.verify_recaptcha(token)
     
-    def get(self, request, *args, **kwargs):
-        # This method will handle the username availability check
-        username = request.GET.get('username')
-        
-        if User.objects.filter(username=username).exists():
-            return JsonResponse({'isTaken': True})
+    async def get(self, request, *args, **kwargs):
+        # This method will handle the username availability check (?username=, or ?email=)
+        # asked on every keystroke of the register form. most names are answered by the filters without a query,
+        # the rest go to a replica. the post still checks against the primary
+        if 'email' in request.GET and 'username' not in request.GET:
+            taken = await sync_to_async(availability.is_taken)('email', request.GET.get('email'), replica=True)
         else:
-            return JsonResponse({'isTaken': False})
+            taken = await sync_to_async(availability.is_taken)('username', request.GET.get('username'), replica=True)
+        return JsonResponse({'isTaken': taken})
 
 
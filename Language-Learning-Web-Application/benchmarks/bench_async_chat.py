@@ -0,0 +1,78 @@
+"""
+Throughput of the blocking cohere call vs the async one in lang_chat/llm.py.
+
+Both sides send the same number of chat requests to a local fake cohere server (fake_cohere.py).
+- sync:  cohere.Client.chat from a fixed pool of threads, the same as the old view under N wsgi workers
+- async: lang_chat.llm.chat on one event loop, the same as the async view under asgi
+
+    python benchmarks/bench_async_chat.py --requests 400 --latency 1.0 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cohere
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from fake_cohere import start_server  # noqa: E402
+
+
+def run_sync(url, requests, workers):
+    client = cohere.Client('fake-key', base_url=url)
+
+    def one_chat(i):
+        return client.chat(model='command-light', message=f'hello {i}', chat_history=[]).text
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(one_chat, range(requests)))
+    return time.perf_counter() - started
+
+
+def run_async(requests):
+    from lang_chat import llm
+
+    async def main():
+        started = time.perf_counter()
+        await asyncio.gather(*(llm.chat(f'hello {i}', []) for i in range(requests)))
+        return time.perf_counter() - started
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=1.0, help='fake completion time in seconds')
+    parser.add_argument('--workers', type=int, default=4, help='sync worker count (wsgi workers)')
+    parser.add_argument('--max-concurrency', type=int, default=200, help='COHERE_MAX_CONCURRENT_REQUESTS for the async run')
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency)
+    settings.configure(
+        COHERE_API_KEY='fake-key',
+        COHERE_BASE_URL=server.url,
+        COHERE_TIMEOUT=args.latency * 10 + 30,
+        COHERE_MAX_CONCURRENT_REQUESTS=args.max_concurrency,
+        COHERE_COMPLETION_CACHE_SIZE=0,
+        COHERE_COMPLETION_CACHE_TTL=0,
+        # everything queues behind the concurrency cap, nothing is shed
+        CHAT_UPSTREAM={'MAX_QUEUE': args.requests, 'MAX_WAIT': args.latency * 10 + 30},
+    )
+
+    sync_seconds = run_sync(server.url, args.requests, args.workers)
+    async_seconds = run_async(args.requests)
+    server.shutdown()
+
+    print(f'{args.requests} chats, {args.latency}s fake completion time')
+    print(f'sync  ({args.workers} workers): {sync_seconds:8.2f}s  {args.requests / sync_seconds:8.1f} chats/s')
+    print(f'async (limit {args.max_concurrency}):   {async_seconds:8.2f}s  {args.requests / async_seconds:8.1f} chats/s')
+
+
+if __name__ == '__main__':
+    main()
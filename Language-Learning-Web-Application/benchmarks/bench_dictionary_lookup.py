@@ -0,0 +1,122 @@
+"""
+Dictionary typeahead latency (lang_chat/lookup.py) on a large made up dictionary.
+
+Builds the in-memory index from --entries generated words (no database needed), then times
+prefix lookups (the first few letters of a word) and fuzzy lookups (a word with one typo)
+and checks the p99 against --budget-ms.
+
+    python benchmarks/bench_dictionary_lookup.py --entries 100000 --queries 2000
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+# english-ish words: onset + vowel + coda syllables and a suffix. the real english vocabulary has 10k+ distinct
+# trigrams, a made up one with too few syllables has a couple thousand, each shared by far more words
+ONSETS = ('', 'b', 'bl', 'br', 'c', 'ch', 'cl', 'cr', 'd', 'dr', 'f', 'fl', 'fr', 'g', 'gl', 'gr', 'h', 'j', 'k',
+          'l', 'm', 'n', 'p', 'ph', 'pl', 'pr', 'qu', 'r', 's', 'sc', 'sh', 'sk', 'sl', 'sm', 'sn', 'sp', 'st',
+          'str', 'sw', 't', 'th', 'tr', 'v', 'w', 'wh', 'wr', 'y', 'z')
+VOWELS = ('a', 'e', 'i', 'o', 'u', 'y', 'ai', 'ea', 'ee', 'ie', 'oa', 'oo', 'ou', 'au', 'oi')
+CODAS = ('', '', 'b', 'ck', 'd', 'ft', 'g', 'ght', 'l', 'ld', 'll', 'm', 'mp', 'n', 'nd', 'ng', 'nk', 'nt', 'p',
+         'r', 'rd', 'rk', 'rm', 'rn', 'rt', 's', 'sh', 'sk', 'ss', 'st', 't', 'th', 'tch', 'x')
+SUFFIXES = ('', '', '', 's', 'ed', 'ing', 'er', 'ly', 'tion', 'ness', 'able', 'ment', 'ful', 'ous')
+
+
+def make_words(count, rng):
+    words = set()
+    while len(words) < count:
+        syllables = (rng.choice(ONSETS) + rng.choice(VOWELS) + rng.choice(CODAS) for _ in range(rng.randint(1, 3)))
+        words.add(''.join(syllables) + rng.choice(SUFFIXES))
+    return sorted(words)
+
+
+def typo(word, rng):
+    i = rng.randrange(len(word))
+    kind = rng.choice(('swap', 'drop', 'replace'))
+    if kind == 'swap' and i < len(word) - 1:
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    if kind == 'drop' and len(word) > 3:
+        return word[:i] + word[i + 1:]
+    return word[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[i + 1:]
+
+
+def timed(fn, queries):
+    times = []
+    for query in queries:
+        started = time.perf_counter()
+        fn(query)
+        times.append((time.perf_counter() - started) * 1000)
+    return times
+
+
+def report(name, times, budget):
+    times = sorted(times)
+    p99 = times[int(len(times) * 0.99) - 1]
+    verdict = 'ok' if p99 <= budget else 'OVER BUDGET'
+    print(
+        f'{name:8} p50 {statistics.median(times):6.3f}ms  p95 {times[int(len(times) * 0.95) - 1]:6.3f}ms  '
+        f'p99 {p99:6.3f}ms  max {times[-1]:6.3f}ms  {verdict}'
+    )
+    return p99 <= budget
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--budget-ms', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'lang_chat'],
+        DICTIONARY_INDEX_MAX_AGE=float('inf'),
+    )
+    django.setup()
+    from lang_chat import lookup
+
+    rng = random.Random(args.seed)
+    words = make_words(args.entries, rng)
+    rows = [
+        (i, word, None, ''.join(chr(rng.randint(0x4e00, 0x9fa5)) for _ in range(rng.randint(1, 3))))
+        for i, word in enumerate(words, 1)
+    ]
+
+    started = time.perf_counter()
+    index = lookup.DictionaryIndex(rows)
+    print(f'built the index of {len(index)} entries in {time.perf_counter() - started:.2f}s')
+    # lookup() uses the process wide index, this one stands in for the database
+    lookup._index = index
+
+    samples = [rng.choice(words) for _ in range(args.queries)]
+    prefixes = [word[:rng.randint(1, min(5, len(word)))] for word in samples]
+    typos = [typo(word, rng) for word in samples]
+
+    ok = all([
+        report('prefix', timed(lambda q: lookup.lookup(q, mode='prefix'), prefixes), args.budget_ms),
+        report('fuzzy', timed(lambda q: lookup.lookup(q, mode='fuzzy'), typos), args.budget_ms),
+        report('auto', timed(lambda q: lookup.lookup(q, mode='auto'), typos), args.budget_ms),
+    ])
+
+    found = sum(1 for word, query in zip(samples, typos) if word in {
+        result['english_word'] for result in lookup.lookup(query, mode='fuzzy')
+    })
+    print(f'the misspelled word was in the fuzzy results {found / len(samples):.0%} of the time')
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.put((args.entries + i + 1, f'zz{words[i]}', None, '新'))
+    print(f'incremental update {(time.perf_counter() - started) * 1000 / 1000:.3f}ms per entry')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
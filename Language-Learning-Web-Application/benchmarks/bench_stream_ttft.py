@@ -0,0 +1,72 @@
+"""
+Time to first token: waiting for the whole reply (llm.chat) vs streaming it (llm.chat_stream).
+
+Runs against a local fake cohere server (fake_cohere.py), so the numbers only depend on
+--latency (whole reply) and --first-token-latency.
+
+    python benchmarks/bench_stream_ttft.py --requests 50 --latency 2.0 --first-token-latency 0.3
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+from django.conf import settings
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
+
+from fake_cohere import start_server  # noqa: E402
+
+
+async def first_text_full(llm, i):
+    started = time.perf_counter()
+    await llm.chat(f'hello {i}', [])
+    return time.perf_counter() - started
+
+
+async def first_text_streamed(llm, i):
+    started = time.perf_counter()
+    first = None
+    async for _ in llm.chat_stream(f'hello {i}', []):
+        if first is None:
+            first = time.perf_counter() - started
+    return first
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=2.0)
+    parser.add_argument('--first-token-latency', type=float, default=0.3)
+    args = parser.parse_args()
+
+    server = start_server(latency=args.latency, first_token_latency=args.first_token_latency)
+    settings.configure(
+        COHERE_API_KEY='fake-key',
+        COHERE_BASE_URL=server.url,
+        COHERE_TIMEOUT=args.latency * 10 + 30,
+        COHERE_MAX_CONCURRENT_REQUESTS=args.requests,
+        COHERE_COMPLETION_CACHE_SIZE=0,
+        COHERE_COMPLETION_CACHE_TTL=0,
+        # everything queues behind the concurrency cap, nothing is shed
+        CHAT_UPSTREAM={'MAX_QUEUE': args.requests, 'MAX_WAIT': args.latency * 10 + 30},
+    )
+    from lang_chat import llm
+
+    async def run():
+        full = await asyncio.gather(*(first_text_full(llm, i) for i in range(args.requests)))
+        streamed = await asyncio.gather(*(first_text_streamed(llm, i) for i in range(args.requests)))
+        return full, streamed
+
+    full, streamed = asyncio.run(run())
+    server.shutdown()
+
+    print(f'{args.requests} chats, reply takes {args.latency}s, first token after {args.first_token_latency}s')
+    print(f'whole reply   p50 {statistics.median(full):6.3f}s  max {max(full):6.3f}s')
+    print(f'streamed      p50 {statistics.median(streamed):6.3f}s  max {max(streamed):6.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+A tiny stand-in for the Cohere chat api, for benchmarks and local testing.
+
+It answers POST /v1/chat after a configurable delay, so the app (or the benchmarks)
+can be pointed at it with COHERE_BASE_URL=http://127.0.0.1:<port> instead of paying for real completions.
+Streaming requests ("stream": true) get the first word after --first-token-latency
+and the rest spread out until --latency, like a real generation.
+
+    python benchmarks/fake_cohere.py --port 8010 --latency 1.5 --first-token-latency 0.2
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeCohereServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 refuses connections as soon as a burst of chats comes in
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=1.0, first_token_latency=0.2):
+        super().__init__(address, FakeCohereHandler)
+        self.latency = latency
+        self.first_token_latency = min(first_token_latency, latency)
+        self.requests_served = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count_request(self):
+        with self._lock:
+            self.requests_served += 1
+
+
+class FakeCohereHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # keep the benchmark output readable
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat'):
+            self.send_error(404)
+            return
+
+        self.server.count_request()
+        text = f"Fake reply to: {body.get('message', '')}"
+        if body.get('stream'):
+            self._stream_reply(text)
+            return
+
+        time.sleep(self.server.latency)
+        self._send_json(self._full_response(text))
+
+    def _full_response(self, text):
+        return {
+            'response_id': str(uuid.uuid4()),
+            'generation_id': str(uuid.uuid4()),
+            'text': text,
+            'finish_reason': 'COMPLETE',
+            'chat_history': [],
+            'meta': {'api_version': {'version': '1'}},
+        }
+
+    def _stream_reply(self, text):
+        # cohere streams one json event per line
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/stream+json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        words = text.split(' ')
+        self._write_chunk({'is_finished': False, 'event_type': 'stream-start', 'generation_id': str(uuid.uuid4())})
+        time.sleep(self.server.first_token_latency)
+        gap = (self.server.latency - self.server.first_token_latency) / max(len(words) - 1, 1)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(gap)
+            self._write_chunk({
+                'is_finished': False,
+                'event_type': 'text-generation',
+                'text': word if i == 0 else ' ' + word,
+            })
+        self._write_chunk({
+            'is_finished': True,
+            'event_type': 'stream-end',
+            'finish_reason': 'COMPLETE',
+            'response': self._full_response(text),
+        })
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, event):
+        line = json.dumps(event).encode() + b'\n'
+        self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(host='127.0.0.1', port=0, latency=1.0, first_token_latency=0.2):
+    # port 0 picks a free port, read it back from server.url
+    server = FakeCohereServer((host, port), latency=latency, first_token_latency=first_token_latency)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--latency', type=float, default=1.0, help='seconds to wait before answering')
+    parser.add_argument('--first-token-latency', type=float, default=0.2, help='seconds before the first streamed word')
+    args = parser.parse_args()
+
+    server = FakeCohereServer((args.host, args.port), latency=args.latency, first_token_latency=args.first_token_latency)
+    print(f'fake cohere listening on {server.url} (latency {args.latency}s)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+A tiny stand-in for the reCAPTCHA Enterprise assessments api, for benchmarks and local testing.
+
+It answers POST /assessments after a configurable delay, so the register view can be pointed at it with
+RECAPTCHA_VERIFY_URL=http://127.0.0.1:<port>/assessments. Every token is valid except "invalid".
+
+    python benchmarks/fake_recaptcha.py --port 8011 --latency 0.1
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeRecaptchaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latency=0.1):
+        super().__init__(address, FakeRecaptchaHandler)
+        self.latency = latency
+        self.requests_served = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/assessments'
+
+    def count_request(self):
+        with self._lock:
+            self.requests_served += 1
+
+
+class FakeRecaptchaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.split('?')[0].rstrip('/').endswith('/assessments'):
+            self.send_error(404)
+            return
+
+        self.server.count_request()
+        time.sleep(self.server.latency)
+        token = body.get('event', {}).get('token')
+        data = json.dumps({
+            'tokenProperties': {'valid': bool(token) and token != 'invalid', 'action': 'register'},
+            'riskAnalysis': {'score': 0.9},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.1):
+    # port 0 picks a free port, read it back from server.url
+    server = FakeRecaptchaServer((host, port), latency=latency)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8011)
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds to wait before answering')
+    args = parser.parse_args()
+
+    server = FakeRecaptchaServer((args.host, args.port), latency=args.latency)
+    print(f'fake recaptcha listening on {server.url} (latency {args.latency}s)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
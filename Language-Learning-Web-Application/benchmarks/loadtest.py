@@ -0,0 +1,404 @@
+"""
+Load test of the live endpoints: chat history (ChatView GET), a chat turn (ChatView POST), login and register.
+
+run: boots the app with settings_bench.py (sqlite by default, BENCH_DATABASE_URL=postgres://... for postgres),
+against a fake cohere (fake_cohere.py) and a fake reCAPTCHA (fake_recaptcha.py) with the given latencies,
+seeds users and chats, and drives every scenario at each concurrency level. the requests go straight into the
+ASGI application in this process (httpx's ASGITransport, one worker's worth of app), or to a running server
+with --url. per scenario and level it reports throughput, p50/p95/p99 latency and the database queries per
+request (from the app's own /metrics/, lang_app/instrumentation.py), and writes them all to a json file.
+
+    python benchmarks/loadtest.py run --concurrency 1,8,32 --requests 200 --llm-latency 0.5 -o before.json
+
+compare: lines two result files up and flags regressions (throughput down, p95/p99 up by more than
+--threshold, more queries per request). exits with 1 when there are any.
+
+    python benchmarks/loadtest.py compare before.json after.json --threshold 0.1
+
+commits: runs the load test on two commits (checked out in temporary git worktrees, this script and
+settings_bench.py from the working tree) and compares them. the run options go after the commits.
+
+    python benchmarks/loadtest.py commits main HEAD --concurrency 1,16 --requests 100
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BENCH_DIR)
+
+PASSWORD = 'bench-password-1'
+# the view label of each scenario in the app's metrics
+SCENARIO_VIEWS = {
+    'chat_get': 'ChatView',
+    'chat_post': 'ChatView',
+    'login': 'UserLoginView',
+    'register': 'UserRegisterView',
+}
+OK_STATUS = {'chat_get': {200}, 'chat_post': {200}, 'login': {200}, 'register': {201}}
+
+
+def setup_django(backend_dir, llm_url, recaptcha_url):
+    # backend/ for lang_app, lang_chat, login, its parent for the backend.* names in INSTALLED_APPS
+    for path in (BENCH_DIR, os.path.dirname(backend_dir), backend_dir):
+        sys.path.insert(0, path)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings_bench')
+    os.environ['COHERE_BASE_URL'] = llm_url
+    os.environ['RECAPTCHA_VERIFY_URL'] = recaptcha_url
+    import django
+
+    django.setup()
+
+
+def seed(users, chats, history):
+    """Migrate, then create the login users and the chats the scenarios use. Returns the chat ids."""
+    from django.contrib.auth import get_user_model
+    from django.contrib.auth.hashers import make_password
+    from django.core.management import call_command
+    from lang_chat.models import Chat
+    from lang_chat.writes import write_turns
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    User = get_user_model()
+    encoded = make_password(PASSWORD)  # hashed once, every bench user has the same password
+    User.objects.bulk_create(
+        [User(username=f'bench-login-{i}', email=f'bench-login-{i}@example.com', password=encoded) for i in range(users)],
+        ignore_conflicts=True,
+    )
+    existing = list(Chat.objects.filter(chat_name__startswith='bench-').values_list('chat_id', flat=True)[:chats])
+    for i in range(len(existing), chats):
+        chat = Chat.objects.create(chat_name=f'bench-{i}')
+        write_turns([(chat, f'question {n}', f'answer {n}', None) for n in range(history)])
+        existing.append(chat.chat_id)
+    return existing
+
+
+class Scenarios:
+    def __init__(self, chat_ids, users, run_id):
+        self.chat_ids = chat_ids
+        self.users = users
+        self.run_id = run_id
+
+    def request(self, scenario, i):
+        """(method, path, json body) of the i-th request of a scenario."""
+        if scenario == 'chat_get':
+            return 'GET', f'/chat/{self.chat_ids[i % len(self.chat_ids)]}/', None
+        if scenario == 'chat_post':
+            # unique, so the completion cache doesn't answer it
+            return 'POST', f'/chat/{self.chat_ids[i % len(self.chat_ids)]}/', {'message': f'hello {self.run_id} {i}'}
+        if scenario == 'login':
+            user = i % self.users
+            return 'POST', '/login/', {'email': f'bench-login-{user}@example.com', 'password': PASSWORD}
+        if scenario == 'register':
+            name = f'bench-{self.run_id}-{i}'
+            return 'POST', '/register/', {
+                'username': name, 'email': f'{name}@example.com', 'password': PASSWORD, 'recaptchaToken': f'token-{name}',
+            }
+        raise ValueError(f'Unknown scenario {scenario!r}')
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))]
+
+
+def parse_metrics(text, names):
+    """{(metric name, view): value} of the _sum/_count lines of these histograms."""
+    values = {}
+    for line in text.splitlines():
+        match = re.match(r'^(\w+)\{([^}]*)\} (\S+)$', line)
+        if not match or match.group(1) not in names:
+            continue
+        view = re.search(r'view="([^"]*)"', match.group(2))
+        if view:
+            key = (match.group(1), view.group(1))
+            values[key] = values.get(key, 0.0) + float(match.group(3))
+    return values
+
+
+DB_METRICS = (
+    'http_request_db_queries_sum', 'http_request_db_queries_count',
+    'http_request_db_seconds_sum', 'http_request_db_seconds_count',
+)
+
+
+async def scrape(client):
+    from django.conf import settings
+
+    # settings_bench.py sets the token, older commits serve /metrics/ to anybody and ignore the header
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    response = await client.get('/metrics/', headers={'Authorization': f'Bearer {token}'} if token else {})
+    if response.status_code != 200:
+        return {}
+    return parse_metrics(response.text, DB_METRICS)
+
+
+async def run_level(client, scenarios, scenario, concurrency, total):
+    counter = itertools.count()
+    latencies, statuses = [], Counter()
+
+    async def worker():
+        while True:
+            i = next(counter)
+            if i >= total:
+                return
+            method, path, body = scenarios.request(scenario, i)
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, path, json=body)
+                status = response.status_code
+            except Exception as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[status] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, sorted(latencies), statuses
+
+
+async def run_all(client, scenarios, args):
+    results = []
+    for scenario in args.scenarios:
+        for concurrency in args.concurrency:
+            total = max(args.requests, concurrency * 4)
+            # warm up the clients, pools and caches of this scenario, not measured
+            scenarios.run_id = uuid.uuid4().hex[:8]
+            await run_level(client, scenarios, scenario, min(concurrency, 8), min(concurrency, 8))
+            scenarios.run_id = uuid.uuid4().hex[:8]
+            before = await scrape(client)
+            seconds, latencies, statuses = await run_level(client, scenarios, scenario, concurrency, total)
+            after = await scrape(client)
+
+            view = SCENARIO_VIEWS[scenario]
+            diff = {name: after.get((name, view), 0.0) - before.get((name, view), 0.0) for name in DB_METRICS}
+            counted = diff['http_request_db_queries_count']
+            errors = sum(count for status, count in statuses.items() if status not in OK_STATUS[scenario])
+            row = {
+                'scenario': scenario,
+                'concurrency': concurrency,
+                'requests': total,
+                'errors': errors,
+                'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+                'seconds': seconds,
+                'throughput': total / seconds,
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': percentile(latencies, 0.50) * 1000,
+                'p95_ms': percentile(latencies, 0.95) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                # None when the app has no /metrics/ (older commits)
+                'db_queries_per_request': diff['http_request_db_queries_sum'] / counted if counted else None,
+                'db_ms_per_request': diff['http_request_db_seconds_sum'] / counted * 1000 if counted else None,
+            }
+            results.append(row)
+            print(format_row(row), flush=True)
+    return results
+
+
+def format_row(row):
+    queries = row['db_queries_per_request']
+    return (
+        f"{row['scenario']:<10} c={row['concurrency']:<4} {row['throughput']:9.1f} req/s  "
+        f"p50 {row['p50_ms']:8.1f}ms  p95 {row['p95_ms']:8.1f}ms  p99 {row['p99_ms']:8.1f}ms  "
+        f"queries {'-' if queries is None else f'{queries:.1f}'}  errors {row['errors']}"
+    )
+
+
+def git_commit(path):
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    import httpx
+
+    from fake_cohere import start_server as start_cohere
+    from fake_recaptcha import start_server as start_recaptcha
+
+    llm = start_cohere(latency=args.llm_latency, first_token_latency=min(args.llm_latency, 0.2))
+    recaptcha = start_recaptcha(latency=args.captcha_latency)
+    backend_dir = os.path.abspath(args.backend_dir)
+    setup_django(backend_dir, llm.url, recaptcha.url)
+
+    from django.conf import settings
+    from django.db import connection
+
+    chat_ids = seed(args.users, args.chats, args.history)
+    scenarios = Scenarios(chat_ids, args.users, uuid.uuid4().hex[:8])
+
+    async def main():
+        if args.url:
+            transport, base_url = httpx.AsyncHTTPTransport(), args.url
+        else:
+            from django.core.asgi import get_asgi_application
+
+            transport, base_url = httpx.ASGITransport(app=get_asgi_application()), 'http://testserver'
+        async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+            return await run_all(client, scenarios, args)
+
+    results = asyncio.run(main())
+    llm.shutdown()
+    recaptcha.shutdown()
+
+    import django
+
+    report = {
+        'meta': {
+            'commit': git_commit(backend_dir),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'settings': settings.SETTINGS_MODULE,
+            'target': args.url or 'asgi in process',
+            'llm_latency': args.llm_latency,
+            'captcha_latency': args.captcha_latency,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {args.output}')
+
+
+def compare(base, new, threshold):
+    """[(row key, [(what, base value, new value)]), ...] of the regressions, and the printable table."""
+    base_rows = {(row['scenario'], row['concurrency']): row for row in base['results']}
+    lines = [f"{(base['meta'].get('commit') or 'base')[:12]} -> {(new['meta'].get('commit') or 'new')[:12]}"]
+    regressions = []
+    for row in new['results']:
+        key = (row['scenario'], row['concurrency'])
+        old = base_rows.get(key)
+        if old is None:
+            continue
+        found = []
+        if row['throughput'] < old['throughput'] * (1 - threshold):
+            found.append(('throughput', old['throughput'], row['throughput']))
+        for field in ('p95_ms', 'p99_ms'):
+            if row[field] > old[field] * (1 + threshold):
+                found.append((field, old[field], row[field]))
+        old_queries, new_queries = old.get('db_queries_per_request'), row.get('db_queries_per_request')
+        # query counts don't jitter, half a query more per request is a new query on a path
+        if old_queries is not None and new_queries is not None and new_queries >= old_queries + 0.5:
+            found.append(('db_queries_per_request', old_queries, new_queries))
+        if row['errors'] > old['errors']:
+            found.append(('errors', old['errors'], row['errors']))
+
+        change = (row['throughput'] - old['throughput']) / old['throughput']
+        p95_change = (row['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0
+        lines.append(
+            f"{key[0]:<10} c={key[1]:<4} throughput {old['throughput']:8.1f} -> {row['throughput']:8.1f} ({change:+.0%})  "
+            f"p95 {old['p95_ms']:8.1f} -> {row['p95_ms']:8.1f}ms ({p95_change:+.0%})"
+            + ('  REGRESSION: ' + ', '.join(what for what, _, _ in found) if found else '')
+        )
+        if found:
+            regressions.append((key, found))
+    return regressions, lines
+
+
+def compare_files(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    regressions, lines = compare(base, new, args.threshold)
+    print('\n'.join(lines))
+    print(f'{len(regressions)} regressions' if regressions else 'no regressions')
+    return 1 if regressions else 0
+
+
+def run_commits(args, run_args):
+    toplevel = subprocess.run(
+        ['git', 'rev-parse', '--show-toplevel'], cwd=PROJECT_DIR, capture_output=True, text=True, check=True,
+    ).stdout.strip()
+    backend = os.path.relpath(os.path.join(PROJECT_DIR, 'backend'), toplevel)
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    outputs = []
+    try:
+        for n, commit in enumerate((args.base, args.new)):
+            tree = os.path.join(workdir, f'tree{n}')
+            subprocess.run(['git', 'worktree', 'add', '--detach', tree, commit], cwd=toplevel, check=True)
+            output = os.path.join(workdir, f'{n}.json')
+            env = dict(os.environ)
+            # a fresh sqlite file per commit unless a database was given
+            env.setdefault('BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(workdir, f'{n}.sqlite3'))
+            try:
+                subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), 'run', '--backend-dir', os.path.join(tree, backend),
+                     '--output', output, *run_args],
+                    env=env, check=True,
+                )
+            finally:
+                subprocess.run(['git', 'worktree', 'remove', '--force', tree], cwd=toplevel)
+            outputs.append(output)
+        args.base, args.new = outputs
+        return compare_files(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def add_run_arguments(parser):
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIO_VIEWS),
+                        help='comma separated, of ' + ', '.join(SCENARIO_VIEWS))
+    parser.add_argument('--concurrency', type=lambda value: [int(level) for level in value.split(',')],
+                        default=[1, 8, 32], help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=200, help='requests per scenario and level (at least 4 per client)')
+    parser.add_argument('--llm-latency', type=float, default=0.5, help='seconds the fake cohere takes per completion')
+    parser.add_argument('--captcha-latency', type=float, default=0.05, help='seconds the fake recaptcha takes')
+    parser.add_argument('--users', type=int, default=20, help='login users to seed')
+    parser.add_argument('--chats', type=int, default=20, help='chats to seed')
+    parser.add_argument('--history', type=int, default=30, help='turns of history in each seeded chat')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds before a request counts as failed')
+    parser.add_argument('--url', help='load test a running server (started with settings_bench) instead')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run the load test and write the results')
+    add_run_arguments(run_parser)
+    run_parser.add_argument('--backend-dir', default=os.path.join(PROJECT_DIR, 'backend'))
+    run_parser.add_argument('-o', '--output', default='loadtest.json')
+
+    compare_parser = commands.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative change that is a regression')
+
+    commits_parser = commands.add_parser('commits', help='run on two commits and compare')
+    commits_parser.add_argument('base')
+    commits_parser.add_argument('new')
+    commits_parser.add_argument('--threshold', type=float, default=0.1)
+
+    args, rest = parser.parse_known_args()
+    if args.command == 'run':
+        if rest:
+            parser.error(f'unrecognized arguments: {" ".join(rest)}')
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare_files(args))
+    else:
+        # the rest are run options, checked by the runs
+        sys.exit(run_commits(args, rest))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,9 @@ function Chat() {
 const [chat, setChat] = useState([]);
 // message is the state that holds the message that the user is typing
 const [message, setMessage] = useState('');
+// pending holds the turn that is still streaming in (the user's message and the half written ai reply).
+// it is kept apart from chat because fetchChatHistory replaces chat every second and would wipe it
+const [pending, setPending] = useState([]);
 // messagesEndRef is a reference to the last message in the chat
 // so a function (scrollToBottom) can be called to scroll to the bottom of the chat
 // it is null when first initialized, because when users first enter the chat they 
@@ -178,7 +181,9 @@ const sendMessage = async () => {
     // message object has to be stringified into a JSON string to be sent to the backend
     // same thing as fetchChatHistory, the response is stored in the response variable
 
-    const response = await fetch('http://localhost:8000/chat/', { // Update the URL to match your Django URL configuration
+    // the reply is streamed from chat/stream/ (server-sent events) instead of waiting for the whole thing,
+    // so the first words show up as soon as cohere generates them
+    const response = await fetch('http://localhost:8000/chat/stream/', { // Update the URL to match your Django URL configuration
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
@@ -186,28 +191,56 @@ const sendMessage = async () => {
         body: JSON.stringify({ message }),
     });
 
-    // the response is parsed into json format and stored in data
-    const data = await response.json(); // Read the response body here
-
-    // if the reponse is okay (response.ok = True)
-    if (response.ok) {
-        // Add the new message to the existing chat state, initialised as an empty array
-        // chat => is a function that updates the chat state
-        // updated with [...chat, ...data.messages], which is a new array
-        // the new array is the old array (chat) and the new message (data.messages)
-        // ...chat is a spread operator, which is for including all elements from chat, likewise for ...data.messages, in the new array
-        setChat(chat => [...chat, ...data.messages]); // Use the data from response.json()
-
-        // Scroll to the bottom of the chat
-        scrollToBottom();
-
-    // if the response is not okay (response.ok = False)
-    } else {
-        // the response will be parsed an stored in errorData
+    // if the response is not okay (response.ok = False) nothing was streamed, the backend sent a json error
+    if (!response.ok) {
         const errorData = await response.json();
-        // the error message, with the error part of the errorData object will be logged in the console
         console.error('Failed to send message:', errorData.error);
+        return;
     }
+
+    // show the user's message and an empty ai bubble right away, the ai text fills in token by token
+    const sentAt = new Date().toISOString();
+    const userBubble = { sender__username: 'user', message_text: message, timestamp: sentAt };
+    let aiText = '';
+    setPending([userBubble, { sender__username: 'ai', message_text: aiText, timestamp: sentAt }]);
+
+    // read the body as it arrives. events are separated by a blank line, and look like
+    // event: token
+    // data: {"text": "..."}
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        // the last piece may be an event that is only half received, keep it for the next read
+        buffer = events.pop();
+
+        for (const rawEvent of events) {
+            const lines = rawEvent.split('\n');
+            const eventName = lines.find(line => line.startsWith('event: '))?.slice(7);
+            const dataLine = lines.find(line => line.startsWith('data: '));
+            if (!eventName || !dataLine) continue;
+            const data = JSON.parse(dataLine.slice(6));
+
+            if (eventName === 'token') {
+                aiText += data.text;
+                setPending([userBubble, { sender__username: 'ai', message_text: aiText, timestamp: sentAt }]);
+            } else if (eventName === 'done') {
+                // both messages are saved now, same shape as the non streaming response
+                setChat(chat => [...chat, ...data.messages]);
+                setPending([]);
+            } else if (eventName === 'error') {
+                console.error('Failed to send message:', data.error);
+            }
+        }
+    }
+    setPending([]);
+
+    // Scroll to the bottom of the chat
+    scrollToBottom();
 };
 
 return (
@@ -305,7 +338,7 @@ return (
                     chat.map() is called on the chat array. Each element calls the the callback function,  and the messages in the element is called by the name msg. 
                     the naming doesn't really matter. I can name is it hello or whatever, but msg as in message just makes sense in this context. 
                     index is the actual second parameter of the map function, so it just makes sense */}
-                    {chat.map((msg, index) => (
+                    {[...chat, ...pending].map((msg, index) => (
                             // god usernaming is so funny. i changed the backend and forgot to change this, 
                             // had sender instead of sender_username and had non styled messages 
                             // the naming has to match what the backend is sending
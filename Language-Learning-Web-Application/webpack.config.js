@@ -12,7 +12,8 @@ module.exports = {
     filename: '[name].bundle.js',
     // __dirname is where webpack.config.js lives
     path: path.resolve(__dirname, 'dist'),
-    publicPath: '/',
+    // the bundles are collected and served under STATIC_URL (lang_app/storage.py)
+    publicPath: '/static/',
   },
   plugins: [
     // Add more HtmlWebpackPlugin instances for each HTML file